@@ -0,0 +1,219 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+
+import numpy as np
+
+# Import the annotation hash the mask cache keys rasterized shapes by
+from dataset_cache import get_annotation_hash
+
+# Name of the annotation manifest in a dataset directory; not .json, so it is never read as an annotation
+MANIFEST_NAME = 'annotation-manifest.jsonl'
+MANIFEST_VERSION = 1
+
+class AnnotationIndex:
+    """
+    Flat, array-backed index of the labelme annotations in a dataset.
+
+    All polygon vertices live in one (points, 2) coordinate buffer. Shapes are
+    slices of that buffer given by `shape_offsets`, and images are slices of the
+    shapes given by `image_offsets`. Because the index holds only a few NumPy
+    arrays and plain lists, DataLoader workers can share it cheaply.
+    """
+    def __init__(self, keys, label_names, shape_labels, coords, shape_offsets, image_offsets, image_sizes=None):
+        self.keys = keys  # Image keys, the annotated image file name without extension
+        self.label_names = label_names  # Label names in order of first appearance
+        self.shape_labels = shape_labels  # Index into label_names for every shape
+        self.coords = coords  # Polygon vertices of every shape, concatenated
+        self.shape_offsets = shape_offsets  # First vertex of each shape, plus the total
+        self.image_offsets = image_offsets  # First shape of each image, plus the total
+        self.image_sizes = image_sizes  # (height, width) of every image as recorded by labelme, 0 when missing
+        self._key_to_index = {key: i for i, key in enumerate(keys)}
+
+    @classmethod
+    def from_directory(cls, dataset_directory, max_workers=None):
+        """
+        Parses every labelme JSON file in a directory with a thread pool.
+
+        Args:
+            dataset_directory: Path to the directory of annotation files.
+            max_workers: The number of parsing threads (default: based on the CPU count).
+
+        Returns:
+            An AnnotationIndex over all annotated images.
+        """
+        annotation_file_paths = sorted(Path(dataset_directory).glob("*.json"))
+        return cls.from_files(annotation_file_paths, max_workers)
+
+    @classmethod
+    def from_manifest(cls, dataset_directory, manifest_path=None, max_workers=None):
+        """
+        Builds the index from the annotation manifest of a directory, parsing
+        only the annotation files that are new or changed since it was written.
+
+        The manifest holds one JSON line per annotation file with its size,
+        modification time, annotation hash and shapes. Files whose size and
+        modification time match their line are not opened; the manifest is
+        rewritten when any file was added, changed or removed.
+
+        Args:
+            dataset_directory: Path to the directory of annotation files.
+            manifest_path: Path to the manifest (default: MANIFEST_NAME in the directory).
+            max_workers: The number of parsing threads (default: based on the CPU count).
+
+        Returns:
+            An AnnotationIndex over all annotated images.
+        """
+        dataset_directory = Path(dataset_directory)
+        manifest_path = Path(manifest_path or dataset_directory/MANIFEST_NAME)
+        records = _load_manifest(manifest_path)
+
+        # One directory listing gives the size and modification time of every annotation file
+        with os.scandir(dataset_directory) as entries:
+            file_stats = {entry.name: entry.stat() for entry in entries if entry.name.endswith('.json') and entry.is_file()}
+        stale_names = sorted(name for name, stat in file_stats.items()
+                             if name not in records or (records[name]['size'], records[name]['mtime_ns']) != (stat.st_size, stat.st_mtime_ns))
+        removed_names = records.keys() - file_stats.keys()
+
+        if stale_names:
+            max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                annotations = executor.map(_read_annotation, [dataset_directory/name for name in stale_names])
+                for name, annotation in zip(stale_names, annotations):
+                    stat = file_stats[name]
+                    records[name] = _make_manifest_record(name, stat.st_size, stat.st_mtime_ns, annotation)
+        for name in removed_names:
+            del records[name]
+        if stale_names or removed_names:
+            _save_manifest(manifest_path, records)
+
+        names = sorted(records)
+        return cls.from_annotations([records[name]['annotation'] for name in names], [dataset_directory/name for name in names])
+
+    @classmethod
+    def from_files(cls, annotation_file_paths, max_workers=None):
+        max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            annotations = list(executor.map(_read_annotation, annotation_file_paths))
+        return cls.from_annotations(annotations, annotation_file_paths)
+
+    @classmethod
+    def from_annotations(cls, annotations, annotation_file_paths):
+        """
+        Args:
+            annotations: Parsed labelme annotations with 'imagePath' and 'shapes'.
+            annotation_file_paths: The file each annotation came from, for error messages.
+        """
+        keys = []
+        seen_keys = set()
+        label_names = []
+        label_to_index = {}
+        shape_labels = []
+        point_counts = []
+        shape_counts = []
+        point_arrays = []
+        image_sizes = []
+        for file_path, annotation in zip(annotation_file_paths, annotations):
+            key = annotation['imagePath'].split('.')[0]
+            if key in seen_keys:
+                raise ValueError(f"Duplicate annotation for image {key} in {file_path}")
+            seen_keys.add(key)
+            keys.append(key)
+            shape_counts.append(len(annotation['shapes']))
+            image_sizes.append((annotation.get('imageHeight') or 0, annotation.get('imageWidth') or 0))
+
+            for shape in annotation['shapes']:
+                label = shape['label']
+                if label not in label_to_index:
+                    label_to_index[label] = len(label_names)
+                    label_names.append(label)
+                shape_labels.append(label_to_index[label])
+                point_counts.append(len(shape['points']))
+                point_arrays.append(np.asarray(shape['points'], dtype=np.float64).reshape(-1, 2))
+
+        coords = np.concatenate(point_arrays) if point_arrays else np.zeros((0, 2), dtype=np.float64)
+        shape_offsets = np.concatenate([[0], np.cumsum(point_counts)]).astype(np.int64)
+        image_offsets = np.concatenate([[0], np.cumsum(shape_counts)]).astype(np.int64)
+        image_sizes = np.asarray(image_sizes, dtype=np.int64).reshape(-1, 2)
+        return cls(keys, label_names, np.asarray(shape_labels, dtype=np.int32), coords, shape_offsets, image_offsets, image_sizes)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._key_to_index
+
+    def get_labels(self, key):
+        start, end = self._get_shape_range(key)
+        return [self.label_names[label] for label in self.shape_labels[start:end]]
+
+    def get_polygons(self, key):
+        """
+        Returns the polygons of an image as (vertices, 2) views into the coordinate buffer.
+        """
+        start, end = self._get_shape_range(key)
+        return [self.coords[self.shape_offsets[i]:self.shape_offsets[i + 1]] for i in range(start, end)]
+
+    def get_shapes(self, key):
+        """
+        Returns the shapes of an image in the labelme `{'label', 'points'}` form.
+        """
+        return [{'label': label, 'points': polygon.tolist()} for label, polygon in zip(self.get_labels(key), self.get_polygons(key))]
+
+    def get_image_size(self, key):
+        """
+        Returns the (height, width) labelme recorded for an image, or None when it is missing.
+        """
+        if self.image_sizes is None:
+            return None
+        height, width = self.image_sizes[self._key_to_index[key]]
+        return (int(height), int(width)) if height and width else None
+
+    def _get_shape_range(self, key):
+        index = self._key_to_index[key]
+        return self.image_offsets[index], self.image_offsets[index + 1]
+
+def _read_annotation(file_path):
+    with open(file_path, 'r') as file:
+        annotation = json.load(file)
+    # Drop the embedded image data, which is never used and can be large
+    annotation.pop('imageData', None)
+    return annotation
+
+def _make_manifest_record(file_name, size, mtime_ns, annotation):
+    # Keeps only what the index reads, so the manifest stays a fraction of the size of the annotation files
+    shapes = [{'label': shape['label'], 'points': shape['points']} for shape in annotation['shapes']]
+    return {
+        'file': file_name,
+        'size': size,
+        'mtime_ns': mtime_ns,
+        'annotation_hash': get_annotation_hash(shapes),
+        'annotation': {
+            'imagePath': annotation['imagePath'],
+            'imageHeight': annotation.get('imageHeight'),
+            'imageWidth': annotation.get('imageWidth'),
+            'shapes': shapes,
+        },
+    }
+
+def _load_manifest(manifest_path):
+    # Returns the records of a manifest by file name, or none when it is missing, damaged or from another version
+    try:
+        with open(manifest_path, 'r') as file:
+            header = json.loads(file.readline())
+            if header.get('version') != MANIFEST_VERSION:
+                return {}
+            records = [json.loads(line) for line in file]
+    except (FileNotFoundError, json.JSONDecodeError, AttributeError):
+        return {}
+    return {record['file']: record for record in records}
+
+def _save_manifest(manifest_path, records):
+    # Write to a temporary file first, so concurrent readers such as other DDP ranks never see a partial manifest
+    temp_path = manifest_path.with_name(f"{manifest_path.name}.{os.getpid()}.tmp")
+    with open(temp_path, 'w') as file:
+        file.write(json.dumps({'version': MANIFEST_VERSION}) + '\n')
+        for name in sorted(records):
+            file.write(json.dumps(records[name], separators=(',', ':')) + '\n')
+    os.replace(temp_path, manifest_path)
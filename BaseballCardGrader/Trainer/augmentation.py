@@ -0,0 +1,294 @@
+from pathlib import Path
+import argparse
+import json
+import math
+import random
+import time
+
+import torch
+import torchvision.transforms.v2 as transforms
+import torchvision.transforms.v2.functional as TF
+from torchvision import tv_tensors
+from torchvision.tv_tensors import BoundingBoxes, Mask
+
+# Import the resize policies
+from batching import get_resize_transform
+
+# Import the polygon-centered crops of tiled training
+from tiling import PolygonCrop
+
+# How training samples are augmented: the PIL chain, or the uint8 tensor chain with jitter applied per batch
+AUGMENTATION_PIPELINES = ('pil', 'tensor')
+
+# Grayscale weights of torchvision's rgb_to_grayscale
+GRAY_WEIGHTS = torch.tensor([0.2989, 0.587, 0.114])
+
+# RGB to YIQ, whose chroma plane a hue shift rotates
+RGB_TO_YIQ = torch.tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]])
+
+def get_pil_transforms(resize_policy, tile_size=None, tile_background=0.1):
+    """
+    Builds the training and validation transforms that jitter and flip the
+    decoded image before resizing it and converting it to float32.
+
+    Returns:
+        A tuple of the training and validation transforms. Both are collated
+        with custom_collate_fn of train_model.py.
+    """
+    # Define data augmentation transforms
+    data_augment_transforms = transforms.Compose(
+        transforms=[
+            transforms.ColorJitter(
+                    brightness = (0.95, 1.05),
+                    contrast = (0.95, 1.05),
+                    saturation = (0.95, 1.05),
+                    hue = (-0.02, 0.02),
+            ),
+            transforms.RandomHorizontalFlip(p=0.5),
+            transforms.RandomVerticalFlip(p=0.5),
+        ],
+    )
+    # Compose transforms to sanitize bounding boxes and normalize input data
+    final_tranforms = transforms.Compose([
+        transforms.ToImage(),
+        transforms.ToDtype(torch.float32, scale=True),
+        transforms.SanitizeBoundingBoxes(),
+    ])
+    # Compose transforms to resize images
+    resize_tranforms = transforms.Compose([
+        get_resize_transform(resize_policy)
+    ])
+    # Define the transformations for training and validation datasets
+    if tile_size:
+        # Full-resolution tiles around the polygons replace resizing, and are cropped before augmenting so only the tile is jittered
+        train_tfms = transforms.Compose([
+            PolygonCrop(tuple(tile_size), tile_background),
+            data_augment_transforms,
+            final_tranforms
+        ])
+        valid_tfms = transforms.Compose([
+            PolygonCrop(tuple(tile_size), jitter=False),
+            final_tranforms
+        ])
+    else:
+        train_tfms = transforms.Compose([
+            data_augment_transforms,
+            resize_tranforms,
+            final_tranforms
+        ])
+        valid_tfms = transforms.Compose([
+            resize_tranforms,
+            final_tranforms
+        ])
+    return train_tfms, valid_tfms
+
+def get_tensor_transforms(resize_policy, tile_size=None, tile_background=0.1):
+    """
+    Builds the training and validation transforms that bring each sample to
+    its training size first, and flip it as a uint8 CHW tensor.
+
+    Images stay uint8 through the dataset. Photometric jitter and the float32
+    conversion happen per batch in BatchCollate, which both returned
+    transforms must be collated with.
+
+    Returns:
+        A tuple of the training and validation transforms.
+    """
+    to_size = PolygonCrop(tuple(tile_size), tile_background) if tile_size else get_resize_transform(resize_policy)
+    valid_to_size = PolygonCrop(tuple(tile_size), jitter=False) if tile_size else get_resize_transform(resize_policy)
+    train_tfms = transforms.Compose([
+        transforms.ToImage(),
+        to_size,
+        RandomFlips(),
+        transforms.SanitizeBoundingBoxes(),
+    ])
+    valid_tfms = transforms.Compose([
+        transforms.ToImage(),
+        valid_to_size,
+        transforms.SanitizeBoundingBoxes(),
+    ])
+    return train_tfms, valid_tfms
+
+class RandomFlips:
+    """
+    Flips a sample horizontally and vertically, each with probability p.
+
+    Both flips of the image and masks are done in one pass, and boxes are
+    mirrored by swapping their coordinates instead of being recomputed from
+    the masks. Takes and returns the (image, target) pair of BaseballCardDataset.
+    """
+    def __init__(self, horizontal_p=0.5, vertical_p=0.5):
+        self.horizontal_p = horizontal_p
+        self.vertical_p = vertical_p
+
+    def __call__(self, image, target):
+        flip_horizontal = random.random() < self.horizontal_p
+        flip_vertical = random.random() < self.vertical_p
+        dims = [-1] * flip_horizontal + [-2] * flip_vertical
+        if not dims:
+            return image, target
+
+        height, width = image.shape[-2:]
+        boxes = target['boxes'].as_subclass(torch.Tensor)
+        if flip_horizontal:
+            boxes = torch.stack([width - boxes[:, 2], boxes[:, 1], width - boxes[:, 0], boxes[:, 3]], dim=1)
+        if flip_vertical:
+            boxes = torch.stack([boxes[:, 0], height - boxes[:, 3], boxes[:, 2], height - boxes[:, 1]], dim=1)
+        image = tv_tensors.wrap(image.flip(dims), like=image)
+        masks = Mask(target['masks'].flip(dims))
+        boxes = BoundingBoxes(boxes, format='xyxy', canvas_size=(height, width))
+        return image, {**target, 'masks': masks, 'boxes': boxes}
+
+class BatchColorJitter:
+    """
+    Jitters the brightness, contrast, saturation and hue of a batch of uint8 images at once.
+
+    Each of the four adjustments is linear in RGB, so they are folded into a
+    3x3 matrix and an offset per image and applied in one pass while the
+    images are converted to float32. Hue is rotated in the YIQ chroma plane
+    rather than HSV, which approximates ColorJitter for the small shifts used. The
+    adjustments are always applied in the order above and clamped once at the
+    end, where ColorJitter shuffles them and clamps after each.
+    """
+    def __init__(self, brightness=(0.95, 1.05), contrast=(0.95, 1.05), saturation=(0.95, 1.05), hue=(-0.02, 0.02)):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+
+    def __call__(self, images):
+        """
+        Args:
+            images: A sequence of uint8 (3, H, W) images, which may differ in size.
+
+        Returns:
+            A list of the jittered float32 images, scaled to [0, 1].
+        """
+        count = len(images)
+        brightness = torch.empty(count).uniform_(*self.brightness)
+        contrast = torch.empty(count).uniform_(*self.contrast)
+        saturation = torch.empty(count).uniform_(*self.saturation)
+        angle = torch.empty(count).uniform_(*self.hue) * 2 * math.pi
+
+        # Contrast blends towards the mean gray of the brightened image, which is the brightness times the original's
+        mean_gray = torch.stack([image.sum(dim=(1, 2), dtype=torch.float64).float() / (image.shape[1] * image.shape[2]) for image in images]) @ GRAY_WEIGHTS / 255
+        identity = torch.eye(3).expand(count, 3, 3)
+        saturation_matrix = saturation[:, None, None] * identity + (1 - saturation)[:, None, None] * GRAY_WEIGHTS.expand(count, 3, 3)
+        rotation = torch.zeros(count, 3, 3)
+        rotation[:, 0, 0] = 1
+        rotation[:, 1, 1] = rotation[:, 2, 2] = torch.cos(angle)
+        rotation[:, 1, 2] = torch.sin(angle)
+        rotation[:, 2, 1] = -torch.sin(angle)
+        hue_matrix = torch.linalg.inv(RGB_TO_YIQ) @ rotation @ RGB_TO_YIQ
+
+        color_matrix = hue_matrix @ saturation_matrix
+        offsets = color_matrix @ ((1 - contrast) * brightness * mean_gray)[:, None].expand(count, 3)[..., None]
+        matrices = color_matrix * (contrast * brightness / 255)[:, None, None]
+
+        if all(image.shape == images[0].shape for image in images):
+            batch = torch.einsum('bij,bjhw->bihw', matrices, torch.stack(list(images)).float())
+            return list(batch.add_(offsets[..., None]).clamp_(0, 1))
+        return [torch.einsum('ij,jhw->ihw', matrix, image.float()).add_(offset[..., None]).clamp_(0, 1)
+                for matrix, offset, image in zip(matrices, offsets, images)]
+
+class BatchCollate:
+    """
+    Collates samples of the uint8 tensor pipeline into the (images, targets)
+    tuples of custom_collate_fn, converting the images to float32 and
+    jittering them as a batch when a jitter is given.
+    """
+    def __init__(self, jitter=None):
+        self.jitter = jitter
+
+    def __call__(self, batch):
+        images, targets = tuple(zip(*batch))
+        if self.jitter:
+            images = self.jitter(images)
+        else:
+            images = [TF.to_dtype(image, torch.float32, scale=True) for image in images]
+        return tuple(images), targets
+
+def get_collate_fns(pipeline, default_collate_fn):
+    """
+    Returns the training and validation collate functions of an augmentation pipeline.
+
+    Args:
+        pipeline: One of AUGMENTATION_PIPELINES.
+        default_collate_fn: The collate function of the PIL pipeline.
+    """
+    if pipeline == 'pil':
+        return default_collate_fn, default_collate_fn
+    if pipeline == 'tensor':
+        return BatchCollate(BatchColorJitter()), BatchCollate()
+    raise ValueError(f"Unknown augmentation pipeline {pipeline}, expected one of {AUGMENTATION_PIPELINES}")
+
+def get_augmentation_transforms(pipeline, resize_policy, tile_size=None, tile_background=0.1):
+    # Returns the training and validation transforms of an augmentation pipeline
+    if pipeline == 'pil':
+        return get_pil_transforms(resize_policy, tile_size, tile_background)
+    if pipeline == 'tensor':
+        return get_tensor_transforms(resize_policy, tile_size, tile_background)
+    raise ValueError(f"Unknown augmentation pipeline {pipeline}, expected one of {AUGMENTATION_PIPELINES}")
+
+def benchmark_augmentation(make_dataset, default_collate_fn, batch_size=4, num_batches=8, pipelines=AUGMENTATION_PIPELINES, resize_policy='stretch'):
+    """
+    Measures the training samples per second of each augmentation pipeline on
+    the CPU, loading and collating in this process as one DataLoader worker would.
+
+    Args:
+        make_dataset: A function of the training transforms returning a dataset of
+            (image, target) pairs, such as a BaseballCardDataset.
+        default_collate_fn: The collate function of the PIL pipeline.
+        num_batches: The number of batches timed for each pipeline, after one warm-up batch.
+
+    Returns:
+        A dictionary of the samples per second and milliseconds per sample of each pipeline.
+    """
+    report = {'batch_size': batch_size, 'num_batches': num_batches, 'resize_policy': resize_policy, 'pipelines': {}}
+    for pipeline in pipelines:
+        train_tfms, _ = get_augmentation_transforms(pipeline, resize_policy)
+        collate_fn, _ = get_collate_fns(pipeline, default_collate_fn)
+        dataset = make_dataset(train_tfms)
+        indices = [i % len(dataset) for i in range((num_batches + 1) * batch_size)]
+        batches = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+
+        collate_fn([dataset[i] for i in batches[0]])
+        start = time.perf_counter()
+        for batch in batches[1:]:
+            collate_fn([dataset[i] for i in batch])
+        elapsed = time.perf_counter() - start
+        samples = num_batches * batch_size
+        report['pipelines'][pipeline] = {'samples_per_sec': samples / elapsed, 'ms_per_sample': elapsed / samples * 1000}
+    return report
+
+if __name__ == "__main__":
+    # Imported here so the training transforms do not pull in the trainer
+    from train_model import BaseballCardDataset, load_dataset_annotations, custom_collate_fn
+    from dataset_cache import MaskCache
+
+    parser = argparse.ArgumentParser(description="Benchmark the training samples per second of the augmentation pipelines on the CPU")
+    parser.add_argument("dataset_directory", type=Path, help="Path to the dataset of images and labelme annotations")
+    parser.add_argument("--batch-size", type=int, default=4, help="Images per batch")
+    parser.add_argument("--num-batches", type=int, default=8, help="Batches timed for each pipeline")
+    parser.add_argument("--resize-policy", default="stretch", help="Resize policy of the training transforms")
+    parser.add_argument("--cache-dir", type=Path, default=None, help="Read decoded images and masks from this cache, as training does by default")
+    parser.add_argument("--threads", type=int, default=1, help="Torch threads, 1 like a DataLoader worker")
+    parser.add_argument("--output", type=Path, default=None, help="Also write the JSON report to this path")
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    image_dict, annotation_index, class_names = load_dataset_annotations(args.dataset_directory)
+    image_keys = sorted(key for key in image_dict if key in annotation_index)
+    class_to_idx = {c: i for i, c in enumerate(class_names)}
+    mask_cache = None
+    if args.cache_dir:
+        mask_cache = MaskCache(args.cache_dir)
+        mask_cache.build([image_dict[key] for key in image_keys], [annotation_index.get_shapes(key) for key in image_keys])
+
+    report = benchmark_augmentation(lambda tfms: BaseballCardDataset(image_keys, annotation_index, image_dict, class_to_idx, tfms, mask_cache),
+                                    custom_collate_fn, args.batch_size, args.num_batches, resize_policy=args.resize_policy)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    for pipeline, result in report['pipelines'].items():
+        print(f"{pipeline}: {result['samples_per_sec']:.2f} samples/s, {result['ms_per_sample']:.0f} ms per sample")
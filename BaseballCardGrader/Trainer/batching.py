@@ -0,0 +1,129 @@
+from collections import defaultdict
+import math
+
+import numpy as np
+from PIL import Image
+import torchvision.transforms.v2 as transforms
+from torch.utils.data import BatchSampler
+
+# Training image size of the stretch policy, and the bounds of the keep-aspect policy
+TRAIN_IMAGE_SIZE = (1120, 800)
+
+# How training images are brought to the model input size
+RESIZE_POLICIES = ('stretch', 'keep-aspect')
+
+def get_resize_transform(policy, image_size=TRAIN_IMAGE_SIZE):
+    """
+    Builds the resize transform of a resize policy.
+
+    'stretch' forces every image to image_size whatever its orientation.
+    'keep-aspect' scales the image to fit within image_size, or within the
+    transposed size for landscape images, without distorting it. The detection
+    model pads every batch to its largest image, so batches of one
+    orientation carry no padding.
+
+    Args:
+        policy: One of RESIZE_POLICIES.
+        image_size: The (height, width) of portrait training images.
+    """
+    if policy == 'stretch':
+        return transforms.Resize(list(image_size), antialias=True)
+    if policy == 'keep-aspect':
+        # The short side goes to the short bound unless that pushes the long side past the long bound
+        return transforms.Resize(min(image_size), max_size=max(image_size), antialias=True)
+    raise ValueError(f"Unknown resize policy {policy}, expected one of {RESIZE_POLICIES}")
+
+def set_model_resize_bounds(model, policy, image_size=TRAIN_IMAGE_SIZE):
+    """
+    Gives the model's own transform the bounds of a resize policy.
+
+    Mask R-CNN resizes every image again so its short side is at least 800 and
+    its long side at most 1333. Keep-aspect images wider than 1.4:1 come out of
+    get_resize_transform with a short side under 800, which that transform
+    would upsample, so for keep-aspect the model takes the same bounds and
+    leaves the images as they are. Stretched images already fit its defaults.
+    """
+    if policy == 'keep-aspect':
+        model.transform.min_size = (min(image_size),)
+        model.transform.max_size = max(image_size)
+
+def get_resized_size(policy, original_size, image_size=TRAIN_IMAGE_SIZE):
+    """
+    Returns the (height, width) the resize transform of a policy gives an image of original_size (height, width).
+    """
+    if policy == 'stretch':
+        return tuple(image_size)
+    if policy == 'keep-aspect':
+        # The same truncation as torchvision's Resize with a short side and max_size
+        height, width = original_size
+        short, long = sorted((height, width))
+        new_short, new_long = min(image_size), int(min(image_size) * long / short)
+        if new_long > max(image_size):
+            new_short, new_long = int(max(image_size) * new_short / new_long), max(image_size)
+        return (new_short, new_long) if height <= width else (new_long, new_short)
+    raise ValueError(f"Unknown resize policy {policy}, expected one of {RESIZE_POLICIES}")
+
+def get_aspect_ratio_groups(image_keys, annotation_index, image_dict, bins=(1.0,)):
+    """
+    Assigns every image to an aspect ratio group.
+
+    Sizes come from the labelme annotations, falling back to the image header
+    when an annotation does not record one.
+
+    Args:
+        bins: The width / height ratios separating the groups. The default
+            separates portrait from landscape images.
+
+    Returns:
+        A list with the group of every image key.
+    """
+    aspect_ratios = []
+    for key in image_keys:
+        image_size = annotation_index.get_image_size(key)
+        if image_size is None:
+            with Image.open(image_dict[key]) as image:
+                width, height = image.size
+        else:
+            height, width = image_size
+        aspect_ratios.append(width / height)
+    return np.digitize(aspect_ratios, bins).tolist()
+
+class GroupedBatchSampler(BatchSampler):
+    """
+    Batches the indices of a sampler so each batch holds images of one group.
+
+    Indices are taken in the sampler's order and a batch is emitted as soon as
+    its group fills up. The leftover partial batches are topped up with other
+    images of their group, so every epoch has exactly ceil(len(sampler) /
+    batch_size) batches, and every rank of a distributed run takes the same
+    number of steps. Leftovers beyond that count are left out of the epoch.
+    """
+    def __init__(self, sampler, group_ids, batch_size):
+        self.sampler = sampler
+        self.group_ids = group_ids
+        self.batch_size = batch_size
+        self.drop_last = False
+
+    def __iter__(self):
+        buckets = defaultdict(list)
+        group_indices = defaultdict(list)
+        num_batches = 0
+        for index in self.sampler:
+            group = self.group_ids[index]
+            buckets[group].append(index)
+            group_indices[group].append(index)
+            if len(buckets[group]) == self.batch_size:
+                yield buckets.pop(group)
+                num_batches += 1
+
+        # The fullest leftovers first, so the fewest images are repeated
+        for group, batch in sorted(buckets.items(), key=lambda item: -len(item[1])):
+            if num_batches >= len(self):
+                break
+            indices = group_indices[group]
+            batch += [indices[i % len(indices)] for i in range(self.batch_size - len(batch))]
+            yield batch
+            num_batches += 1
+
+    def __len__(self):
+        return math.ceil(len(self.sampler) / self.batch_size)
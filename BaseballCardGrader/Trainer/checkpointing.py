@@ -0,0 +1,79 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+
+import numpy as np
+import torch
+
+class CheckpointWriter:
+    """
+    Saves checkpoints from a background thread.
+
+    `save` takes a CPU snapshot of the object on the calling thread, so training
+    can keep updating the model and optimizer in place while the file is written.
+    At most one write is in flight; a new save waits for the previous one, which
+    also bounds the memory held by snapshots to a single copy.
+    """
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def save(self, obj, path):
+        self.wait()
+        snapshot = snapshot_to_cpu(obj)
+        self._pending = self._executor.submit(save_atomic, snapshot, path)
+
+    def wait(self):
+        # Re-raises any error from the previous write
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+def snapshot_to_cpu(obj):
+    """
+    Copies every tensor in a nested structure of dicts, lists and tuples to the CPU.
+
+    Tensors are always copied, even when they already live on the CPU, so the
+    snapshot is not changed by later in-place updates.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [snapshot_to_cpu(v) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+def save_atomic(obj, path):
+    # Write next to the target and rename, so a preempted write never leaves a truncated checkpoint
+    temp_path = Path(path).with_suffix('.tmp')
+    torch.save(obj, temp_path)
+    os.replace(temp_path, path)
+
+def get_rng_state():
+    rng_state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_state['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+def set_rng_state(rng_state):
+    random.setstate(rng_state['python'])
+    np.random.set_state(rng_state['numpy'])
+    torch.set_rng_state(rng_state['torch'])
+    if 'cuda' in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+def load_training_state(path):
+    # The state holds Python and NumPy RNG states, which weights_only loading rejects; only load files you wrote
+    return torch.load(path, map_location='cpu', weights_only=False)
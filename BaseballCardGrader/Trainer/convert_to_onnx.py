@@ -1,94 +1,66 @@
 # Import Python Standard Library dependencies
-import sys
-
+import argparse
+import itertools
 import json
 from pathlib import Path
 
+# Import PIL for image decoding
+from PIL import Image
+
 # Import PyTorch dependencies
 import torch
+import torchvision.transforms.v2 as transforms
 
-# Import Mask R-CNN
-from torchvision.models.detection import maskrcnn_resnet50_fpn_v2
-from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
-from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
+# Import the model loading of the grader
+from grader import Grader, iter_images
 
-# Import ONNX dependencies
-import onnx # Import the onnx module
-from onnxsim import simplify # Import the method to simplify ONNX models
-import onnxruntime as ort # Import the ONNX Runtime
+# Import the ONNX export profiles
+from onnx_export import EXPORT_PROFILES, INPUT_SIZE, export_profile, build_report
 
 if __name__ == "__main__":
-        if len(sys.argv) != 2:
-                print("Needs path to model")
-                exit()
+        parser = argparse.ArgumentParser(description="Export the trained model to ONNX and compare the artifacts with PyTorch")
+        parser.add_argument("checkpoint_directory", type=Path, help="Path to the model checkpoint and colormap")
+        parser.add_argument("--profiles", nargs='+', choices=list(EXPORT_PROFILES), default=list(EXPORT_PROFILES),
+                            help="Artifacts to write: fp32 optimized, int8 dynamically quantized, fp32 with a static 1120x800 input, and fp32 with a dynamic batch axis")
+        parser.add_argument("--sample-images", type=Path, nargs='*', default=[], help="Images or directories to compare the artifacts on (default: random inputs)")
+        parser.add_argument("--max-samples", type=int, default=4, help="Maximum number of sample images")
+        parser.add_argument("--repeats", type=int, default=3, help="Timed runs per image")
+        parser.add_argument("--threads", type=int, default=None, help="ONNX Runtime intra-op threads (default: all cores)")
+        args = parser.parse_args()
 
         model_name = "BaseballCardGraderModel"
 
         # The path to the checkpoint folder
-        checkpoint_directory = Path(sys.argv[1]) 
-
-        # The colormap path
-        colormap_path = list(checkpoint_directory.glob('*colormap.json'))[0]
-
-        # Load the JSON colormap data
-        with open(colormap_path, 'r') as file:
-                colormap_json = json.load(file)
-
-        # Convert the JSON data to a dictionary        
-        colormap_dict = {item['label']: item['color'] for item in colormap_json['items']}
-
-        # Extract the class names from the colormap
-        class_names = list(colormap_dict.keys())
-
-        # Make a copy of the colormap in integer format
-        int_colors = [tuple(int(c*255) for c in color) for color in colormap_dict.values()]
-
-        # The model checkpoint path
-        checkpoint_path = list(checkpoint_directory.glob('*.pth'))[0]
-
-        # Load the model checkpoint onto the CPU
-        model_checkpoint = torch.load(checkpoint_path, map_location='cpu')
-
-        # Initialize a Mask R-CNN model
-        model = maskrcnn_resnet50_fpn_v2(weights='DEFAULT')
-
-        # Get the number of input features for the classifier
-        in_features_box = model.roi_heads.box_predictor.cls_score.in_features
-        in_features_mask = model.roi_heads.mask_predictor.conv5_mask.in_channels
-
-        # Replace the box predictor
-        model.roi_heads.box_predictor = FastRCNNPredictor(in_features_box, len(class_names))
-
-        # Replace the mask predictor
-        model.roi_heads.mask_predictor = MaskRCNNPredictor(in_channels=in_features_mask, dim_reduced=256, num_classes=len(class_names))
-
-        # Initialize the model with the checkpoint parameters and buffers
-        model.load_state_dict(model_checkpoint)
+        checkpoint_directory = args.checkpoint_directory
 
+        # Load the model checkpoint and class names onto the CPU
+        model = Grader(checkpoint_directory, device='cpu').model
         model.name = model_name
 
-        model.eval()
-
-        input_tensor = torch.randn(1, 3, 256, 256)
-
-        onnx_file_path = f"{checkpoint_directory}/{model.name}.onnx"
-
-        # Export the PyTorch model to ONNX format
-        torch.onnx.export(model.cpu(),
-                        input_tensor.cpu(),
-                        onnx_file_path,
-                        export_params=True,
-                        do_constant_folding=False,
-                        input_names = ['input'],
-                        output_names = ['boxes', 'labels', 'scores', 'masks'],
-                        dynamic_axes={'input': {2 : 'height', 3 : 'width'}}
-                        )
-
-        # Load the ONNX model from the onnx_file_name
-        onnx_model = onnx.load(onnx_file_path)
-
-        # Simplify the model
-        model_simp, check = simplify(onnx_model)
-
-        # Save the simplified model to the onnx_file_name
-        onnx.save(model_simp, onnx_file_path)
\ No newline at end of file
+        # Export every requested profile, the fp32 one keeps the name the app bundles
+        artifacts = {}
+        for profile in args.profiles:
+                onnx_file_path = checkpoint_directory/f"{model.name}{EXPORT_PROFILES[profile]}.onnx"
+                export_profile(model, profile, onnx_file_path)
+                artifacts[profile] = onnx_file_path
+                print(f"Exported {profile} to {onnx_file_path}")
+
+        # Prepare the sample images the same way the app does, or random inputs when there are none
+        to_input = transforms.Compose([transforms.ToImage(), transforms.ToDtype(torch.float32, scale=True), transforms.Resize(list(INPUT_SIZE), antialias=True)])
+        sample_paths = list(itertools.islice((image for path in args.sample_images for image in iter_images(path)), args.max_samples))
+        inputs = [to_input(Image.open(path).convert('RGB')) for path in sample_paths] or [torch.rand(3, *INPUT_SIZE)]
+
+        # Compare every artifact with the PyTorch model on CPU
+        report = build_report(model, artifacts, inputs, args.repeats, args.threads)
+        report['inputs'] = [str(path) for path in sample_paths] or 'random'
+        report_path = checkpoint_directory/f"{model.name}-export-report.json"
+        with open(report_path, 'w') as file:
+                json.dump(report, file, indent=2)
+
+        print(f"PyTorch: {report['pytorch']['latency_ms']:.0f} ms")
+        for profile, result in report['profiles'].items():
+                parity = result['parity']
+                mask_iou = f"{parity['mean_mask_iou']:.3f}" if parity['mean_mask_iou'] is not None else "n/a"
+                print(f"{profile}: {result['size_mb']:.1f} MB, session {result['session_ms']:.0f} ms, {result['latency_ms']:.0f} ms,"
+                      f" matched {parity['matched']}/{parity['reference_detections']} detections, mean mask IoU {mask_iou}")
+        print(f"Wrote the report to {report_path}")
@@ -0,0 +1,310 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from tqdm.auto import tqdm
+
+# Import PIL for image decoding and polygon rasterization
+from PIL import Image, ImageDraw
+
+class MaskCache:
+    """
+    On-disk cache of decoded images and rasterized segmentation masks.
+
+    Each entry is keyed by the image path, its modification time and a hash of
+    its annotation shapes, so editing either the image or its labelme polygons
+    produces a new entry. Images are stored as HxWx3 uint8 arrays and masks are
+    bit-packed along the flattened pixel axis. Both are saved as `.npy` files so
+    they can be memory-mapped on load.
+    """
+    def __init__(self, cache_directory):
+        self._cache_directory = Path(cache_directory)
+        self._cache_directory.mkdir(parents=True, exist_ok=True)
+
+    def get_key(self, image_path, shapes):
+        image_path = Path(image_path)
+        annotation_hash = get_annotation_hash(shapes)
+        key_source = f"{image_path.resolve()}|{image_path.stat().st_mtime_ns}|{annotation_hash}"
+        return hashlib.sha1(key_source.encode('utf-8')).hexdigest()
+
+    def contains(self, key):
+        return self._get_meta_path(key).exists()
+
+    def build(self, image_paths, shapes_list, prune=True):
+        """
+        Rasterizes and stores every entry that is not already cached.
+
+        Args:
+            image_paths: Paths to the source images.
+            shapes_list: The labelme shapes for each image, in the same order.
+            prune: Whether to delete the entries of images or annotations that are
+                not among these, such as those of edited polygons, so a cache
+                directory only ever holds one dataset.
+
+        Returns:
+            The number of entries that were written.
+        """
+        written = 0
+        keys = set()
+        for image_path, shapes in tqdm(list(zip(image_paths, shapes_list)), desc="Mask cache"):
+            key = self.get_key(image_path, shapes)
+            keys.add(key)
+            if self.contains(key):
+                continue
+            self._write_entry(key, image_path, shapes)
+            written += 1
+        if prune:
+            self.prune(keys)
+        return written
+
+    def prune(self, keys):
+        """
+        Deletes every entry whose key is not in keys.
+
+        Only files of MaskCache entries are touched, so a FeatureCache sharing
+        the directory keeps its entries.
+
+        Returns:
+            The number of entries that were deleted.
+        """
+        pruned = 0
+        # The image array is the one file only MaskCache entries have
+        for image_path in self._cache_directory.glob('*.image.npy'):
+            key = image_path.name.removesuffix('.image.npy')
+            if key in keys:
+                continue
+            # The metadata goes first, so a half-deleted entry is never treated as valid
+            for path in (self._get_meta_path(key), self._get_masks_path(key), image_path):
+                path.unlink(missing_ok=True)
+            pruned += 1
+        return pruned
+
+    def load(self, image_path, shapes):
+        """
+        Loads an image and its masks, rasterizing them first on a cache miss.
+
+        Returns:
+            A tuple of the HxWx3 uint8 image array and the NxHxW boolean mask array.
+        """
+        key = self.get_key(image_path, shapes)
+        if not self.contains(key):
+            self._write_entry(key, image_path, shapes)
+
+        with open(self._get_meta_path(key), 'r') as file:
+            meta = json.load(file)
+        height, width = meta['height'], meta['width']
+
+        image = np.load(self._get_image_path(key), mmap_mode='r')
+        packed_masks = np.load(self._get_masks_path(key), mmap_mode='r')
+        masks = np.unpackbits(packed_masks, axis=1, count=height * width)
+        masks = masks.reshape(meta['count'], height, width).view(np.bool_)
+        return image, masks
+
+    def _write_entry(self, key, image_path, shapes):
+        image = np.asarray(Image.open(image_path).convert('RGB'))
+        height, width = image.shape[:2]
+
+        masks = rasterize_shapes(shapes, (width, height))
+        packed_masks = np.packbits(masks.reshape(len(masks), -1), axis=1)
+
+        # Write the arrays before the metadata so a partially written entry is never treated as valid
+        save_array_atomic(self._get_image_path(key), image)
+        save_array_atomic(self._get_masks_path(key), packed_masks)
+        meta = {'image_path': str(image_path), 'height': height, 'width': width, 'count': len(masks)}
+        save_json_atomic(self._get_meta_path(key), meta)
+
+    def _get_image_path(self, key):
+        return self._cache_directory/f"{key}.image.npy"
+
+    def _get_masks_path(self, key):
+        return self._cache_directory/f"{key}.masks.npy"
+
+    def _get_meta_path(self, key):
+        return self._cache_directory/f"{key}.json"
+
+def get_annotation_hash(shapes):
+    shapes_json = json.dumps([{'label': shape['label'], 'points': shape['points']} for shape in shapes], sort_keys=True)
+    return hashlib.sha1(shapes_json.encode('utf-8')).hexdigest()
+
+def rasterize_shapes(shapes, image_size):
+    width, height = image_size
+    masks = np.zeros((len(shapes), height, width), dtype=np.bool_)
+    for i, shape in enumerate(shapes):
+        mask_image = Image.new('L', image_size, 0)
+        ImageDraw.Draw(mask_image, 'L').polygon([tuple(p) for p in shape['points']], fill=(255))
+        masks[i] = np.asarray(mask_image) > 0
+    return masks
+
+def save_array_atomic(path, array):
+    with open_temp_file(path, 'wb') as file:
+        np.save(file, array)
+    os.replace(file.name, path)
+
+def save_json_atomic(path, data):
+    with open_temp_file(path, 'w') as file:
+        json.dump(data, file)
+    os.replace(file.name, path)
+
+def open_temp_file(path, mode):
+    # A uniquely named file beside path, so DataLoader workers and ranks writing the same entry never share a temp file
+    path = Path(path)
+    return tempfile.NamedTemporaryFile(mode, dir=path.parent, prefix=f"{path.name}.", suffix='.tmp', delete=False)
+
+# Magic bytes and preamble layout of a training shard file
+SHARD_MAGIC = b'BCGSHRD1'
+SHARD_PREAMBLE_SIZE = 64
+SHARD_ALIGNMENT = 64
+
+def pack_shard(shard_path, keys, image_paths, shapes_list, class_names, image_size=(1120, 800)):
+    """
+    Writes a dataset into a single memory-mappable shard at the training resolution.
+
+    The shard starts with a fixed preamble (magic bytes, header offset and header
+    length), followed by 64-byte aligned sections and a JSON header at the end:
+        images: (count, height, width, 3) uint8
+        masks: (instances, ceil(height * width / 8)) uint8, bit-packed
+        boxes: (instances, 4) float32, xyxy in resized pixel coordinates
+        labels: (instances,) int64, indices into class_names
+        offsets: (count + 1,) int64, first instance of each image
+
+    Args:
+        shard_path: The path of the shard file to write.
+        keys: The image keys, in the order they are stored.
+        image_paths: Paths to the source images.
+        shapes_list: The labelme shapes for each image.
+        class_names: The class names, including 'background'.
+        image_size: The (height, width) the images and masks are resized to.
+
+    Returns:
+        None
+    """
+    # Imported here so reading a shard does not require torchvision
+    import torch
+    import torchvision
+    import torchvision.transforms.v2.functional as TF
+
+    height, width = image_size
+    class_to_idx = {c: i for i, c in enumerate(class_names)}
+    instance_counts = [len(shapes) for shapes in shapes_list]
+    offsets = np.concatenate([[0], np.cumsum(instance_counts)]).astype(np.int64)
+    instances = int(offsets[-1])
+    packed_width = (height * width + 7) // 8
+
+    # Lay out every section before writing so the file can be filled in place
+    sections = {}
+    position = SHARD_PREAMBLE_SIZE
+    for name, dtype, shape in [('images', 'uint8', (len(keys), height, width, 3)),
+                               ('masks', 'uint8', (instances, packed_width)),
+                               ('boxes', 'float32', (instances, 4)),
+                               ('labels', 'int64', (instances,)),
+                               ('offsets', 'int64', (len(keys) + 1,))]:
+        sections[name] = {'offset': position, 'dtype': dtype, 'shape': shape}
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        position += -(-size // SHARD_ALIGNMENT) * SHARD_ALIGNMENT
+
+    header = json.dumps({
+        'count': len(keys),
+        'height': height,
+        'width': width,
+        'keys': list(keys),
+        'class_names': list(class_names),
+        'sections': sections,
+    }).encode('utf-8')
+
+    temp_path = Path(shard_path).with_suffix('.tmp')
+    with open(temp_path, 'wb') as file:
+        file.truncate(position + len(header))
+        file.seek(position)
+        file.write(header)
+        file.seek(0)
+        file.write(SHARD_MAGIC + np.array([position, len(header)], dtype=np.int64).tobytes())
+
+    arrays = {name: np.memmap(temp_path, dtype=section['dtype'], mode='r+', offset=section['offset'], shape=section['shape'])
+              for name, section in sections.items()}
+    arrays['offsets'][:] = offsets
+
+    for i, (image_path, shapes) in enumerate(tqdm(list(zip(image_paths, shapes_list)), desc="Pack shard")):
+        image = Image.open(image_path).convert('RGB')
+        original_width, original_height = image.size
+        start, end = offsets[i], offsets[i + 1]
+
+        # Resize the image exactly as transforms.Resize([height, width], antialias=True) would
+        arrays['images'][i] = np.asarray(TF.resize(image, [height, width], antialias=True))
+        if end == start:
+            continue
+
+        # Rasterize at full resolution, then resize with nearest neighbour like the Mask transform
+        masks = torch.from_numpy(rasterize_shapes(shapes, image.size))
+        boxes = torchvision.ops.masks_to_boxes(masks)
+        masks = TF.resize(masks.to(torch.uint8), [height, width], interpolation=TF.InterpolationMode.NEAREST)
+        scale = torch.tensor([width / original_width, height / original_height] * 2)
+
+        arrays['masks'][start:end] = np.packbits(masks.numpy().reshape(end - start, -1).astype(np.bool_), axis=1)
+        arrays['boxes'][start:end] = (boxes * scale).numpy()
+        arrays['labels'][start:end] = [class_to_idx[shape['label']] for shape in shapes]
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    os.replace(temp_path, shard_path)
+
+class TrainingShard:
+    """
+    Read-only view of a shard written by `pack_shard`.
+
+    The file is memory-mapped lazily on first access, so each DataLoader worker
+    maps it on its own and the pages are shared through the OS page cache
+    instead of being pickled into every worker.
+    """
+    def __init__(self, shard_path):
+        self._shard_path = Path(shard_path)
+        with open(self._shard_path, 'rb') as file:
+            preamble = file.read(SHARD_PREAMBLE_SIZE)
+            if preamble[:len(SHARD_MAGIC)] != SHARD_MAGIC:
+                raise ValueError(f"{self._shard_path} is not a training shard")
+            header_offset, header_length = np.frombuffer(preamble[len(SHARD_MAGIC):len(SHARD_MAGIC) + 16], dtype=np.int64)
+            file.seek(int(header_offset))
+            self._header = json.loads(file.read(int(header_length)).decode('utf-8'))
+        self._key_to_index = {key: i for i, key in enumerate(self._header['keys'])}
+        self._arrays = None
+
+    @property
+    def keys(self):
+        return self._header['keys']
+
+    @property
+    def class_names(self):
+        return self._header['class_names']
+
+    def __contains__(self, key):
+        return key in self._key_to_index
+
+    def __getstate__(self):
+        # Never pickle the memory maps into DataLoader workers
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def get(self, key):
+        """
+        Returns views into the shard for one image.
+
+        Returns:
+            A tuple of the HxWx3 uint8 image, the NxHxW boolean masks, the Nx4
+            float32 boxes and the N int64 labels (indices into class_names).
+        """
+        if self._arrays is None:
+            # Copy-on-write maps are writable without copying the underlying pages
+            self._arrays = {name: np.memmap(self._shard_path, dtype=section['dtype'], mode='c', offset=section['offset'], shape=tuple(section['shape']))
+                            for name, section in self._header['sections'].items()}
+
+        index = self._key_to_index[key]
+        height, width = self._header['height'], self._header['width']
+        start, end = self._arrays['offsets'][index], self._arrays['offsets'][index + 1]
+
+        masks = np.unpackbits(self._arrays['masks'][start:end], axis=1, count=height * width)
+        masks = masks.reshape(end - start, height, width).view(np.bool_)
+        return self._arrays['images'][index], masks, self._arrays['boxes'][start:end], self._arrays['labels'][start:end]
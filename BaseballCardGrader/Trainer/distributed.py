@@ -0,0 +1,100 @@
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Sampler
+
+def init_distributed():
+    """
+    Joins the process group when the script was launched by torchrun.
+
+    Uses NCCL when CUDA is available and gloo otherwise, so several CPU
+    processes on one machine or across nodes can train together, e.g.
+    `torchrun --standalone --nproc-per-node 2 train_model.py <dataset> <checkpoints>`.
+    Every rank holds its own model and batch, so size --batch-size to the
+    memory of one process.
+
+    Returns:
+        Whether training is distributed.
+    """
+    if int(os.environ.get('WORLD_SIZE', '1')) <= 1:
+        return False
+    if torch.cuda.is_available():
+        torch.cuda.set_device(get_local_rank())
+        dist.init_process_group('nccl')
+    else:
+        dist.init_process_group('gloo')
+    return True
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def get_local_rank():
+    return int(os.environ.get('LOCAL_RANK', '0'))
+
+def get_local_world_size():
+    # The number of training processes sharing this machine's cores
+    return int(os.environ.get('LOCAL_WORLD_SIZE', '1'))
+
+def is_main_process():
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def all_reduce_mean(value, device='cpu'):
+    # Averages a Python number over all ranks
+    if not is_distributed():
+        return value
+    tensor = torch.tensor(float(value), dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item() / get_world_size()
+
+def broadcast_object(obj):
+    # Returns rank 0's object on every rank
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+def all_gather_objects(obj):
+    # Returns the objects of every rank, in rank order
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+def unwrap_model(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+class ShardSampler(Sampler):
+    """
+    Strided, unpadded shard of a dataset for evaluation.
+
+    Unlike DistributedSampler it never repeats samples to even out the shards,
+    so metrics merged across ranks count every image exactly once.
+    """
+    def __init__(self, dataset, rank=None, world_size=None):
+        self._length = len(dataset)
+        self._rank = get_rank() if rank is None else rank
+        self._world_size = get_world_size() if world_size is None else world_size
+
+    def __iter__(self):
+        return iter(range(self._rank, self._length, self._world_size))
+
+    def __len__(self):
+        return len(range(self._rank, self._length, self._world_size))
@@ -0,0 +1,245 @@
+from pathlib import Path
+import json
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+# Import the helpers for merging results across ranks
+from distributed import all_gather_objects
+
+# Import the checkpoint bundle loader
+from model_bundle import load_model
+
+# IoU thresholds of the COCO mAP@[.5:.95] metric
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+# Recall points precision is interpolated at, as in COCO
+RECALL_POINTS = np.linspace(0.0, 1.0, 101)
+
+class DetectionEvaluator:
+    """
+    Streaming COCO-style evaluation of instance segmentation predictions.
+
+    Each `update` matches one image's predictions to its ground truth at every
+    IoU threshold and keeps only the scores and match flags, so memory does not
+    grow with the image size. Mask IoUs are computed on bit-packed masks with a
+    vectorized popcount, and box IoUs with array broadcasting.
+    """
+    def __init__(self, class_names, score_threshold=0.5, iou_thresholds=IOU_THRESHOLDS):
+        self.class_names = class_names  # Class names, starting with 'background'
+        self.score_threshold = score_threshold  # Minimum score counted by precision and recall
+        self.iou_thresholds = np.asarray(iou_thresholds)
+        self._scores = {'segm': [], 'bbox': []}  # Prediction scores, per image
+        self._labels = {'segm': [], 'bbox': []}  # Prediction labels, per image
+        self._matches = {'segm': [], 'bbox': []}  # (thresholds, predictions) true positive flags, per image
+        self._gt_counts = np.zeros(len(class_names), dtype=np.int64)  # Ground truth instances per class
+
+    def update(self, prediction, target):
+        """
+        Adds one image.
+
+        Args:
+            prediction: A model output dictionary with 'boxes', 'labels', 'scores'
+                and soft 'masks' of shape (N, 1, H, W).
+            target: A target dictionary with 'boxes', 'labels' and boolean 'masks'.
+        """
+        scores = prediction['scores'].cpu().numpy()
+        order = np.argsort(-scores, kind='stable')
+        scores = scores[order]
+        labels = prediction['labels'].cpu().numpy()[order]
+        gt_labels = target['labels'].cpu().numpy()
+        np.add.at(self._gt_counts, gt_labels, 1)
+
+        pred_bits, pred_areas = pack_masks(prediction['masks'][:, 0] >= 0.5)
+        gt_bits, gt_areas = pack_masks(target['masks'].bool())
+        ious = {
+            'segm': packed_mask_iou(pred_bits[order], pred_areas[order], gt_bits, gt_areas),
+            'bbox': box_iou(prediction['boxes'].cpu().numpy()[order], target['boxes'].cpu().numpy()),
+        }
+        for iou_type, iou in ious.items():
+            self._scores[iou_type].append(scores)
+            self._labels[iou_type].append(labels)
+            self._matches[iou_type].append(match_predictions(iou, labels, gt_labels, self.iou_thresholds))
+
+    def merge(self, other):
+        """
+        Adds the images of another evaluator, such as one from another rank.
+        """
+        for iou_type in self._scores:
+            self._scores[iou_type].extend(other._scores[iou_type])
+            self._labels[iou_type].extend(other._labels[iou_type])
+            self._matches[iou_type].extend(other._matches[iou_type])
+        self._gt_counts += other._gt_counts
+
+    def compute(self):
+        """
+        Returns:
+            A dictionary with segm and bbox mAP@[.5:.95], mAP@.5 and mAP@.75, and the
+            per-class AP, precision and recall at IoU 0.5 and the score threshold.
+        """
+        metrics = {}
+        per_class = {}
+        for iou_type in ('segm', 'bbox'):
+            scores = np.concatenate(self._scores[iou_type]) if self._scores[iou_type] else np.zeros(0)
+            labels = np.concatenate(self._labels[iou_type]) if self._labels[iou_type] else np.zeros(0, dtype=np.int64)
+            matches = np.concatenate(self._matches[iou_type], axis=1) if self._matches[iou_type] else np.zeros((len(self.iou_thresholds), 0), dtype=bool)
+
+            # (classes, thresholds) average precision, NaN for classes without ground truth
+            average_precision = np.full((len(self.class_names), len(self.iou_thresholds)), np.nan)
+            for class_id in range(1, len(self.class_names)):
+                gt_count = self._gt_counts[class_id]
+                if gt_count == 0:
+                    continue
+                in_class = labels == class_id
+                class_scores = scores[in_class]
+                class_matches = matches[:, in_class]
+                average_precision[class_id] = compute_average_precision(class_scores, class_matches, gt_count)
+
+                above_threshold = class_scores >= self.score_threshold
+                true_positives = int(class_matches[0, above_threshold].sum())
+                class_metrics = per_class.setdefault(self.class_names[class_id], {'ground_truth': int(gt_count)})
+                class_metrics[f'{iou_type}_ap'] = float(np.mean(average_precision[class_id]))
+                class_metrics[f'{iou_type}_precision'] = true_positives / max(int(above_threshold.sum()), 1)
+                class_metrics[f'{iou_type}_recall'] = true_positives / int(gt_count)
+
+            valid = ~np.isnan(average_precision[:, 0])
+            metrics[f'{iou_type}_map'] = float(np.mean(average_precision[valid])) if valid.any() else 0.0
+            for iou_threshold in (0.5, 0.75):
+                column = int(np.argmin(np.abs(self.iou_thresholds - iou_threshold)))
+                metrics[f'{iou_type}_map{int(iou_threshold * 100)}'] = float(np.mean(average_precision[valid, column])) if valid.any() else 0.0
+        metrics['per_class'] = per_class
+        return metrics
+
+def pack_masks(masks):
+    """
+    Bit-packs (N, H, W) boolean masks into (N, words) uint64 rows.
+
+    Returns:
+        A tuple of the packed masks and the (N,) mask areas.
+    """
+    masks = masks.cpu().numpy() if isinstance(masks, torch.Tensor) else np.asarray(masks)
+    flat = masks.reshape(len(masks), int(np.prod(masks.shape[1:])))
+    packed = np.packbits(flat, axis=1)
+    # Pad every row to whole 64-bit words so the popcount runs on words instead of bytes
+    padding = -packed.shape[1] % 8
+    if padding:
+        packed = np.pad(packed, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(packed).view(np.uint64), flat.sum(axis=1, dtype=np.int64)
+
+def packed_mask_iou(pred_bits, pred_areas, gt_bits, gt_areas, max_chunk_bytes=64 * 1024 * 1024):
+    """
+    Computes the (predictions, ground truth) IoU matrix of bit-packed masks.
+
+    Intersections are popcounts of the AND of every pair of rows, taken in chunks
+    of predictions so the broadcast stays under max_chunk_bytes.
+    """
+    intersections = np.zeros((len(pred_bits), len(gt_bits)), dtype=np.int64)
+    if len(gt_bits):
+        chunk = max(1, max_chunk_bytes // max(1, gt_bits.nbytes))
+        for start in range(0, len(pred_bits), chunk):
+            pairs = pred_bits[start:start + chunk, None, :] & gt_bits[None, :, :]
+            intersections[start:start + chunk] = np.bitwise_count(pairs).sum(axis=2, dtype=np.int64)
+    unions = pred_areas[:, None] + gt_areas[None, :] - intersections
+    return intersections / np.maximum(unions, 1)
+
+def box_iou(pred_boxes, gt_boxes):
+    # Computes the (predictions, ground truth) IoU matrix of xyxy boxes
+    top_left = np.maximum(pred_boxes[:, None, :2], gt_boxes[None, :, :2])
+    bottom_right = np.minimum(pred_boxes[:, None, 2:], gt_boxes[None, :, 2:])
+    intersections = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    pred_areas = np.prod(pred_boxes[:, 2:] - pred_boxes[:, :2], axis=1)
+    gt_areas = np.prod(gt_boxes[:, 2:] - gt_boxes[:, :2], axis=1)
+    unions = pred_areas[:, None] + gt_areas[None, :] - intersections
+    return intersections / np.maximum(unions, 1e-9)
+
+def match_predictions(ious, pred_labels, gt_labels, iou_thresholds):
+    """
+    Greedily matches score-sorted predictions to ground truth of the same class, as COCO does.
+
+    Every IoU threshold is matched at once, so the only loop is over predictions.
+
+    Returns:
+        A (thresholds, predictions) boolean array of true positives.
+    """
+    matches = np.zeros((len(iou_thresholds), len(pred_labels)), dtype=bool)
+    gt_matched = np.zeros((len(iou_thresholds), len(gt_labels)), dtype=bool)
+    if len(gt_labels) == 0:
+        return matches
+    thresholds = np.arange(len(iou_thresholds))
+    # Pairs of different classes can never match
+    ious = np.where(pred_labels[:, None] == gt_labels[None, :], ious, -1.0)
+    for i in range(len(pred_labels)):
+        candidate_ious = np.where(gt_matched, -1.0, ious[i][None, :])
+        best = candidate_ious.argmax(axis=1)
+        matched = candidate_ious[thresholds, best] >= iou_thresholds
+        matches[:, i] = matched
+        gt_matched[thresholds[matched], best[matched]] = True
+    return matches
+
+def compute_average_precision(scores, matches, gt_count):
+    # Returns the 101-point interpolated AP at every IoU threshold for one class
+    if len(scores) == 0:
+        return np.zeros(len(matches))
+    order = np.argsort(-scores, kind='mergesort')
+    true_positives = np.cumsum(matches[:, order], axis=1)
+    false_positives = np.cumsum(~matches[:, order], axis=1)
+    recall = true_positives / gt_count
+    precision = true_positives / (true_positives + false_positives)
+    # Make precision monotonically decreasing, then sample it at the recall points
+    precision = np.flip(np.maximum.accumulate(np.flip(precision, axis=1), axis=1), axis=1)
+    average_precision = np.zeros(len(matches))
+    for t in range(len(matches)):
+        indices = np.searchsorted(recall[t], RECALL_POINTS, side='left')
+        sampled = np.where(indices < len(scores), precision[t, np.minimum(indices, len(scores) - 1)], 0.0)
+        average_precision[t] = sampled.mean()
+    return average_precision
+
+def evaluate(model, dataloader, device, class_names, score_threshold=0.5):
+    """
+    Runs the model in eval mode over a DataLoader and computes detection metrics.
+
+    When training is distributed, every rank evaluates its shard of the data and
+    the matches of all ranks are merged before the metrics are computed.
+
+    Args:
+        model: A Mask R-CNN model.
+        dataloader: A DataLoader yielding (images, targets) batches.
+        device: The device to run the model on.
+        class_names: The class names, starting with 'background'.
+        score_threshold: The minimum score counted by precision and recall.
+
+    Returns:
+        The metrics dictionary from DetectionEvaluator.compute.
+    """
+    was_training = model.training
+    model.eval()
+    evaluator = DetectionEvaluator(class_names, score_threshold)
+    with torch.inference_mode():
+        for inputs, targets in dataloader:
+            predictions = model([image.to(device) for image in inputs])
+            for prediction, target in zip(predictions, targets):
+                evaluator.update(prediction, target)
+    model.train(was_training)
+
+    rank_evaluators = all_gather_objects(evaluator)
+    evaluator = rank_evaluators[0]
+    for rank_evaluator in rank_evaluators[1:]:
+        evaluator.merge(rank_evaluator)
+    return evaluator.compute()
+
+def evaluate_checkpoint(weights_path, dataset, class_names, device='cpu', batch_size=4, num_workers=0, collate_fn=None):
+    """
+    Evaluates a saved checkpoint bundle in its own process, for running alongside training.
+
+    Returns:
+        The metrics dictionary from DetectionEvaluator.compute.
+    """
+    model, _ = load_model(weights_path, device)
+    dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn)
+    return evaluate(model, dataloader, device, class_names)
+
+def append_metrics(metrics_path, record):
+    # Appends one JSON line to the metrics file
+    with open(Path(metrics_path), 'a') as file:
+        file.write(json.dumps(record) + '\n')
@@ -0,0 +1,243 @@
+from pathlib import Path
+from collections import OrderedDict
+import hashlib
+import json
+import math
+
+import numpy as np
+from tqdm.auto import tqdm
+
+import torch
+from torch.nn import functional as F
+from torch.utils.data import Dataset
+import torchvision.transforms.v2.functional as TF
+from torchvision.models.detection.image_list import ImageList
+from torchvision.models.detection.transform import resize_boxes
+
+# Import the annotation hash and atomic array writes of the mask cache
+from dataset_cache import get_annotation_hash, save_array_atomic, save_json_atomic
+
+class FeatureCache:
+    """
+    On-disk cache of the FPN feature maps of non-augmented training samples,
+    for training the RPN and ROI heads without running the backbone.
+
+    Each entry is keyed by the image path, its modification time, a hash of its
+    annotation shapes, a hash of the backbone weights from get_backbone_hash
+    and the transform settings, so retraining the backbone or editing an image
+    or its polygons produces a new entry. Every FPN level is stored as float16
+    in one flat `.npy` file that is memory-mapped on load, the masks of the
+    sample's target are bit-packed like those of MaskCache, and the level
+    shapes, sizes, boxes and labels are kept in the entry's JSON file.
+    """
+    def __init__(self, cache_directory):
+        self._cache_directory = Path(cache_directory)
+        self._cache_directory.mkdir(parents=True, exist_ok=True)
+
+    def get_key(self, image_path, shapes, backbone_hash, settings=None):
+        image_path = Path(image_path)
+        key_source = json.dumps({
+            'image_path': str(image_path.resolve()),
+            'mtime_ns': image_path.stat().st_mtime_ns,
+            'annotation_hash': get_annotation_hash(shapes),
+            'backbone_hash': backbone_hash,
+            'settings': settings or {},
+        }, sort_keys=True)
+        return hashlib.sha1(key_source.encode('utf-8')).hexdigest()
+
+    def contains(self, key):
+        return self._get_meta_path(key).exists()
+
+    def build(self, model, dataset, keys, device='cpu'):
+        """
+        Computes and stores the feature maps of every sample that is not already cached.
+
+        Args:
+            model: The Mask R-CNN whose transform and backbone compute the features.
+            dataset: A dataset of non-augmented (image, target) pairs, in the order of keys.
+            keys: The cache key of every sample of the dataset, from get_key.
+            device: The device to run the backbone on.
+
+        Returns:
+            The number of entries that were written.
+        """
+        was_training = model.training
+        model.eval()
+        written = 0
+        for index, key in enumerate(tqdm(keys, desc="Feature cache")):
+            if self.contains(key):
+                continue
+            image, target = dataset[index]
+            if not image.is_floating_point():
+                image = TF.to_dtype(image, torch.float32, scale=True)
+            with torch.inference_mode():
+                images, _ = model.transform([image.to(device)])
+                features = model.backbone(images.tensors)
+            self._write_entry(key, images, features, tuple(image.shape[-2:]), target)
+            written += 1
+        model.train(was_training)
+        return written
+
+    def load(self, key):
+        """
+        Loads the feature maps and target of one sample.
+
+        Returns:
+            A tuple of the CachedFeatures, with float16 maps mapped from disk,
+            and the target dictionary at the size of the non-augmented image.
+        """
+        with open(self._get_meta_path(key), 'r') as file:
+            meta = json.load(file)
+
+        # Copy-on-write maps can be wrapped as tensors without copying the underlying pages
+        flat_features = np.load(self._get_features_path(key), mmap_mode='c')
+        features = OrderedDict()
+        offset = 0
+        for level in meta['levels']:
+            size = math.prod(level['shape'])
+            features[level['name']] = torch.from_numpy(flat_features[offset:offset + size].reshape(level['shape']))
+            offset += size
+
+        height, width = meta['original_size']
+        packed_masks = np.load(self._get_masks_path(key), mmap_mode='r')
+        masks = np.unpackbits(packed_masks, axis=1, count=height * width).reshape(meta['count'], height, width).view(np.bool_)
+        target = {
+            'boxes': torch.tensor(meta['boxes'], dtype=torch.float32).reshape(-1, 4),
+            'labels': torch.tensor(meta['labels'], dtype=torch.int64),
+            'masks': torch.from_numpy(masks),
+        }
+        return CachedFeatures(features, meta['image_size'], meta['padded_size'], meta['original_size']), target
+
+    def _write_entry(self, key, images, features, original_size, target):
+        flat_features = torch.cat([feature[0].flatten() for feature in features.values()]).to(torch.float16).cpu().numpy()
+        masks = target['masks'].cpu().numpy().astype(np.bool_)
+        packed_masks = np.packbits(masks.reshape(len(masks), -1), axis=1)
+
+        # Write the arrays before the metadata so a partially written entry is never treated as valid
+        save_array_atomic(self._get_features_path(key), flat_features)
+        save_array_atomic(self._get_masks_path(key), packed_masks)
+        meta = {
+            'levels': [{'name': name, 'shape': list(feature.shape[1:])} for name, feature in features.items()],
+            'image_size': list(images.image_sizes[0]),
+            'padded_size': list(images.tensors.shape[-2:]),
+            'original_size': list(original_size),
+            'count': len(masks),
+            'boxes': target['boxes'].tolist(),
+            'labels': target['labels'].tolist(),
+        }
+        save_json_atomic(self._get_meta_path(key), meta)
+
+    def _get_features_path(self, key):
+        return self._cache_directory/f"{key}.features.npy"
+
+    def _get_masks_path(self, key):
+        return self._cache_directory/f"{key}.masks.npy"
+
+    def _get_meta_path(self, key):
+        return self._cache_directory/f"{key}.json"
+
+def get_backbone_hash(model):
+    # Cached feature maps are only valid for the backbone and FPN weights that computed them
+    digest = hashlib.sha1()
+    for name, tensor in model.backbone.state_dict().items():
+        digest.update(name.encode('utf-8'))
+        digest.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+class CachedFeatures:
+    """
+    The FPN feature maps of one sample, standing in for its image in a batch.
+
+    Attributes:
+        features: The feature map of every FPN level, without a batch dimension.
+        image_size: The (height, width) of the image after the model's transform.
+        padded_size: The (height, width) the transform padded the image to.
+        original_size: The (height, width) of the non-augmented image, which
+            targets and detections are given at.
+    """
+    def __init__(self, features, image_size, padded_size, original_size):
+        self.features = features
+        self.image_size = tuple(image_size)
+        self.padded_size = tuple(padded_size)
+        self.original_size = tuple(original_size)
+
+    def to(self, device):
+        # Heads train in float32; the maps are only stored as float16
+        features = OrderedDict((name, feature.to(device, torch.float32)) for name, feature in self.features.items())
+        return CachedFeatures(features, self.image_size, self.padded_size, self.original_size)
+
+class CachedFeatureDataset(Dataset):
+    # Returns the (CachedFeatures, target) pair of every cached sample
+    def __init__(self, feature_cache, keys):
+        self._feature_cache = feature_cache
+        self._keys = keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, index):
+        return self._feature_cache.load(self._keys[index])
+
+class CachedFeatureHeads(torch.nn.Module):
+    """
+    Runs the RPN and ROI heads of a Mask R-CNN on cached feature maps in place of images.
+
+    Takes a list of CachedFeatures where the model takes image tensors, and
+    returns what the model would: the losses in training mode, and detections
+    at the size of the non-augmented images in eval mode. The backbone and FPN
+    are frozen and never run. Feature maps of different sizes are zero-padded
+    to the largest in the batch, where the model would pad the images instead.
+
+    Every other attribute, and the state dict, is that of the wrapped model,
+    so checkpoints and bundles hold the whole model.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        model.backbone.requires_grad_(False)
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            if name == 'model':
+                raise
+            return getattr(self.model, name)
+
+    def state_dict(self, *args, **kwargs):
+        return self.model.state_dict(*args, **kwargs)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        return self.model.load_state_dict(state_dict, *args, **kwargs)
+
+    def forward(self, inputs, targets=None):
+        features = OrderedDict()
+        for name in inputs[0].features:
+            feature_maps = [features_of_sample.features[name] for features_of_sample in inputs]
+            height = max(feature_map.shape[-2] for feature_map in feature_maps)
+            width = max(feature_map.shape[-1] for feature_map in feature_maps)
+            features[name] = torch.stack([F.pad(feature_map, (0, width - feature_map.shape[-1], 0, height - feature_map.shape[-2]))
+                                          for feature_map in feature_maps])
+
+        # The anchor generator only reads the shape, dtype and device of the padded image batch, so an expanded scalar stands in for it
+        padded_height = max(features_of_sample.padded_size[0] for features_of_sample in inputs)
+        padded_width = max(features_of_sample.padded_size[1] for features_of_sample in inputs)
+        reference = features[name]
+        image_batch = torch.zeros((), dtype=reference.dtype, device=reference.device).expand(len(inputs), 3, padded_height, padded_width)
+        images = ImageList(image_batch, [features_of_sample.image_size for features_of_sample in inputs])
+
+        if targets is not None:
+            targets = [self._resize_target(target, features_of_sample) for target, features_of_sample in zip(targets, inputs)]
+        proposals, proposal_losses = self.model.rpn(images, features, targets)
+        detections, detector_losses = self.model.roi_heads(features, proposals, images.image_sizes, targets)
+        if self.training:
+            return {**detector_losses, **proposal_losses}
+        return self.model.transform.postprocess(detections, images.image_sizes, [features_of_sample.original_size for features_of_sample in inputs])
+
+    def _resize_target(self, target, features_of_sample):
+        # Brings a target to the size the model's transform resized its image to, as the transform does
+        if features_of_sample.image_size == features_of_sample.original_size:
+            return target
+        masks = F.interpolate(target['masks'][:, None].float(), size=features_of_sample.image_size)[:, 0].byte()
+        boxes = resize_boxes(target['boxes'], features_of_sample.original_size, features_of_sample.image_size)
+        return {**target, 'boxes': boxes, 'masks': masks}
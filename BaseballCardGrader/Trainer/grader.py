@@ -0,0 +1,242 @@
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+
+# Import PIL for image decoding
+from PIL import Image
+
+# Import PyTorch dependencies
+import torch
+import torchvision.transforms.v2 as transforms
+
+# Import the checkpoint bundle loader
+from model_bundle import load_model, find_checkpoint, get_torch_device
+
+# Import the batched mask post-processing
+from postprocessing import detect, postprocess_detections, coverage_fractions
+
+# Import tiled full-resolution inference
+from tiling import detect_tiled
+
+# Import the resize policies of training
+from batching import TRAIN_IMAGE_SIZE, get_resize_transform, get_resized_size
+
+# Image file types picked up when grading a directory
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+class Grader:
+    """
+    Batched Mask R-CNN inference over many card images.
+
+    The model and colormap are loaded once. Images are decoded and resized in a
+    background thread pool while the previous batch runs through the model, and
+    results are yielded per image in input order.
+
+    Images are resized with the resize policy and image size the model was
+    trained with, from its bundle, unless they are given.
+
+    With a tile size, images keep their full resolution and each one is graded
+    in overlapping tiles of `batch_size` tiles per forward pass instead.
+    """
+    def __init__(self, checkpoint_directory, device=None, batch_size=4, threshold=0.5, image_size=None, num_decode_workers=4,
+                 tile_size=None, tile_overlap=0.2, mask_threshold=None, resize_policy=None):
+        self._checkpoint_directory = Path(checkpoint_directory)
+        self._device = torch.device(device or get_torch_device())
+        self._batch_size = batch_size
+        self._threshold = threshold
+        # The mask threshold follows the score threshold unless it is set on its own
+        self._mask_threshold = threshold if mask_threshold is None else mask_threshold
+        self._image_size = list(image_size) if image_size else None
+        self._resize_policy = resize_policy
+        self._num_decode_workers = num_decode_workers
+        self._tile_size = tile_size
+        self._tile_overlap = tile_overlap
+
+        # Loads the model with its class names and colors
+        self.model = self._load_model()
+        self._image_size = self._image_size or list(TRAIN_IMAGE_SIZE)
+        self._resize_policy = self._resize_policy or 'stretch'
+        self._resize = get_resize_transform(self._resize_policy, tuple(self._image_size))
+        self.int_colors = [tuple(int(c*255) for c in color) for color in self.colors]
+        self._to_input = transforms.Compose([transforms.ToImage(), transforms.ToDtype(torch.float32, scale=True)])
+
+    def _load_model(self):
+        # The bundle rebuilds the model without downloading weights it would replace
+        self.model_path = find_checkpoint(self._checkpoint_directory)
+        model, bundle = load_model(self.model_path, self._device)
+        self.class_names = bundle['class_names']
+        self.colors = bundle['colors']
+        # A model trained on tiles is graded in tiles of the same size unless told otherwise
+        preprocessing = bundle['preprocessing']
+        tile_size = preprocessing.get('tile_size')
+        if tile_size and not self._tile_size:
+            self._tile_size = tuple(tile_size)
+        self._read_resize(preprocessing)
+        return model
+
+    def _read_resize(self, preprocessing):
+        # Images are resized the way the model's training images were, unless the size or policy was given
+        self._image_size = self._image_size or preprocessing.get('image_size')
+        self._resize_policy = self._resize_policy or preprocessing.get('resize_policy')
+
+    def get_settings(self):
+        # Everything besides the model and the score threshold that changes the detections of an image
+        return {
+            'image_size': self._image_size,
+            'resize_policy': self._resize_policy,
+            'tile_size': list(self._tile_size) if self._tile_size else None,
+            'tile_overlap': self._tile_overlap if self._tile_size else None,
+            'mask_threshold': self._mask_threshold,
+        }
+
+    def get_input_size(self, original_size):
+        """
+        Returns the (height, width) an image of original_size (height, width) is
+        resized to before the model, or None when it is graded in tiles at full resolution.
+        """
+        if self._tile_size:
+            return None
+        return get_resized_size(self._resize_policy, tuple(original_size), tuple(self._image_size))
+
+    def grade(self, images):
+        """
+        Grades a directory, a single image or an iterable of images.
+
+        Args:
+            images: A directory path, an image path, or an iterable of image paths
+                or PIL images.
+
+        Yields:
+            A result dictionary per image, in input order.
+        """
+        batch = []
+        with ThreadPoolExecutor(max_workers=self._num_decode_workers) as executor:
+            for decoded in self._decode_ahead(executor, iter_images(images)):
+                batch.append(decoded)
+                if len(batch) == self._batch_size:
+                    yield from self.run_batch(batch)
+                    batch = []
+            if batch:
+                yield from self.run_batch(batch)
+
+    def grade_to_jsonl(self, images, output_path):
+        """
+        Grades images and streams one JSON line per image to a file.
+
+        Returns:
+            The number of graded images.
+        """
+        count = 0
+        with open(output_path, 'w') as file:
+            for result in self.grade(images):
+                file.write(json.dumps(result) + '\n')
+                file.flush()
+                count += 1
+        return count
+
+    def decode(self, image):
+        """
+        Decodes an image and resizes it to the model input, as grade does before batching.
+
+        Args:
+            image: An image path or a PIL image.
+
+        Returns:
+            A tuple of the image name, its original (width, height) and the input tensor,
+            which run_batch takes.
+        """
+        name = str(image) if not isinstance(image, Image.Image) else getattr(image, 'filename', '') or ''
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        image = image.convert('RGB')
+        if self._tile_size:
+            return name, image.size, self._to_input(image)
+        resized_image = self._resize(image)
+        return name, image.size, self._to_input(resized_image)
+
+    def run_batch(self, batch):
+        """
+        Grades a batch of decoded images in one forward pass, or tile by tile in tiled mode.
+
+        Args:
+            batch: A list of tuples from decode.
+
+        Yields:
+            A result dictionary per image, in batch order.
+        """
+        if self._tile_size:
+            yield from self._run_tiled(batch)
+            return
+        inputs = [input_tensor.to(self._device) for _, _, input_tensor in batch]
+        with torch.inference_mode():
+            model_outputs = detect(self.model, inputs)
+
+        for (name, original_size, input_tensor), model_output in zip(batch, model_outputs):
+            yield self._to_result(name, original_size, input_tensor.shape[-2:], model_output)
+
+    def _decode_ahead(self, executor, images):
+        # Keep a bounded number of decodes in flight so memory stays flat for any input size
+        pending = deque()
+        max_pending = self._batch_size * 2
+        for image in images:
+            pending.append(executor.submit(self.decode, image))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def _run_tiled(self, batch):
+        # Tiles of one image fill the forward passes, so images run one at a time
+        for name, original_size, input_tensor in batch:
+            with torch.inference_mode():
+                detections = detect_tiled(self.model, input_tensor.to(self._device), self._tile_size, self._tile_overlap,
+                                          self._batch_size, self._threshold, self._mask_threshold)
+            yield self._format_result(name, original_size, input_tensor.shape[-2:], detections)
+
+    def _to_result(self, name, original_size, input_size, model_output):
+        # Filters, pastes and encodes the masks of every detection above the score threshold at once
+        detections = postprocess_detections(model_output, tuple(input_size), self._threshold, self._mask_threshold)
+        return self._format_result(name, original_size, input_size, detections)
+
+    def _format_result(self, name, original_size, input_size, detections):
+        return {
+            'image': name,
+            'image_size': list(original_size),
+            'input_size': [int(input_size[1]), int(input_size[0])],
+            'boxes': detections['boxes'].cpu().round(decimals=3).tolist(),
+            'labels': [self.class_names[int(label)] for label in detections['labels']],
+            'scores': detections['scores'].cpu().tolist(),
+            'masks': detections['rles'],
+            # Fraction of the card covered by each defect class, with overlaps counted once
+            'coverage': coverage_fractions(detections['coverage_map'], self.class_names),
+        }
+
+def iter_images(images):
+    if isinstance(images, (str, Path)):
+        path = Path(images)
+        if path.is_dir():
+            yield from sorted(file for file in path.iterdir() if file.suffix.lower() in IMAGE_EXTENSIONS)
+        else:
+            yield path
+    else:
+        yield from images
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grade card images with a trained model")
+    parser.add_argument("checkpoint_directory", type=Path, help="Path to the model checkpoint and colormap")
+    parser.add_argument("images", type=Path, nargs='+', help="Image files or directories of images to grade")
+    parser.add_argument("--output", type=Path, default=Path("results.jsonl"), help="Path of the JSONL results file")
+    parser.add_argument("--batch-size", type=int, default=4, help="Images, or tiles when tiling, per forward pass")
+    parser.add_argument("--threshold", type=float, default=0.5, help="Score and mask threshold")
+    parser.add_argument("--tile-size", type=int, nargs=2, default=None, metavar=("HEIGHT", "WIDTH"),
+                        help="Grade full-resolution images in overlapping tiles of this size instead of resizing them")
+    parser.add_argument("--tile-overlap", type=float, default=0.2, help="Least overlap of neighbouring tiles, as a fraction of the tile size")
+    args = parser.parse_args()
+
+    grader = Grader(args.checkpoint_directory, batch_size=args.batch_size, threshold=args.threshold,
+                    tile_size=tuple(args.tile_size) if args.tile_size else None, tile_overlap=args.tile_overlap)
+    images = (image for path in args.images for image in iter_images(path))
+    count = grader.grade_to_jsonl(images, args.output)
+    print(f"Graded {count} images into {args.output}")
@@ -0,0 +1,164 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import base64
+import http.client
+import itertools
+import json
+import socket
+import statistics
+import threading
+import time
+
+import numpy as np
+
+# Import the image discovery of the grader
+from grader import iter_images
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    # An HTTP connection over a Unix socket, for servers started with --socket
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self._socket_path = str(socket_path)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socket_path)
+
+class GradingClient:
+    """
+    Client of grading_server.py, over TCP or a Unix socket.
+
+    Every thread keeps its own persistent connection. Methods return the HTTP
+    status and the decoded JSON body, so callers can tell rejections (503)
+    from results.
+    """
+    def __init__(self, host='127.0.0.1', port=8765, socket_path=None, timeout=120):
+        self._host = host
+        self._port = port
+        self._socket_path = socket_path
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def grade_image(self, image_bytes, name='', threshold=None):
+        headers = {'Content-Type': 'application/octet-stream', 'X-Image-Name': name}
+        if threshold is not None:
+            headers['X-Threshold'] = str(threshold)
+        return self._request('POST', '/grade', image_bytes, headers)
+
+    def grade_captures(self, captures, mode='normalMapLut', name='', threshold=None):
+        """
+        Grades a card from its four directional captures.
+
+        Args:
+            captures: A dictionary of directions to the encoded bytes of each capture.
+            threshold: The score threshold, or None for the server's.
+        """
+        body = json.dumps({'captures': {direction: base64.b64encode(data).decode() for direction, data in captures.items()}, 'mode': mode, 'threshold': threshold})
+        return self._request('POST', '/grade-captures', body.encode(), {'Content-Type': 'application/json', 'X-Image-Name': name})
+
+    def grade_capture_paths(self, paths, mode='normalMapLut', name='', threshold=None):
+        # The server reads the captures itself, which saves encoding them when it runs on the same machine; paths must lie under its --capture-root
+        body = json.dumps({'paths': {direction: str(path) for direction, path in paths.items()}, 'mode': mode, 'threshold': threshold})
+        return self._request('POST', '/grade-captures', body.encode(), {'Content-Type': 'application/json', 'X-Image-Name': name})
+
+    def metrics(self):
+        return self._request('GET', '/metrics')[1]
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            if self._socket_path:
+                self._local.connection = UnixHTTPConnection(self._socket_path, self._timeout)
+            else:
+                self._local.connection = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+        return self._local.connection
+
+    def _request(self, method, path, body=None, headers=None):
+        connection = self._connection()
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        except (ConnectionError, http.client.HTTPException):
+            # Reconnect on the next request, the server may have closed an idle connection
+            connection.close()
+            self._local.connection = None
+            raise
+
+def load_test(client, payloads, num_requests=32, concurrency=4):
+    """
+    Sends images to the server from `concurrency` threads, each waiting for its previous response.
+
+    Args:
+        client: A GradingClient.
+        payloads: A list of (name, encoded image bytes) pairs, cycled through.
+
+    Returns:
+        A dictionary with the throughput, the counts per HTTP status, and the
+        p50, p90 and p99 client-side latency of graded requests in milliseconds.
+    """
+    requests = itertools.cycle(payloads)
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+
+    def send(_):
+        with lock:
+            name, data = next(requests)
+        start = time.perf_counter()
+        try:
+            status, _ = client.grade_image(data, name)
+        except (ConnectionError, http.client.HTTPException, TimeoutError):
+            status = 'error'
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(num_requests)))
+    elapsed = time.perf_counter() - start
+
+    summary = {'requests': num_requests, 'concurrency': concurrency, 'seconds': elapsed,
+               'graded_per_second': statuses.get(200, 0) / elapsed, 'statuses': {str(status): count for status, count in statuses.items()}}
+    if latencies:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        summary['latency_ms'] = {'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'mean': statistics.mean(latencies)}
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grade images with a running grading server, or load test it")
+    parser.add_argument("images", type=Path, nargs='*', help="Image files or directories of images to send")
+    parser.add_argument("--captures", type=Path, default=None, help="Directory of a card's Left, Right, Up and Down captures to grade together")
+    parser.add_argument("--mode", default="normalMapLut", help="Normal map mode for --captures")
+    parser.add_argument("--threshold", type=float, default=None, help="Score threshold (default: the server's)")
+    parser.add_argument("--host", default='127.0.0.1', help="Server address")
+    parser.add_argument("--port", type=int, default=8765, help="Server port")
+    parser.add_argument("--socket", type=Path, default=None, help="Connect to this Unix socket instead of a port")
+    parser.add_argument("--load-test", type=int, default=None, metavar="REQUESTS", help="Send this many requests and report latency percentiles")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight during a load test")
+    args = parser.parse_args()
+
+    client = GradingClient(args.host, args.port, args.socket)
+    if args.captures:
+        # Captures are matched to directions by name, as preprocess_images.py does
+        paths = {}
+        for path in args.captures.iterdir():
+            for direction in ('Left', 'Right', 'Up', 'Down'):
+                if direction in path.name and path.suffix.lower() in ('.png', '.jpg', '.jpeg', '.heic'):
+                    paths[direction] = path
+        status, result = client.grade_captures({direction: path.read_bytes() for direction, path in paths.items()}, args.mode, args.captures.name, args.threshold)
+        print(status, json.dumps(result))
+    elif args.load_test:
+        payloads = [(str(path), path.read_bytes()) for image in args.images for path in iter_images(image)]
+        summary = load_test(client, payloads, args.load_test, args.concurrency)
+        summary['server'] = client.metrics()
+        print(json.dumps(summary, indent=2))
+    else:
+        for path in (path for image in args.images for path in iter_images(image)):
+            status, result = client.grade_image(path.read_bytes(), str(path), args.threshold)
+            print(status, json.dumps(result))
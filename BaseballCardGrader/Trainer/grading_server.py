@@ -0,0 +1,478 @@
+from pathlib import Path
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+import argparse
+import base64
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+# Import PIL for image decoding
+from PIL import Image
+
+# Import the PyTorch grader, the ONNX Runtime one is only imported for that backend
+from grader import Grader
+
+# Import the content-addressed cache of normal maps and raw detections
+from result_cache import ResultCache, RAW_SCORE_THRESHOLD, hash_bytes, hash_file, get_model_hash, threshold_detections
+
+# The normal map step of the capture rig lives in the old scripts directory
+sys.path.insert(0, str(Path(__file__).resolve().parent/'old'))
+
+# Directions of the four captures of a card, in the order the normal map step takes them
+CAPTURE_DIRECTIONS = ["Right", "Left", "Up", "Down"]
+
+class QueueFullError(Exception):
+    # Raised when the service already holds as many requests as it admits
+    pass
+
+class LatencyStats:
+    """
+    Latency percentiles of the most recent requests, per stage.
+
+    Every stage keeps a sliding window of its latest `window` samples, so the
+    percentiles follow the current load and memory stays flat.
+    """
+    def __init__(self, window=1024):
+        self._window = window
+        self._samples = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, **stage_ms):
+        with self._lock:
+            for stage, milliseconds in stage_ms.items():
+                self._samples.setdefault(stage, deque(maxlen=self._window)).append(milliseconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self):
+        """
+        Returns:
+            A dictionary with the counters and, per stage, the p50, p90, p99 and
+            mean latency in milliseconds and the number of samples they cover.
+        """
+        with self._lock:
+            samples = {stage: np.array(values) for stage, values in self._samples.items()}
+            counters = dict(self._counters)
+        latencies = {}
+        for stage, values in samples.items():
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            latencies[stage] = {'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'mean': float(values.mean()), 'samples': len(values)}
+        return {'counters': counters, 'latency_ms': latencies}
+
+class GradingService:
+    """
+    Grades requests on a pool of warm graders, micro-batching concurrent requests.
+
+    Every grader of the pool is warmed up with one dummy batch and then owned by
+    a worker thread. A worker takes the oldest queued request and waits up to
+    max_wait_ms from when that request was queued for more, up to
+    max_batch_size, before running them as one batch. Images are decoded by the
+    calling thread, so decoding overlaps inference.
+
+    At most max_pending requests are admitted at once, counting those being
+    decoded, queued and run. Further requests raise QueueFullError right away
+    instead of waiting, so callers can back off.
+
+    With a ResultCache, the graders must keep every detection, graded at
+    RAW_SCORE_THRESHOLD. Cards graded before are answered from the cache at
+    any score threshold, and normal maps are reused across models.
+    """
+    def __init__(self, graders, max_batch_size=4, max_wait_ms=20, max_pending=32, request_timeout=60, threshold=0.5, result_cache=None):
+        self._graders = graders
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._request_timeout = request_timeout
+        self._threshold = threshold
+        self._result_cache = result_cache
+        self._model_hash = get_model_hash(graders[0].model_path) if result_cache is not None else None
+        self._admission = threading.BoundedSemaphore(max_pending)
+        self._queue = queue.Queue()
+        self._workers = []
+        self.stats = LatencyStats()
+
+    def start(self):
+        dummy = Image.new('RGB', (800, 1120))
+        for i, grader in enumerate(self._graders):
+            list(grader.run_batch([grader.decode(dummy)]))
+            worker = threading.Thread(target=self._run_worker, args=(grader,), name=f"grading-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        # One sentinel per worker, queued behind the requests already waiting
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def grade_image(self, image, name='', threshold=None):
+        """
+        Grades one image.
+
+        Args:
+            image: A PIL image, or the encoded bytes of one.
+            name: The name reported in the result.
+            threshold: The score threshold, or None for the service's.
+
+        Returns:
+            The result dictionary of Grader, with whether it came from the
+            cache and the server-side 'timings' in milliseconds.
+        """
+        with self._admit():
+            start = time.perf_counter()
+            cache_key = None
+            if self._result_cache is not None and isinstance(image, bytes):
+                cache_key = self._result_cache.get_key([hash_bytes(image)], self._model_hash, self._graders[0].get_settings())
+                detections = self._result_cache.get_detections(cache_key)
+                if detections is not None:
+                    return self._cached_result(detections, name, threshold, start)
+            if not isinstance(image, Image.Image):
+                image = Image.open(io.BytesIO(image))
+            image.filename = name
+            decoded = self._graders[0].decode(image)
+            return self._grade_decoded(decoded, start, {'decode_ms': (time.perf_counter() - start) * 1000}, threshold, cache_key)
+
+    def grade_captures(self, captures, mode='normalMapLut', name='', threshold=None):
+        """
+        Builds the normal map of a card's four directional captures and grades it.
+
+        Args:
+            captures: A dictionary of the directions in CAPTURE_DIRECTIONS to image
+                paths or encoded image bytes.
+            mode: The normal map mode of preprocess_images.py.
+            name: The name reported in the result.
+            threshold: The score threshold, or None for the service's.
+        """
+        check_captures(captures)
+        with self._admit():
+            start = time.perf_counter()
+            # The normal map is built at the size the grader resizes it to, or at full resolution for tiled graders
+            settings = self._graders[0].get_settings()
+            resize_settings = None if settings['tile_size'] else {key: settings[key] for key in ('image_size', 'resize_policy')}
+            normal_map = cache_key = None
+            if self._result_cache is not None:
+                capture_hashes = [hash_file(capture) if isinstance(capture, (str, Path)) else hash_bytes(capture)
+                                  for capture in (captures[direction] for direction in CAPTURE_DIRECTIONS)]
+                normal_map_key = self._result_cache.get_key(capture_hashes, settings={'mode': mode, 'resize': resize_settings})
+                cache_key = self._result_cache.get_key([normal_map_key], self._model_hash, self._graders[0].get_settings())
+                detections = self._result_cache.get_detections(cache_key)
+                if detections is not None:
+                    return {**self._cached_result(detections, name, threshold, start), 'normal_map_key': normal_map_key}
+                normal_map = self._result_cache.get_normal_map(normal_map_key)
+            if normal_map is None:
+                normal_map = build_normal_map(captures, mode, self._graders[0].get_input_size)
+                if self._result_cache is not None:
+                    self._result_cache.put_normal_map(normal_map_key, normal_map)
+            normal_map.filename = name
+            decoded = self._graders[0].decode(normal_map)
+            result = self._grade_decoded(decoded, start, {'normal_map_ms': (time.perf_counter() - start) * 1000}, threshold, cache_key)
+            return {**result, 'normal_map_key': normal_map_key} if self._result_cache is not None else result
+
+    def get_normal_map_path(self, key):
+        # The cached normal map PNG of a grade_captures result, or None
+        return self._result_cache.get_normal_map_path(key) if self._result_cache is not None else None
+
+    def metrics(self):
+        summary = self.stats.summary()
+        counters = summary['counters']
+        summary.update(workers=len(self._workers), queued=self._queue.qsize(),
+                       mean_batch_size=counters.get('batched_requests', 0) / counters['batches'] if counters.get('batches') else None)
+        return summary
+
+    @contextmanager
+    def _admit(self):
+        if not self._admission.acquire(blocking=False):
+            self.stats.count('rejected')
+            raise QueueFullError("Too many pending requests")
+        try:
+            yield
+        finally:
+            self._admission.release()
+
+    def _grade_decoded(self, decoded, start, timings, threshold=None, cache_key=None):
+        future = Future()
+        queued_at = time.perf_counter()
+        self._queue.put((decoded, future, queued_at))
+        try:
+            result, queue_ms, inference_ms = future.result(timeout=self._request_timeout)
+        except FutureTimeoutError:
+            # A request still in the queue is cancelled so no worker grades it; one already taken into a batch finishes unread
+            future.cancel()
+            self.stats.count('timed_out')
+            raise
+        if cache_key:
+            self._result_cache.put_detections(cache_key, result)
+        if self._result_cache is not None or threshold is not None:
+            # Thresholds under the graders' own cannot bring back dropped detections, only a cache grades at the raw threshold
+            result = threshold_detections(result, self._threshold if threshold is None else threshold, self._graders[0].class_names)
+        total_ms = (time.perf_counter() - start) * 1000
+        timings.update(queue_ms=queue_ms, inference_ms=inference_ms, total_ms=total_ms)
+        self.stats.record(**{stage.removesuffix('_ms'): milliseconds for stage, milliseconds in timings.items()})
+        self.stats.count('graded')
+        return {**result, 'cached': False, 'timings': timings}
+
+    def _cached_result(self, detections, name, threshold, start):
+        result = threshold_detections({**detections, 'image': name}, self._threshold if threshold is None else threshold, self._graders[0].class_names)
+        total_ms = (time.perf_counter() - start) * 1000
+        self.stats.record(cached=total_ms)
+        self.stats.count('cache_hits')
+        return {**result, 'cached': True, 'timings': {'total_ms': total_ms}}
+
+    def _take_batch(self):
+        # Blocks for the oldest request, then gathers more until the batch fills or its latency budget runs out
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return None
+            # Marking the future running skips requests that timed out while queued, and keeps later ones from cancelling
+            if first[1].set_running_or_notify_cancel():
+                break
+            self.stats.count('skipped_cancelled')
+        batch = [first]
+        deadline = first[2] + self._max_wait
+        while len(batch) < self._max_batch_size:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if item is None:
+                # Leave the sentinel for after this batch
+                self._queue.put(None)
+                break
+            if not item[1].set_running_or_notify_cancel():
+                self.stats.count('skipped_cancelled')
+                continue
+            batch.append(item)
+        return batch
+
+    def _run_worker(self, grader):
+        while (batch := self._take_batch()) is not None:
+            start = time.perf_counter()
+            try:
+                results = list(grader.run_batch([decoded for decoded, _, _ in batch]))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            inference_ms = (time.perf_counter() - start) * 1000
+            self.stats.count('batches')
+            self.stats.count('batched_requests', len(batch))
+            for (_, future, queued_at), result in zip(batch, results):
+                future.set_result((result, (start - queued_at) * 1000, inference_ms))
+
+def read_grayscale(capture, target_size=None):
+    # Decodes a capture path or encoded bytes to a luma plane, area-resized to target_size (width, height)
+    import cv2
+    from preprocess_images import readImageAsGrayscale
+    if isinstance(capture, (str, Path)):
+        return readImageAsGrayscale(str(capture), target_size)
+    image = cv2.imdecode(np.frombuffer(capture, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        # OpenCV cannot decode HEIC, which the capture rig writes
+        import pillow_heif
+        heif_file = pillow_heif.open_heif(io.BytesIO(capture))
+        image = np.asarray(Image.frombuffer(heif_file.mode, heif_file.size, heif_file.data, "raw", heif_file.mode, heif_file.stride, 1).convert("L"))
+    if target_size is not None and (image.shape[1], image.shape[0]) != tuple(target_size):
+        image = cv2.resize(image, tuple(target_size), interpolation=cv2.INTER_AREA)
+    return image
+
+def check_captures(captures):
+    missing = [direction for direction in CAPTURE_DIRECTIONS if direction not in captures]
+    if missing:
+        raise ValueError(f"Missing captures: {missing}")
+
+def build_normal_map(captures, mode='normalMapLut', get_image_size=None):
+    """
+    Runs the normal map step of preprocess_images.py on a card's four captures.
+
+    Args:
+        captures: A dictionary of the directions in CAPTURE_DIRECTIONS to image
+            paths or encoded image bytes.
+        mode: 'normalMap', 'normalMapLut' or 'overlay'.
+        get_image_size: A function from the (height, width) of the captures to
+            the (height, width) they are area-resized to while decoding, such as
+            Grader.get_input_size, or None to keep the full resolution.
+
+    Returns:
+        The normal map as an RGB PIL image.
+    """
+    import cv2
+    from preprocess_images import OverlayBuffer
+    check_captures(captures)
+    first_image = read_grayscale(captures[CAPTURE_DIRECTIONS[0]])
+    image_size = get_image_size(first_image.shape) if get_image_size is not None else None
+    target_size = (image_size[1], image_size[0]) if image_size else None
+    if target_size is not None and (first_image.shape[1], first_image.shape[0]) != target_size:
+        first_image = cv2.resize(first_image, target_size, interpolation=cv2.INTER_AREA)
+    grayscale_images = [first_image] + [read_grayscale(captures[direction], target_size) for direction in CAPTURE_DIRECTIONS[1:]]
+    # The buffer holds BGR planes, as OpenCV writes them
+    return Image.fromarray(np.ascontiguousarray(OverlayBuffer().render(grayscale_images, mode)[:, :, ::-1]))
+
+class GradingRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of a GradingService.
+
+    GET /health and GET /metrics report on the service. POST /grade takes an
+    encoded image as the body. POST /grade-captures takes a JSON body with
+    'captures' mapping every direction to a base64 image, or 'paths' mapping
+    them to files under the server's capture root, and an optional 'mode' and
+    'threshold'. Without a capture root, 'paths' requests get 403.
+    POST /grade takes its score threshold from an X-Threshold header. With a
+    result cache, GET /normal-maps/<normal_map_key> returns the PNG normal map
+    of a captures result. Requests over the service's limit get 503 with a
+    Retry-After header.
+    """
+    service = None  # The GradingService, set on the subclass a server is made with
+    capture_root = None  # The only directory 'paths' may point into, or None to refuse them
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self._send_json(200, self.service.metrics())
+        elif self.path.startswith('/normal-maps/') and (normal_map_path := self.service.get_normal_map_path(self.path.removeprefix('/normal-maps/'))):
+            self._send_bytes(200, normal_map_path.read_bytes(), 'image/png')
+        else:
+            self._send_json(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        name = self.headers.get('X-Image-Name', '')
+        try:
+            if self.path == '/grade':
+                threshold = self.headers.get('X-Threshold')
+                result = self.service.grade_image(body, name, float(threshold) if threshold else None)
+            elif self.path == '/grade-captures':
+                request = json.loads(body)
+                if 'paths' in request:
+                    captures = self._resolve_capture_paths(request['paths'])
+                else:
+                    captures = {direction: base64.b64decode(data) for direction, data in request['captures'].items()}
+                result = self.service.grade_captures(captures, request.get('mode', 'normalMapLut'), name, request.get('threshold'))
+            else:
+                self._send_json(404, {'error': f"Unknown path {self.path}"})
+                return
+        except PermissionError as e:
+            self._send_json(403, {'error': str(e)})
+        except QueueFullError as e:
+            self._send_json(503, {'error': str(e)}, {'Retry-After': '1'})
+        except FutureTimeoutError:
+            self._send_json(504, {'error': "Grading timed out"})
+        except (ValueError, KeyError, OSError) as e:
+            self._send_json(400, {'error': str(e)})
+        else:
+            self._send_json(200, result)
+
+    def _resolve_capture_paths(self, paths):
+        # Clients name files on the server's own disk, so only files inside the capture root are opened, after symlinks are resolved
+        if self.capture_root is None:
+            raise PermissionError("Capture paths are disabled; start the server with --capture-root or send 'captures'")
+        if not isinstance(paths, dict):
+            raise ValueError("'paths' must map directions to file paths")
+        captures = {}
+        for direction, path in paths.items():
+            if not isinstance(path, str):
+                raise ValueError(f"Capture path for {direction} must be a string")
+            resolved_path = (self.capture_root/path).resolve()
+            if not resolved_path.is_relative_to(self.capture_root) or not resolved_path.is_file():
+                raise PermissionError(f"Capture path for {direction} is not a file under the capture root")
+            captures[direction] = resolved_path
+        return captures
+
+    def _send_json(self, status, payload, headers=None):
+        self._send_bytes(status, json.dumps(payload).encode(), 'application/json', headers)
+
+    def _send_bytes(self, status, data, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        # Per-request logs would dominate the output under load; /metrics covers them
+        pass
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, host='127.0.0.1', port=8765, socket_path=None, capture_root=None):
+    """
+    Creates an HTTP server for a service on a TCP port, or on a Unix socket when socket_path is given.
+
+    Requests may only grade captures by path from files under capture_root, and not at all without it.
+    """
+    capture_root = Path(capture_root).resolve() if capture_root else None
+    handler = type('BoundGradingRequestHandler', (GradingRequestHandler,), {'service': service, 'capture_root': capture_root})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return ThreadingUnixHTTPServer(str(socket_path), handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+def create_graders(checkpoint_directory, backend='torch', workers=1, device=None, threshold=0.5, onnx_path=None, num_threads=None, keep_all=False):
+    # Loads one grader per worker, each with its own model or session, keeping every detection for a result cache when keep_all is set
+    score_threshold = RAW_SCORE_THRESHOLD if keep_all else threshold
+    if backend == 'onnx':
+        from onnx_grader import OnnxGrader
+        return [OnnxGrader(checkpoint_directory, onnx_path, threshold=score_threshold, num_threads=num_threads, mask_threshold=threshold) for _ in range(workers)]
+    return [Grader(checkpoint_directory, device, threshold=score_threshold, mask_threshold=threshold) for _ in range(workers)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve card grading over local HTTP with warm models and micro-batching")
+    parser.add_argument("checkpoint_directory", type=Path, help="Path to the model checkpoint and colormap")
+    parser.add_argument("--backend", choices=['torch', 'onnx'], default='torch', help="Grade with the PyTorch checkpoint or the batched ONNX model")
+    parser.add_argument("--onnx-model", type=Path, default=None, help="Path of the batched ONNX model (default: <checkpoint>/BaseballCardGraderModel-batch.onnx)")
+    parser.add_argument("--workers", type=int, default=1, help="Warm graders, each running one batch at a time")
+    parser.add_argument("--max-batch-size", type=int, default=4, help="Most requests run as one batch")
+    parser.add_argument("--max-wait-ms", type=float, default=20, help="Longest a request waits for others to batch with")
+    parser.add_argument("--max-pending", type=int, default=32, help="Most requests admitted at once before new ones get 503")
+    parser.add_argument("--request-timeout", type=float, default=60, help="Seconds a request waits for its result before getting 504")
+    parser.add_argument("--threshold", type=float, default=0.5, help="Mask threshold, and the score threshold of requests that do not set one")
+    parser.add_argument("--device", default=None, help="PyTorch device (default: the fastest available)")
+    parser.add_argument("--threads", type=int, default=None, help="ONNX Runtime intra-op threads per session (default: all cores)")
+    parser.add_argument("--host", default='127.0.0.1', help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--socket", type=Path, default=None, help="Listen on this Unix socket instead of a port")
+    parser.add_argument("--capture-root", type=Path, default=None, help="Directory /grade-captures may read 'paths' from (default: refuse 'paths')")
+    parser.add_argument("--cache-dir", type=Path, default=None, help="Cache normal maps and raw detections in this directory")
+    parser.add_argument("--cache-size-mb", type=float, default=2048, help="Size the result cache is kept under, evicting least recently used files")
+    args = parser.parse_args()
+
+    result_cache = ResultCache(args.cache_dir, int(args.cache_size_mb * 2**20)) if args.cache_dir else None
+    graders = create_graders(args.checkpoint_directory, args.backend, args.workers, args.device, args.threshold, args.onnx_model, args.threads,
+                             keep_all=result_cache is not None)
+    service = GradingService(graders, args.max_batch_size, args.max_wait_ms, args.max_pending, args.request_timeout, args.threshold, result_cache)
+    service.start()
+    server = make_server(service, args.host, args.port, args.socket, args.capture_root)
+    print(f"Serving {args.backend} grading with {args.workers} warm workers on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        if args.socket and args.socket.exists():
+            os.remove(args.socket)
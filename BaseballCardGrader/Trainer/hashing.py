@@ -0,0 +1,10 @@
+import hashlib
+
+# Content hashes shared by the result cache and the preprocessing manifest; standard library only, so preprocess_images.py can import it without torch
+
+def hash_bytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+def hash_file(path):
+    with open(path, 'rb') as file:
+        return hashlib.file_digest(file, 'sha1').hexdigest()
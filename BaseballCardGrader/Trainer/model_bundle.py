@@ -0,0 +1,176 @@
+from pathlib import Path
+import json
+
+import torch
+
+# Import Mask R-CNN
+from torchvision.models.detection import maskrcnn_resnet50_fpn_v2
+from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
+from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
+
+# Version of the bundle layout, bumped when its keys change
+BUNDLE_VERSION = 1
+
+ARCHITECTURE = 'maskrcnn_resnet50_fpn_v2'
+DEFAULT_MODEL_NAME = 'BaseballCardGraderModel'
+
+def get_torch_device():
+    # Shared by training and inference, here so the graders need not import the training module
+    if torch.cuda.is_available():
+        return "cuda"
+    elif torch.backends.mps.is_available():
+        return "mps"
+    else:
+        return "cpu"
+
+def get_head_config(model):
+    """
+    Returns the architecture and head sizes needed to rebuild a model without its weights.
+    """
+    box_predictor = model.roi_heads.box_predictor
+    conv5_mask = model.roi_heads.mask_predictor.conv5_mask
+    return {
+        'architecture': ARCHITECTURE,
+        'num_classes': box_predictor.cls_score.out_features,
+        'box_in_features': box_predictor.cls_score.in_features,
+        'mask_in_channels': conv5_mask.in_channels,
+        'mask_dim_reduced': conv5_mask.out_channels,
+    }
+
+def get_head_config_from_state_dict(state_dict):
+    # Reads the head sizes off the predictor weights of a plain state dict
+    cls_score = state_dict['roi_heads.box_predictor.cls_score.weight']
+    conv5_mask = state_dict['roi_heads.mask_predictor.conv5_mask.weight']  # (in_channels, out_channels, k, k)
+    return {
+        'architecture': ARCHITECTURE,
+        'num_classes': cls_score.shape[0],
+        'box_in_features': cls_score.shape[1],
+        'mask_in_channels': conv5_mask.shape[0],
+        'mask_dim_reduced': conv5_mask.shape[1],
+    }
+
+def get_preprocessing(model, image_size=(1120, 800), resize_policy='stretch', tile_size=None):
+    # How images are prepared before the model, and the normalization the model applies itself
+    return {
+        'image_size': list(image_size),
+        'resize_policy': resize_policy,
+        # Set when the model was trained on full-resolution tiles and expects tiled inference
+        'tile_size': list(tile_size) if tile_size else None,
+        'image_mean': list(model.transform.image_mean),
+        'image_std': list(model.transform.image_std),
+        'min_size': list(model.transform.min_size),
+        'max_size': model.transform.max_size,
+    }
+
+def build_model(head_config):
+    """
+    Builds an untrained model from a head config, without downloading any weights.
+    """
+    if head_config['architecture'] != ARCHITECTURE:
+        raise ValueError(f"Unsupported architecture {head_config['architecture']}, expected {ARCHITECTURE}")
+    model = maskrcnn_resnet50_fpn_v2(weights=None, weights_backbone=None)
+    model.roi_heads.box_predictor = FastRCNNPredictor(in_channels=head_config['box_in_features'], num_classes=head_config['num_classes'])
+    model.roi_heads.mask_predictor = MaskRCNNPredictor(in_channels=head_config['mask_in_channels'],
+                                                       dim_reduced=head_config['mask_dim_reduced'],
+                                                       num_classes=head_config['num_classes'])
+    return model
+
+def make_bundle(model, class_names, colors, preprocessing, metadata=None):
+    """
+    Packs everything needed to run a trained model into one checkpoint dictionary.
+
+    Args:
+        model: The trained model.
+        class_names: The class names, starting with 'background'.
+        colors: The (r, g, b) color of every class, in the 0-1 range.
+        preprocessing: The dictionary from get_preprocessing.
+        metadata: The training metadata, such as the epoch and validation mAP.
+    """
+    return {
+        'version': BUNDLE_VERSION,
+        'state_dict': model.state_dict(),
+        'head': get_head_config(model),
+        'class_names': list(class_names),
+        'colors': [list(color) for color in colors],
+        'preprocessing': preprocessing,
+        'metadata': metadata or {},
+    }
+
+def load_bundle(path):
+    """
+    Loads a checkpoint bundle, memory-mapping its tensors.
+
+    Mapped tensors are only read from disk when they are first used. A plain
+    state dict from before bundles is wrapped into a bundle, with the head
+    sizes read off its weights and the classes from the colormap beside it.
+    """
+    path = Path(path)
+    checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    if 'version' in checkpoint:
+        return checkpoint
+
+    class_names, colors = load_colormap(path.parent, path.stem)
+    return {
+        'version': 0,
+        'state_dict': checkpoint,
+        'head': get_head_config_from_state_dict(checkpoint),
+        'class_names': class_names,
+        'colors': colors,
+        'preprocessing': {'image_size': [1120, 800], 'resize_policy': 'stretch'},
+        'metadata': {},
+    }
+
+def load_model(path, device='cpu'):
+    """
+    Builds the model of a checkpoint bundle in eval mode.
+
+    The model is created on the meta device, so no time is spent initializing
+    weights the checkpoint replaces, and then takes over the mapped tensors.
+
+    Returns:
+        A tuple of the model and the bundle.
+    """
+    bundle = load_bundle(path)
+    with torch.device('meta'):
+        model = build_model(bundle['head'])
+    model.load_state_dict(bundle['state_dict'], assign=True)
+    # The transform resizes images within the bounds the model was trained with
+    preprocessing = bundle['preprocessing']
+    if 'min_size' in preprocessing:
+        model.transform.min_size = tuple(preprocessing['min_size'])
+        model.transform.max_size = preprocessing['max_size']
+    model.eval()
+    return model.to(device), bundle
+
+def find_checkpoint(checkpoint_directory, model_name=DEFAULT_MODEL_NAME):
+    """
+    Returns the model checkpoint of a directory.
+
+    The checkpoint named after the model wins; otherwise the directory must hold exactly one .pth file.
+    """
+    checkpoint_directory = Path(checkpoint_directory)
+    checkpoint_path = checkpoint_directory/f"{model_name}.pth"
+    if checkpoint_path.exists():
+        return checkpoint_path
+    checkpoint_paths = sorted(checkpoint_directory.glob('*.pth'))
+    if len(checkpoint_paths) != 1:
+        raise FileNotFoundError(f"Expected {checkpoint_path} or a single .pth file in {checkpoint_directory}, found {len(checkpoint_paths)}")
+    return checkpoint_paths[0]
+
+def load_colormap(checkpoint_directory, model_name=DEFAULT_MODEL_NAME):
+    """
+    Reads the class names and colors of the colormap JSON the trainer writes for the app.
+
+    Returns:
+        A tuple of the class names and the (r, g, b) colors in the 0-1 range.
+    """
+    checkpoint_directory = Path(checkpoint_directory)
+    colormap_path = checkpoint_directory/f"{model_name}-colormap.json"
+    if not colormap_path.exists():
+        colormap_paths = sorted(checkpoint_directory.glob('*colormap.json'))
+        if len(colormap_paths) != 1:
+            raise FileNotFoundError(f"Expected {colormap_path} or a single colormap in {checkpoint_directory}, found {len(colormap_paths)}")
+        colormap_path = colormap_paths[0]
+    with open(colormap_path, 'r') as file:
+        colormap_json = json.load(file)
+    return [item['label'] for item in colormap_json['items']], [item['color'] for item in colormap_json['items']]
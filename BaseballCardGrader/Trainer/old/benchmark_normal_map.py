@@ -0,0 +1,50 @@
+import argparse
+import time
+import numpy as np
+
+from preprocess_images import OverlayBuffer, generateOverlayedImage
+from check_overlay_buffer import checkOverlayBuffer, assertSameRender
+
+def makeSyntheticCard(height, width, rng):
+    # Four directional captures with different exposure ranges so every min/max differs
+    return [rng.integers(low, high, (height, width), dtype=np.uint8) for low, high in [(0, 256), (12, 230), (30, 200), (5, 250)]]
+
+def timeCards(render, cards, repeats):
+    render(cards[0])  # Warm up allocations and OpenCV dispatch
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for card in cards:
+            render(card)
+    return (time.perf_counter() - start) / (repeats * len(cards)) * 1000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare normalMap implementations on synthetic captures")
+    parser.add_argument("--height", type=int, default=3024, help="Frame height (default: 12MP phone capture)")
+    parser.add_argument("--width", type=int, default=4032, help="Frame width (default: 12MP phone capture)")
+    parser.add_argument("--cards", type=int, default=4, help="Distinct synthetic cards")
+    parser.add_argument("--repeats", type=int, default=3, help="Passes over the synthetic cards")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    cards = [makeSyntheticCard(args.height, args.width, rng) for _ in range(args.cards)]
+    overlayBuffer = OverlayBuffer()
+
+    # Timings of a buffer that renders different bytes mean nothing, so a mismatch stops the run with an AssertionError
+    checkOverlayBuffer()
+    for mode in ("overlay", "normalMap"):
+        assertSameRender(cards[0], mode, overlayBuffer=overlayBuffer, description="synthetic card")
+    print("OverlayBuffer matches generateOverlayedImage byte for byte")
+
+    reference = generateOverlayedImage(cards[0], "normalMap")
+    lutOutput = overlayBuffer.render(cards[0], "normalMapLut")
+    maxDifference = np.abs(reference.astype(np.int16) - lutOutput.astype(np.int16)).max()
+    print(f"normalMapLut max difference from normalMap: {maxDifference}")
+
+    results = {
+        "normalMap (generateOverlayedImage)": timeCards(lambda card: generateOverlayedImage(card, "normalMap"), cards, args.repeats),
+        "normalMap (OverlayBuffer)": timeCards(lambda card: overlayBuffer.render(card, "normalMap"), cards, args.repeats),
+        "normalMapLut (OverlayBuffer)": timeCards(lambda card: overlayBuffer.render(card, "normalMapLut"), cards, args.repeats),
+    }
+    baseline = results["normalMap (generateOverlayedImage)"]
+    for name, milliseconds in results.items():
+        print(f"{name:<36} {milliseconds:8.1f} ms/card  {baseline / milliseconds:5.2f}x")
@@ -0,0 +1,42 @@
+import numpy as np
+
+from preprocess_images import OverlayBuffer, generateOverlayedImage
+
+'''
+Regression check that OverlayBuffer renders the same bytes as generateOverlayedImage.
+Runs random four-view cards of several sizes through both paths, reusing one buffer the way batch workers do,
+and raises AssertionError on the first card whose output differs, so running it exits with a non-zero status.
+benchmark_normal_map.py runs it before every benchmark.
+'''
+
+def makeRandomCard(height, width, rng):
+    # Random exposure ranges per view, and sometimes a constant view, which cv2.normalize maps to the low bound
+    card = []
+    for _ in range(4):
+        if rng.random() < 0.1:
+            card.append(np.full((height, width), rng.integers(0, 256), dtype=np.uint8))
+        else:
+            low = int(rng.integers(0, 128))
+            high = int(rng.integers(low + 1, 257))
+            card.append(rng.integers(low, high, (height, width), dtype=np.uint8))
+    return card
+
+def assertSameRender(card, mode, blueValue=0, overlayBuffer=None, description="card"):
+    expected = generateOverlayedImage(card, mode, blueValue)
+    actual = (overlayBuffer or OverlayBuffer()).render(card, mode, blueValue)
+    # strict also fails on a different dtype or shape, and unlike assert statements it still runs under python -O
+    np.testing.assert_array_equal(actual, expected, err_msg=f"{description} differs in {mode} mode", strict=True)
+
+def checkOverlayBuffer(cards=50, seed=0):
+    rng = np.random.default_rng(seed)
+    overlayBuffer = OverlayBuffer()
+    for index in range(cards):
+        height, width = int(rng.integers(1, 97)), int(rng.integers(1, 97))
+        card = makeRandomCard(height, width, rng)
+        blueValue = int(rng.integers(0, 256)) if index % 2 else 0
+        for mode in ("overlay", "normalMap", "unknown"):
+            assertSameRender(card, mode, blueValue, overlayBuffer, f"card {index} ({height}x{width}, blue {blueValue})")
+
+if __name__ == "__main__":
+    checkOverlayBuffer()
+    print("OverlayBuffer matches generateOverlayedImage byte for byte")
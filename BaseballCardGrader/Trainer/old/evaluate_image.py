@@ -1,5 +1,4 @@
 from pathlib import Path
-import json
 from PIL import Image
 from functools import partial
 import pandas as pd
@@ -7,12 +6,16 @@ import sys
 
 import torch
 import torchvision.transforms.v2 as transforms
-import torch.nn.functional as F
-from torchvision.tv_tensors import BoundingBoxes, Mask
+from torchvision.tv_tensors import BoundingBoxes
 from torchvision.utils import draw_bounding_boxes, draw_segmentation_masks
-from torchvision.models.detection import maskrcnn_resnet50_fpn_v2
-from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
-from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
+
+# The checkpoint bundle loader lives in the Trainer directory above this one
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from model_bundle import load_model, load_bundle, find_checkpoint
+from postprocessing import detect, postprocess_detections, rles_to_masks
+from result_cache import ResultCache, RAW_SCORE_THRESHOLD, grade_cached
+from grader import Grader
+from batching import get_resize_transform
 
 def get_torch_device():
     if torch.cuda.is_available():
@@ -42,16 +45,25 @@ def move_data_to_device(data, device:torch.device):
         return data
 
 if __name__=="__main__":
-    if len(sys.argv) != 3:
-        print("Needs path to model and image")
+    args = sys.argv[1:]
+    '''
+    Optional result cache, so re-evaluating an image at another threshold does not run the model
+    '''
+    cache_directory = None
+    if "-cache" in args:
+        index = args.index("-cache")
+        cache_directory = Path(args[index + 1])
+        del args[index:index + 2]
+    if len(args) not in (2, 3):
+        print("Needs path to model and image, and optionally a score threshold and -cache <cacheDir>")
         exit()
     '''
     Path for checkpoint, colormap, and other files
     '''
-    checkpoint_directory = Path(sys.argv[1]) 
-    checkpoint_path = list(checkpoint_directory.glob('*.pth'))[0]
-    colormap_path = list(checkpoint_directory.glob('*colormap.json'))[0]
-    test_image_path = Path(sys.argv[2])
+    checkpoint_directory = Path(args[0]) 
+    checkpoint_path = find_checkpoint(checkpoint_directory)
+    test_image_path = Path(args[1])
+    threshold = float(args[2]) if len(args) == 3 else 0.5
     font_file = 'font.ttf'
 
     '''
@@ -61,49 +73,48 @@ if __name__=="__main__":
     dtype = torch.float32
 
     '''
-    Gets colormap, classnames, and colors from json file
+    Reads the classnames and colors of the checkpoint
     '''
-    with open(colormap_path, 'r') as file:
-        colormap_json = json.load(file)
-    colormap_dict = {item['label']: item['color'] for item in colormap_json['items']}
-    class_names = list(colormap_dict.keys())
-    int_colors = [tuple(int(c*255) for c in color) for color in colormap_dict.values()]
+    bundle = load_bundle(checkpoint_path)
+    class_names = bundle['class_names']
+    int_colors = [tuple(int(c*255) for c in color) for color in bundle['colors']]
 
-    '''
-    Sets up model from checkpoint
-    '''
-    model_checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=True)
-    model = maskrcnn_resnet50_fpn_v2(weights='DEFAULT')
-    in_features_box = model.roi_heads.box_predictor.cls_score.in_features
-    in_features_mask = model.roi_heads.mask_predictor.conv5_mask.in_channels
-    model.roi_heads.box_predictor = FastRCNNPredictor(in_features_box, len(class_names))
-    model.roi_heads.mask_predictor = MaskRCNNPredictor(in_channels=in_features_mask, dim_reduced=256, num_classes=len(class_names))
-    model.load_state_dict(model_checkpoint)
+    test_image = Image.open(test_image_path).convert("RGB")
+    preprocessing = bundle['preprocessing']
+    resized_image = get_resize_transform(preprocessing.get('resize_policy', 'stretch'), preprocessing['image_size'])(test_image)
 
-    '''
-    Evaluates image with model
-    '''
-    model.eval()
-    model.to(device)
+    if cache_directory:
+        '''
+        Answers from the cached raw detections of this image and model, grading and caching them on a miss
+        '''
+        grader = Grader(checkpoint_directory, device, batch_size=1, threshold=RAW_SCORE_THRESHOLD, mask_threshold=0.5)
+        result, cache_hit = grade_cached(grader, ResultCache(cache_directory), test_image_path, threshold)
+        print(f"{'Cached' if cache_hit else 'Graded'} detections of {test_image_path}")
+        model_output = {
+            'boxes': torch.tensor(result['boxes']).reshape(-1, 4),
+            'labels': torch.tensor([class_names.index(label) for label in result['labels']], dtype=torch.int64),
+            'scores': torch.tensor(result['scores']),
+            'masks': rles_to_masks(result['masks']).reshape(-1, *resized_image.size[::-1]),
+        }
+    else:
+        '''
+        Sets up model from checkpoint and evaluates image with it
+        '''
+        model, _ = load_model(checkpoint_path, device)
+        input_tensor = transforms.Compose([transforms.ToImage(), transforms.ToDtype(torch.float32, scale=True)])(resized_image)[None].to(device)
 
-    test_image = Image.open(test_image_path).convert("RGB")
-    resized_image = transforms.Resize([1120, 800], antialias=True)(test_image)
-    input_tensor = transforms.Compose([transforms.ToImage(), transforms.ToDtype(torch.float32, scale=True)])(resized_image)[None].to(device)
+        with torch.no_grad():
+            model_output = detect(model, input_tensor)
 
-    with torch.no_grad():
-        model_output = model(input_tensor)
+        '''
+        Filters out information from evaluation
+        '''
+        model_output = postprocess_detections(move_data_to_device(model_output[0], 'cpu'), resized_image.size[::-1], threshold, 0.5)
 
-    '''
-    Filters out information from evaluation
-    '''
-    threshold = 0.5
-    model_output = move_data_to_device(model_output, 'cpu')
-    scores_mask = model_output[0]['scores'] > threshold
-    pred_bboxes = BoundingBoxes(model_output[0]['boxes'][scores_mask], format='xyxy', canvas_size=resized_image.size[::-1])
-    pred_labels = [class_names[int(label)] for label in model_output[0]['labels'][scores_mask]]
-    pred_scores = model_output[0]['scores']
-    pred_masks = F.interpolate(model_output[0]['masks'][scores_mask], size=resized_image.size[::-1])
-    pred_masks = torch.concat([Mask(torch.where(mask >= threshold, 1, 0), dtype=torch.bool) for mask in pred_masks])
+    pred_bboxes = BoundingBoxes(model_output['boxes'], format='xyxy', canvas_size=resized_image.size[::-1])
+    pred_labels = [class_names[int(label)] for label in model_output['labels']]
+    pred_scores = model_output['scores']
+    pred_masks = model_output['masks']
 
     '''
     Displays evaluation
@@ -5,21 +5,51 @@ import cv2
 from PIL import Image
 import pillow_heif
 import re
-from collections import defaultdict
+import json
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# The manifest hashes files with the trainer's shared helper, which needs only the standard library
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from hashing import hash_file
 
 requiredKeywords = ["Left", "Right", "Up", "Down"]
 
-def readImageAsGrayscale(path):
+def readImageAsGrayscale(path, targetSize=None):
+    # targetSize is an optional (width, height) the luma plane is area-resized to right after decode
     ext = os.path.splitext(path)[1].lower()
     if ext == ".heic":
-        heif_file = pillow_heif.read_heif(path)
-        image = Image.frombytes(
-            heif_file.mode, heif_file.size, heif_file.data,
-            "raw"
-        ).convert("L")
-        return np.array(image)
+        heif_file = pillow_heif.open_heif(path)
+        # Wrap the decoder's RGB buffer without copying it, so only the luma plane is allocated
+        rgbImage = Image.frombuffer(heif_file.mode, heif_file.size, heif_file.data, "raw", heif_file.mode, heif_file.stride, 1)
+        image = np.asarray(rgbImage.convert("L"))
+        del rgbImage, heif_file
     else:
-        return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise ValueError(f"Could not read image {path}")
+
+    if targetSize is not None and (image.shape[1], image.shape[0]) != tuple(targetSize):
+        image = cv2.resize(image, tuple(targetSize), interpolation=cv2.INTER_AREA)
+    return image
+
+# Decodes the four views of a card concurrently; the decoders release the GIL
+viewDecodePool = None
+
+def getViewDecodePool():
+    global viewDecodePool
+    if viewDecodePool is None:
+        viewDecodePool = ThreadPoolExecutor(max_workers=len(requiredKeywords))
+    return viewDecodePool
+
+def resetViewDecodePool():
+    # Threads do not survive a fork, so forked batch workers start their own pool
+    global viewDecodePool
+    viewDecodePool = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=resetViewDecodePool)
 
 def findPictureFiles(directoryPath):
     foundFiles = {}
@@ -30,7 +60,7 @@ def findPictureFiles(directoryPath):
     for filename in os.listdir(directoryPath):
         lowered = filename.lower()
         for key in requiredKeywords:
-            if key in lowered and filename.lower().endswith(('.png', '.jpg', '.jpeg', '.heic')):
+            if key.lower() in lowered and lowered.endswith(('.png', '.jpg', '.jpeg', '.heic')):
                 foundFiles[key] = os.path.join(directoryPath, filename)
 
     if set(foundFiles.keys()) != set(requiredKeywords):
@@ -40,13 +70,9 @@ def findPictureFiles(directoryPath):
     nameOfPicture = os.path.basename(os.path.normpath(directoryPath))
     return {nameOfPicture: foundFiles}
 
-def getGreyscaledImageList(fileMappings):
-    return [
-        readImageAsGrayscale(fileMappings["Right"]),
-        readImageAsGrayscale(fileMappings["Left"]),
-        readImageAsGrayscale(fileMappings["Up"]),
-        readImageAsGrayscale(fileMappings["Down"]),
-    ]
+def getGreyscaledImageList(fileMappings, targetSize=None):
+    directions = ["Right", "Left", "Up", "Down"]
+    return list(getViewDecodePool().map(lambda direction: readImageAsGrayscale(fileMappings[direction], targetSize), directions))
 
 def overlayImages(image1, image2):
     return cv2.addWeighted(image1, 0.5, image2, 0.5, 0)
@@ -72,7 +98,7 @@ def groupFlatHeicFiles(batchDir):
 
     return validGroups
 
-def generateOverlayedImage(greyScaledImages, mode, blueValue=0):
+def buildDirectionalImages(greyScaledImages, mode, blueValue=0):
     height, width = greyScaledImages[0].shape
     aboveLeftPicture = np.zeros((height, width, 3), dtype=np.uint8)
     bottomRightPicture = np.zeros((height, width, 3), dtype=np.uint8)
@@ -91,49 +117,390 @@ def generateOverlayedImage(greyScaledImages, mode, blueValue=0):
         bottomRightPicture[:, :, 1] = cv2.normalize(greyScaledImages[3], None, 128, 255, cv2.NORM_MINMAX)  # down
         bottomRightPicture[:, :, 2] = cv2.normalize(greyScaledImages[0], None, 128, 255, cv2.NORM_MINMAX)  # right
 
-    return overlayImages(aboveLeftPicture, bottomRightPicture)
+    return aboveLeftPicture, bottomRightPicture
+
+def generateOverlayedImage(greyScaledImages, mode, blueValue=0):
+    return overlayImages(*buildDirectionalImages(greyScaledImages, mode, blueValue))
+
+# Low and high bounds each direction is normalized to in normalMap mode, in greyScaledImages order
+normalMapRanges = [(128, 255), (0, 127), (0, 127), (128, 255)]  # right, left, up, down
+
+def buildNormalizeLut(minValue, maxValue, low, high):
+    # Integer version of cv2.normalize with NORM_MINMAX for one image, as a 256-entry table.
+    # Rounds halves up where OpenCV rounds them to even, so entries can differ by at most 1.
+    span = maxValue - minValue
+    if span == 0:
+        return np.full(256, low, dtype=np.uint8)
+    shifted = np.clip(np.arange(256, dtype=np.int32), minValue, maxValue) - minValue
+    return (low + (2 * shifted * (high - low) + span) // (2 * span)).astype(np.uint8)
+
+class OverlayBuffer:
+    # Produces the same pixels as generateOverlayedImage without the two full-size 3-channel
+    # temporaries. Every channel of the output is blended straight into one preallocated
+    # HxWx3 buffer, and the scratch planes are reused for every card of the same size.
+    # The returned image is a view of the buffer, so it must be consumed before the next card.
+    def __init__(self):
+        self.output = None
+        self._normalizedPlanes = None
+        self._blendedPlane = None
+        self._directionPlanes = None
+
+    def ensureShape(self, height, width):
+        if self.output is None or self.output.shape[:2] != (height, width):
+            self.output = np.empty((height, width, 3), dtype=np.uint8)
+            self._normalizedPlanes = [np.empty((height, width), dtype=np.uint8) for _ in requiredKeywords]
+            self._blendedPlane = np.empty((height, width), dtype=np.uint8)
+
+    def normalize(self, greyScaledImages, mode):
+        height, width = greyScaledImages[0].shape
+        self.ensureShape(height, width)
+        if mode == "normalMap":
+            for image, plane, (low, high) in zip(greyScaledImages, self._normalizedPlanes, normalMapRanges):
+                cv2.normalize(image, plane, low, high, cv2.NORM_MINMAX)
+            self._directionPlanes = self._normalizedPlanes
+        elif mode == "normalMapLut":
+            # One min/max scan and one table lookup per image, with no float math per pixel
+            for image, plane, (low, high) in zip(greyScaledImages, self._normalizedPlanes, normalMapRanges):
+                minValue, maxValue, _, _ = cv2.minMaxLoc(image)
+                cv2.LUT(image, buildNormalizeLut(int(minValue), int(maxValue), low, high), dst=plane)
+            self._directionPlanes = self._normalizedPlanes
+        elif mode == "overlay":
+            self._directionPlanes = greyScaledImages
+        else:
+            self._directionPlanes = None
+
+    def blend(self, blueValue=0):
+        self.output[:, :, 0] = blueValue
+        if self._directionPlanes is None:
+            self.output[:, :, 1:] = 0
+            return self.output
+
+        right, left, up, down = self._directionPlanes
+        # Same weights and rounding as overlayImages, one channel at a time
+        cv2.addWeighted(up, 0.5, down, 0.5, 0, dst=self._blendedPlane)
+        self.output[:, :, 1] = self._blendedPlane
+        cv2.addWeighted(left, 0.5, right, 0.5, 0, dst=self._blendedPlane)
+        self.output[:, :, 2] = self._blendedPlane
+        return self.output
+
+    def render(self, greyScaledImages, mode, blueValue=0):
+        self.normalize(greyScaledImages, mode)
+        return self.blend(blueValue)
+
+# Reused by every card a worker process handles
+workerOverlayBuffer = OverlayBuffer()
+
+# The (width, height) both the trainer and the app resize model inputs to
+modelInputSize = (800, 1120)
+
+def makeOutputProfile(targetSize=None, pngCompression=None):
+    # targetSize: (width, height) every view is area-resized to before the blend, or None for full resolution
+    # pngCompression: zlib level 0-9 for the PNG encoder, or None for the OpenCV default
+    return {"targetSize": tuple(targetSize) if targetSize else None, "pngCompression": pngCompression}
+
+defaultOutputProfile = makeOutputProfile()
+
+def readImageSize(path):
+    # Reads only the header, returning (width, height)
+    if os.path.splitext(path)[1].lower() == ".heic":
+        return pillow_heif.open_heif(path).size
+    with Image.open(path) as image:
+        return image.size
+
+def getScaleSidecarPath(outputPath):
+    # Not .json, so sidecars never get mistaken for labelme annotations in a dataset directory
+    return os.path.splitext(outputPath)[0] + ".scale"
+
+def writeScaleSidecar(outputPath, originalSize, outputSize):
+    sidecar = {
+        "image": os.path.basename(outputPath),
+        "originalSize": list(originalSize),
+        "outputSize": list(outputSize),
+        # Divide output pixel coordinates by these to map them back onto the original capture
+        "scale": [outputSize[0] / originalSize[0], outputSize[1] / originalSize[1]],
+    }
+    sidecarPath = getScaleSidecarPath(outputPath)
+    with open(sidecarPath + ".tmp", "w") as file:
+        json.dump(sidecar, file)
+    os.replace(sidecarPath + ".tmp", sidecarPath)
+
+def writeOutputImage(outputPath, image, profile, originalSize):
+    params = []
+    if profile["pngCompression"] is not None:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, profile["pngCompression"]]
+    if profile["targetSize"]:
+        writeScaleSidecar(outputPath, originalSize, (image.shape[1], image.shape[0]))
+    elif os.path.exists(getScaleSidecarPath(outputPath)):
+        os.remove(getScaleSidecarPath(outputPath))
+
+    # Write to a temporary file first so an interrupted run never leaves a truncated output that looks up to date
+    tempPath = outputPath + ".tmp.png"
+    if not cv2.imwrite(tempPath, image, params):
+        raise IOError(f"Could not write {outputPath}")
+    os.replace(tempPath, outputPath)
 
-def processImageDir(imageDir, outputDir, mode, outputName):
+def processImageDir(imageDir, outputDir, mode, outputName, profile=defaultOutputProfile, force=False):
+    # Returns False when the manifest shows the output is already up to date
     directoryOfPictures = findPictureFiles(imageDir)
     _, fileMappings = list(directoryOfPictures.items())[0]
-    greyScaledImages = getGreyscaledImageList(fileMappings)
-
-    overlayedImage = generateOverlayedImage(greyScaledImages, mode)
     outputPath = os.path.join(outputDir, outputName)
-    cv2.imwrite(outputPath, overlayedImage)
+    manifest = PreprocessManifest(os.path.join(outputDir, manifestFileName))
+    if not force:
+        entry = checkManifestEntry(manifest.get(outputName), fileMappings, mode, profile, outputPath)
+        if entry is not None:
+            manifest.record(outputName, entry)
+            return False
+
+    sources = describeSources(fileMappings)
+    greyScaledImages = getGreyscaledImageList(fileMappings, profile["targetSize"])
+    overlayedImage = OverlayBuffer().render(greyScaledImages, mode)
+    writeOutputImage(outputPath, overlayedImage, profile, readImageSize(fileMappings["Right"]))
+    manifest.record(outputName, describeOutput(sources, mode, profile, outputPath))
+    manifest.compact()
+    return True
+
+def isOutputUpToDate(outputPath, fileMappings, profile=defaultOutputProfile):
+    if not os.path.exists(outputPath):
+        return False
+    outputTime = os.path.getmtime(outputPath)
+    if not all(os.path.getmtime(path) <= outputTime for path in fileMappings.values()):
+        return False
+    # Only resized outputs have a sidecar, and an output written for another target size is stale
+    sidecarPath = getScaleSidecarPath(outputPath)
+    if not profile["targetSize"]:
+        return not os.path.exists(sidecarPath)
+    if not os.path.exists(sidecarPath):
+        return False
+    with open(sidecarPath, "r") as file:
+        return tuple(json.load(file)["outputSize"]) == profile["targetSize"]
+
+# Kept in the output directory, one JSON line per output; not .json, so labelme and the trainer never read it as an annotation
+manifestFileName = "preprocess-manifest.jsonl"
+
+def describeSource(path, knownSource=None):
+    # Only hashes the file when its size or mtime moved since knownSource was recorded
+    stat = os.stat(path)
+    if knownSource and knownSource["path"] == path and knownSource["size"] == stat.st_size and knownSource["mtimeNs"] == stat.st_mtime_ns:
+        return knownSource
+    return {"path": path, "size": stat.st_size, "mtimeNs": stat.st_mtime_ns, "sha1": hash_file(path)}
+
+def describeSources(fileMappings):
+    return {direction: describeSource(path) for direction, path in sorted(fileMappings.items())}
+
+def getProfileRecord(profile):
+    # The profile as it reads back from JSON, where tuples become lists
+    return json.loads(json.dumps(profile))
+
+def getAnnotationPath(outputPath):
+    # labelme saves its annotation next to the image it was drawn on
+    return os.path.splitext(outputPath)[0] + ".json"
+
+def describeOutput(sources, mode, profile, outputPath):
+    annotationPath = getAnnotationPath(outputPath)
+    return {
+        "sources": sources,
+        "mode": mode,
+        "profile": getProfileRecord(profile),
+        "outputPath": outputPath,
+        "outputMtimeNs": os.stat(outputPath).st_mtime_ns,
+        "annotationHash": hash_file(annotationPath) if os.path.exists(annotationPath) else None,
+    }
+
+def checkManifestEntry(entry, fileMappings, mode, profile, outputPath):
+    '''
+    Returns the entry, with refreshed source mtimes, when the output it records is still up to date, or None when the group is stale.
+    Captures that were touched or copied without changing are recognized by their hash, so they are not reprocessed.
+    Outputs written before there was a manifest are adopted when isOutputUpToDate accepts them.
+    '''
+    if entry is None:
+        if isOutputUpToDate(outputPath, fileMappings, profile):
+            return describeOutput(describeSources(fileMappings), mode, profile, outputPath)
+        return None
+    if entry["mode"] != mode or entry["profile"] != getProfileRecord(profile) or entry["outputPath"] != outputPath:
+        return None
+    if not os.path.exists(outputPath) or os.stat(outputPath).st_mtime_ns != entry["outputMtimeNs"]:
+        return None
+    if sorted(fileMappings) != sorted(entry["sources"]):
+        return None
+    sources = {}
+    for direction, path in sorted(fileMappings.items()):
+        knownSource = entry["sources"][direction]
+        source = describeSource(path, knownSource)
+        if source["sha1"] != knownSource["sha1"]:
+            return None
+        sources[direction] = source
+    annotationPath = getAnnotationPath(outputPath)
+    annotationHash = hash_file(annotationPath) if os.path.exists(annotationPath) else None
+    return {**entry, "sources": sources, "annotationHash": annotationHash}
+
+class PreprocessManifest:
+    '''
+    Records each output's source captures (path, size, mtime and hash), the mode and output profile it was made with,
+    and the hash of its labelme annotation. Entries are appended as outputs are written, so an interrupted run keeps
+    what it finished; the last line of a name wins, and compact() rewrites the file with one line per output.
+    '''
+    def __init__(self, manifestPath):
+        self.manifestPath = manifestPath
+        self.entries = {}
+        self.lineCount = 0
+        if os.path.exists(manifestPath):
+            with open(manifestPath, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut short by an interrupted run
+                        continue
+                    self.entries[record["name"]] = record["entry"]
+                    self.lineCount += 1
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def record(self, name, entry):
+        if self.entries.get(name) == entry:
+            return
+        self.entries[name] = entry
+        with open(self.manifestPath, "a") as file:
+            file.write(json.dumps({"name": name, "entry": entry}, separators=(",", ":")) + "\n")
+        self.lineCount += 1
+
+    def compact(self):
+        if self.lineCount == len(self.entries):
+            return
+        tempPath = self.manifestPath + ".tmp"
+        with open(tempPath, "w") as file:
+            for name, entry in sorted(self.entries.items()):
+                file.write(json.dumps({"name": name, "entry": entry}, separators=(",", ":")) + "\n")
+        os.replace(tempPath, self.manifestPath)
+        self.lineCount = len(self.entries)
 
-def runBatchMode(batchDir, outputDir, mode, _defectNameIgnored):
+def processCardGroup(fileMappings, outputPath, mode, profile=defaultOutputProfile):
+    # Runs in a worker process and returns the seconds spent in each stage, and the captures as they were read for the manifest
+    timings = {}
+    start = time.perf_counter()
+    sources = describeSources(fileMappings)
+    timings["hash"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    originalSize = readImageSize(fileMappings["Right"])
+    greyScaledImages = getGreyscaledImageList(fileMappings, profile["targetSize"])
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    workerOverlayBuffer.normalize(greyScaledImages, mode)
+    timings["normalize"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    overlayedImage = workerOverlayBuffer.blend()
+    timings["blend"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    writeOutputImage(outputPath, overlayedImage, profile, originalSize)
+    timings["encode"] = time.perf_counter() - start
+    return timings, sources
+
+def printBatchSummary(processed, skipped, failed, stageTotals, elapsed):
+    print(f"Processed {processed} cards, skipped {skipped} up to date, {failed} failed in {elapsed:.2f}s")
+    if processed:
+        print(f"  {processed / elapsed:.2f} cards/s")
+        for stage, total in stageTotals.items():
+            print(f"  {stage:<10} {total:8.2f}s total {total / processed * 1000:8.1f}ms/card")
+
+def runBatchMode(batchDir, outputDir, mode, _defectNameIgnored, workers=None, maxInFlight=None, force=False, profile=defaultOutputProfile):
     groupedFiles = groupFlatHeicFiles(batchDir)
+    workers = workers or os.cpu_count() or 1
+    # Each card holds four full-size decoded frames, so keep only a few cards per worker in flight
+    maxInFlight = maxInFlight or workers * 2
+    # Only groups whose captures, mode or profile changed since the manifest recorded them are processed again
+    manifest = PreprocessManifest(os.path.join(outputDir, manifestFileName))
+
+    stageTotals = {"hash": 0.0, "decode": 0.0, "normalize": 0.0, "blend": 0.0, "encode": 0.0}
+    processed = skipped = failed = 0
+    batchStart = time.perf_counter()
 
-    for baseName, fileMappings in groupedFiles.items():
+    def collect(baseName, outputPath, future):
+        nonlocal processed, failed
         try:
-            outputName = f"{baseName}.png"
-            greyScaledImages = getGreyscaledImageList(fileMappings)
-            overlayedImage = generateOverlayedImage(greyScaledImages, mode)
-            outputPath = os.path.join(outputDir, outputName)
-            cv2.imwrite(outputPath, overlayedImage)
-            print(f"Processed {outputName}")
+            timings, sources = future.result()
         except Exception as e:
             print(f"Error processing {baseName}: {e}")
+            failed += 1
+            return
+        for stage, seconds in timings.items():
+            stageTotals[stage] += seconds
+        processed += 1
+        previousEntry = manifest.get(f"{baseName}.png")
+        manifest.record(f"{baseName}.png", describeOutput(sources, mode, profile, outputPath))
+        if previousEntry and previousEntry["annotationHash"]:
+            print(f"Processed {baseName}.png again, check that its annotation still matches")
+        else:
+            print(f"Processed {baseName}.png")
+
+    pending = deque()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for baseName, fileMappings in groupedFiles.items():
+                outputPath = os.path.join(outputDir, f"{baseName}.png")
+                if not force:
+                    entry = checkManifestEntry(manifest.get(f"{baseName}.png"), fileMappings, mode, profile, outputPath)
+                    if entry is not None:
+                        manifest.record(f"{baseName}.png", entry)
+                        skipped += 1
+                        continue
+                pending.append((baseName, outputPath, executor.submit(processCardGroup, fileMappings, outputPath, mode, profile)))
+                if len(pending) >= maxInFlight:
+                    collect(*pending.popleft())
+            while pending:
+                collect(*pending.popleft())
+    finally:
+        manifest.compact()
+
+    printBatchSummary(processed, skipped, failed, stageTotals, time.perf_counter() - batchStart)
+
+def popOption(args, name):
+    # Removes "<name> <value>" from args and returns the value, or None when absent
+    if name not in args:
+        return None
+    index = args.index(name)
+    value = args[index + 1]
+    del args[index:index + 2]
+    return value
+
+def parseTargetSize(value):
+    if value is None:
+        return None
+    if value == "model":
+        return modelInputSize
+    width, height = value.lower().split("x")
+    return (int(width), int(height))
 
 if __name__ == "__main__":
     args = sys.argv[1:]
+    options = "[-size <width>x<height> | -size model] [-compression <0-9>]"
 
     if len(args) < 3:
         print("Usage:")
-        print("  Batch Mode:  python preprocess_images.py -batch <batchDir> <resultsDir> <normalMap | overlay> <defectName>")
-        print("  Single Mode: python preprocess_images.py <imageDir> <resultsDir> <normalMap | overlay>")
+        print(f"  Batch Mode:  python preprocess_images.py -batch <batchDir> <resultsDir> <normalMap | normalMapLut | overlay> <defectName> [workers] [-force] {options}")
+        print(f"  Single Mode: python preprocess_images.py <imageDir> <resultsDir> <normalMap | normalMapLut | overlay> [-force] {options}")
         sys.exit(1)
 
+    targetSize = parseTargetSize(popOption(args, "-size"))
+    pngCompression = popOption(args, "-compression")
+    profile = makeOutputProfile(targetSize, int(pngCompression) if pngCompression is not None else None)
+
+    force = "-force" in args
+    args = [arg for arg in args if arg != "-force"]
     if args[0] == "-batch":
-        if len(args) != 5:
-            print("Usage: python preprocess_images.py -batch <batchDir> <resultsDir> <normalMap | overlay> <defectName>")
+        if len(args) not in (5, 6):
+            print(f"Usage: python preprocess_images.py -batch <batchDir> <resultsDir> <normalMap | normalMapLut | overlay> <defectName> [workers] [-force] {options}")
             sys.exit(1)
         batchDir = args[1]
         resultsDir = args[2]
         mode = args[3]
         defectName = args[4]
-        runBatchMode(batchDir, resultsDir, mode, defectName)
+        workers = int(args[5]) if len(args) == 6 else None
+        runBatchMode(batchDir, resultsDir, mode, defectName, workers, force=force, profile=profile)
     else:
         imageDir = args[0]
         resultsDir = args[1]
@@ -141,7 +508,9 @@ if __name__ == "__main__":
         try:
             baseName = os.path.basename(imageDir)
             outputName = f"{baseName}.{mode}.png"
-            processImageDir(imageDir, resultsDir, mode, outputName)
-            print("Done.")
+            if processImageDir(imageDir, resultsDir, mode, outputName, profile, force):
+                print("Done.")
+            else:
+                print(f"{outputName} is up to date.")
         except Exception as e:
             print(f"Failed to process image directory: {e}")
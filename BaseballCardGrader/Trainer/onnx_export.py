@@ -0,0 +1,290 @@
+from pathlib import Path
+import os
+import statistics
+import time
+
+import numpy as np
+import torch
+
+# Import ONNX dependencies
+import onnx
+import onnxruntime as ort
+from onnxruntime.quantization import quantize_dynamic, QuantType
+
+try:
+    from onnxsim import simplify
+except ImportError:  # Exported graphs are left unsimplified without onnxsim
+    simplify = None
+
+# Import the IoU helpers of the detection metrics
+from evaluation import box_iou, pack_masks, packed_mask_iou
+
+# ONNX opset the graphs are exported with, pinned so artifacts do not change with the PyTorch version
+OPSET_VERSION = 17
+
+# (height, width) the app feeds the model
+INPUT_SIZE = (1120, 800)
+
+INPUT_NAMES = ['input']
+OUTPUT_NAMES = ['boxes', 'labels', 'scores', 'masks']
+# The batched graph adds the index of the image every detection belongs to
+BATCHED_OUTPUT_NAMES = OUTPUT_NAMES + ['batch_index']
+
+# Export profiles and the suffix of the file each one writes
+EXPORT_PROFILES = {
+    'fp32': '',
+    'int8': '-int8',
+    'static': '-static',
+    'batch': '-batch',
+}
+
+class ImageDetections(torch.nn.Module):
+    # Returns the detections of a one-image batch as a tuple, which tracing requires
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        detections = self.model(image)[0]
+        return detections['boxes'], detections['labels'], detections['scores'], detections['masks']
+
+class BatchedDetections(torch.nn.Module):
+    """
+    Runs a traced one-image model over every image of a batch.
+
+    Tracing unrolls the model's per-image loops for the traced batch size, so
+    the loop over the batch is scripted instead and exports as an ONNX Loop.
+    Detections of all images are concatenated, with the image index of every
+    detection in a separate output.
+    """
+    def __init__(self, image_model):
+        super().__init__()
+        self.image_model = image_model
+
+    def forward(self, images):
+        boxes = images.new_zeros((0, 4))
+        labels = torch.zeros(0, dtype=torch.int64)
+        scores = images.new_zeros((0,))
+        masks = images.new_zeros((0, 1, images.shape[2], images.shape[3]))
+        batch_index = torch.zeros(0, dtype=torch.int64)
+        for i in range(images.shape[0]):
+            image_boxes, image_labels, image_scores, image_masks = self.image_model(images[i:i + 1])
+            boxes = torch.cat([boxes, image_boxes])
+            labels = torch.cat([labels, image_labels])
+            scores = torch.cat([scores, image_scores])
+            masks = torch.cat([masks, image_masks])
+            batch_index = torch.cat([batch_index, torch.full_like(image_labels, i)])
+        return boxes, labels, scores, masks, batch_index
+
+def export_onnx(model, onnx_path, image_size=INPUT_SIZE, dynamic=True, opset_version=OPSET_VERSION):
+    """
+    Exports a Mask R-CNN model traced at the inference size, with constant folding.
+
+    Args:
+        model: A Mask R-CNN model in eval mode.
+        onnx_path: The path of the ONNX file to write.
+        image_size: The (height, width) of the traced input.
+        dynamic: Whether the input height and width stay dynamic. A static graph
+            lets shape-dependent nodes be folded away, but only accepts image_size.
+    """
+    input_tensor = torch.rand(1, 3, *image_size)
+    torch.onnx.export(model.cpu(),
+                      input_tensor,
+                      onnx_path,
+                      export_params=True,
+                      do_constant_folding=True,
+                      opset_version=opset_version,
+                      input_names=INPUT_NAMES,
+                      output_names=OUTPUT_NAMES,
+                      dynamic_axes={'input': {2: 'height', 3: 'width'}} if dynamic else None,
+                      dynamo=False)
+    simplify_onnx(onnx_path)
+
+def export_batched_onnx(model, onnx_path, image_size=INPUT_SIZE, opset_version=OPSET_VERSION):
+    """
+    Exports a Mask R-CNN model with dynamic batch, height and width axes.
+
+    The outputs are the flat detections of every image, in BATCHED_OUTPUT_NAMES
+    order, so one session run grades a whole sheet of cards.
+    """
+    model = model.cpu()
+    image_model = torch.jit.trace(ImageDetections(model), torch.rand(1, 3, *image_size), check_trace=False)
+    batched_model = torch.jit.script(BatchedDetections(image_model))
+    torch.onnx.export(batched_model,
+                      torch.rand(1, 3, *image_size),
+                      onnx_path,
+                      export_params=True,
+                      do_constant_folding=True,
+                      opset_version=opset_version,
+                      input_names=INPUT_NAMES,
+                      output_names=BATCHED_OUTPUT_NAMES,
+                      dynamic_axes={'input': {0: 'batch', 2: 'height', 3: 'width'}},
+                      dynamo=False)
+    simplify_onnx(onnx_path)
+
+def simplify_onnx(onnx_path):
+    if simplify:
+        onnx_model, check = simplify(onnx.load(onnx_path))
+        if check:
+            onnx.save(onnx_model, onnx_path)
+
+def optimize_onnx(onnx_path, optimized_path):
+    """
+    Applies ONNX Runtime graph optimizations offline and saves the result.
+
+    The basic level only holds hardware-independent rewrites such as constant
+    folding and redundant node elimination, so the saved graph stays valid on
+    any execution provider, and those passes do not run again at session creation.
+    """
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_BASIC
+    session_options.optimized_model_filepath = str(optimized_path)
+    ort.InferenceSession(str(onnx_path), session_options, providers=['CPUExecutionProvider'])
+
+def quantize_onnx(onnx_path, quantized_path):
+    """
+    Quantizes the weights of every convolution and linear layer to 8 bits.
+
+    Activations are quantized on the fly, so no calibration data is needed.
+    Weights are unsigned, which ONNX Runtime's CPU ConvInteger kernels run
+    several times faster than signed ones.
+    """
+    quantize_dynamic(str(onnx_path), str(quantized_path), op_types_to_quantize=['Conv', 'MatMul', 'Gemm'], weight_type=QuantType.QUInt8)
+
+def export_profile(model, profile, onnx_path):
+    """
+    Writes the ONNX artifact of an export profile.
+
+    Args:
+        model: A Mask R-CNN model in eval mode.
+        profile: One of EXPORT_PROFILES.
+        onnx_path: The path of the artifact.
+    """
+    # The unoptimized export is kept beside the artifact only until it is converted
+    export_path = onnx_path.with_suffix('.export.onnx')
+    if profile == 'batch':
+        export_batched_onnx(model, export_path)
+    else:
+        export_onnx(model, export_path, dynamic=profile != 'static')
+    try:
+        if profile == 'int8':
+            # Quantize the plain export, since ONNX Runtime fusions can hide layers from the quantizer
+            quantized_path = onnx_path.with_suffix('.quant.onnx')
+            quantize_onnx(export_path, quantized_path)
+            optimize_onnx(quantized_path, onnx_path)
+            os.remove(quantized_path)
+        else:
+            optimize_onnx(export_path, onnx_path)
+    finally:
+        os.remove(export_path)
+
+def create_session(onnx_path, num_threads=None):
+    # Default optimization level, as the app's InferenceSession uses; the basic passes are already applied offline
+    session_options = ort.SessionOptions()
+    if num_threads:
+        session_options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(str(onnx_path), session_options, providers=['CPUExecutionProvider'])
+
+def measure_latency(run, repeats=3):
+    # Returns the median wall time of `run` in milliseconds, after one warm-up call
+    run()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+def compare_detections(reference, outputs, score_threshold=0.5, match_iou=0.5):
+    """
+    Compares the detections of an ONNX artifact with those of the PyTorch model.
+
+    Each reference detection above the score threshold is matched to the
+    artifact's detection of the same label with the highest box IoU.
+
+    Args:
+        reference: A PyTorch model output dictionary.
+        outputs: The artifact's outputs, in OUTPUT_NAMES or BATCHED_OUTPUT_NAMES order.
+
+    Returns:
+        A dictionary with the detection counts, the matched count, and the mean
+        box and mask IoU and maximum score difference of the matches.
+    """
+    boxes, labels, scores, masks = outputs[:4]
+    keep = scores >= score_threshold
+    reference_keep = (reference['scores'] >= score_threshold).numpy()
+    reference_boxes = reference['boxes'].numpy()[reference_keep]
+    reference_labels = reference['labels'].numpy()[reference_keep]
+    reference_scores = reference['scores'].numpy()[reference_keep]
+
+    ious = box_iou(reference_boxes, boxes[keep])
+    ious = np.where(reference_labels[:, None] == labels[keep][None, :], ious, -1.0)
+    comparison = {'reference_detections': int(reference_keep.sum()), 'detections': int(keep.sum()), 'matched': 0,
+                  'mean_box_iou': None, 'mean_mask_iou': None, 'max_score_diff': None}
+    if not ious.size:
+        return comparison
+
+    best = ious.argmax(axis=1)
+    best_ious = ious[np.arange(len(best)), best]
+    matched = best_ious >= match_iou
+    if not matched.any():
+        return comparison
+
+    reference_bits, reference_areas = pack_masks(reference['masks'][reference_keep][matched, 0] >= 0.5)
+    matched_bits, matched_areas = pack_masks(masks[keep][best[matched], 0] >= 0.5)
+    mask_ious = packed_mask_iou(reference_bits, reference_areas, matched_bits, matched_areas).diagonal()
+    comparison.update(matched=int(matched.sum()),
+                      mean_box_iou=float(best_ious[matched].mean()),
+                      mean_mask_iou=float(mask_ious.mean()),
+                      max_score_diff=float(np.abs(reference_scores[matched] - scores[keep][best[matched]]).max()))
+    return comparison
+
+def build_report(model, artifacts, inputs, repeats=3, num_threads=None):
+    """
+    Measures every artifact against the PyTorch model on CPU.
+
+    Args:
+        model: The PyTorch model the artifacts were exported from, in eval mode.
+        artifacts: A dictionary of profile names to ONNX paths.
+        inputs: (3, 1120, 800) float image tensors to compare on.
+        repeats: The number of timed runs per image.
+        num_threads: The intra-op thread count of every session.
+
+    Returns:
+        A dictionary with the PyTorch latency and, per profile, the file size,
+        session creation time, latency and summed detection comparison.
+    """
+    model = model.cpu()
+    with torch.inference_mode():
+        references = [model([image])[0] for image in inputs]
+        pytorch_latency = statistics.median(measure_latency(lambda: model([image]), repeats) for image in inputs)
+    report = {'images': len(inputs), 'pytorch': {'latency_ms': pytorch_latency}, 'profiles': {}}
+
+    for profile, onnx_path in artifacts.items():
+        start = time.perf_counter()
+        session = create_session(onnx_path, num_threads)
+        session_ms = (time.perf_counter() - start) * 1000
+
+        latencies = []
+        comparisons = []
+        for image, reference in zip(inputs, references):
+            feed = {INPUT_NAMES[0]: image[None].numpy()}
+            latencies.append(measure_latency(lambda: session.run(None, feed), repeats))
+            comparisons.append(compare_detections(reference, session.run(None, feed)))
+
+        report['profiles'][profile] = {
+            'path': Path(onnx_path).name,
+            'size_mb': os.path.getsize(onnx_path) / 2**20,
+            'session_ms': session_ms,
+            'latency_ms': statistics.median(latencies),
+            'parity': summarize_comparisons(comparisons),
+        }
+    return report
+
+def summarize_comparisons(comparisons):
+    # Sums the counts and averages the IoUs of the images that had matches
+    summary = {key: sum(comparison[key] for comparison in comparisons) for key in ('reference_detections', 'detections', 'matched')}
+    for key, reduce in (('mean_box_iou', statistics.mean), ('mean_mask_iou', statistics.mean), ('max_score_diff', max)):
+        values = [comparison[key] for comparison in comparisons if comparison[key] is not None]
+        summary[key] = reduce(values) if values else None
+    return summary
@@ -0,0 +1,92 @@
+from pathlib import Path
+from collections import defaultdict
+import argparse
+
+import numpy as np
+import torch
+import onnxruntime as ort
+
+from grader import Grader, iter_images
+from model_bundle import load_bundle, find_checkpoint
+from onnx_export import INPUT_NAMES, measure_latency
+
+class OnnxGrader(Grader):
+    """
+    Reference runner for the batched ONNX export, on ONNX Runtime's CPU provider.
+
+    Grades `batch_size` cards per session run and splits the flat detections
+    back into per-image results with the batch_index output. Results have the
+    same form as those of Grader, and images are resized with the same policy
+    and size from the checkpoint bundle beside the ONNX file.
+    """
+    def __init__(self, checkpoint_directory, onnx_path=None, batch_size=4, threshold=0.5, image_size=None, num_decode_workers=4, num_threads=None,
+                 mask_threshold=None, resize_policy=None):
+        self._onnx_path = Path(onnx_path or Path(checkpoint_directory)/"BaseballCardGraderModel-batch.onnx")
+        self._num_threads = num_threads
+        super().__init__(checkpoint_directory, 'cpu', batch_size, threshold, image_size, num_decode_workers, mask_threshold=mask_threshold,
+                         resize_policy=resize_policy)
+
+    def _load_model(self):
+        # The bundle is only read for its classes and preprocessing; its weights are memory-mapped and never copied
+        bundle = load_bundle(find_checkpoint(self._checkpoint_directory))
+        self.class_names, self.colors = bundle['class_names'], bundle['colors']
+        self._read_resize(bundle['preprocessing'])
+        self.model_path = self._onnx_path
+        session_options = ort.SessionOptions()
+        if self._num_threads:
+            session_options.intra_op_num_threads = self._num_threads
+        return ort.InferenceSession(str(self._onnx_path), session_options, providers=['CPUExecutionProvider'])
+
+    def run_batch(self, batch):
+        # Keep-aspect inputs differ by orientation, so inputs of each size stack into their own session run instead of being padded
+        size_groups = defaultdict(list)
+        for index, (_, _, input_tensor) in enumerate(batch):
+            size_groups[tuple(input_tensor.shape[-2:])].append(index)
+
+        model_outputs = [None] * len(batch)
+        for indices in size_groups.values():
+            feed = {INPUT_NAMES[0]: torch.stack([batch[index][2] for index in indices]).numpy()}
+            boxes, labels, scores, masks, batch_index = (torch.from_numpy(output) for output in self.model.run(None, feed))
+            for i, index in enumerate(indices):
+                in_image = batch_index == i
+                model_outputs[index] = {'boxes': boxes[in_image], 'labels': labels[in_image], 'scores': scores[in_image], 'masks': masks[in_image]}
+
+        for (name, original_size, input_tensor), model_output in zip(batch, model_outputs):
+            yield self._to_result(name, original_size, input_tensor.shape[-2:], model_output)
+
+def benchmark_batch_sizes(session, batch_sizes, image_size=(1120, 800), repeats=3):
+    """
+    Times one session run per batch size on random inputs.
+
+    Returns:
+        A list of dictionaries with the batch size, the median run latency and
+        the latency per image, in milliseconds.
+    """
+    results = []
+    for batch_size in batch_sizes:
+        feed = {INPUT_NAMES[0]: np.random.rand(batch_size, 3, *image_size).astype(np.float32)}
+        latency = measure_latency(lambda: session.run(None, feed), repeats)
+        results.append({'batch_size': batch_size, 'latency_ms': latency, 'ms_per_image': latency / batch_size})
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grade card images with the batched ONNX model")
+    parser.add_argument("checkpoint_directory", type=Path, help="Path to the colormap and the batched ONNX model")
+    parser.add_argument("images", type=Path, nargs='*', help="Image files or directories of images to grade")
+    parser.add_argument("--model", type=Path, default=None, help="Path of the ONNX model (default: <checkpoint>/BaseballCardGraderModel-batch.onnx)")
+    parser.add_argument("--output", type=Path, default=Path("results.jsonl"), help="Path of the JSONL results file")
+    parser.add_argument("--batch-size", type=int, default=4, help="Images per session run")
+    parser.add_argument("--threshold", type=float, default=0.5, help="Score and mask threshold")
+    parser.add_argument("--threads", type=int, default=None, help="ONNX Runtime intra-op threads (default: all cores)")
+    parser.add_argument("--benchmark", type=int, nargs='+', default=None, help="Batch sizes to time instead of grading")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per benchmarked batch size")
+    args = parser.parse_args()
+
+    grader = OnnxGrader(args.checkpoint_directory, args.model, args.batch_size, args.threshold, num_threads=args.threads)
+    if args.benchmark:
+        for result in benchmark_batch_sizes(grader.model, args.benchmark, repeats=args.repeats):
+            print(f"Batch {result['batch_size']}: {result['latency_ms']:.0f} ms per run, {result['ms_per_image']:.0f} ms per image")
+    else:
+        images = (image for path in args.images for image in iter_images(path))
+        count = grader.grade_to_jsonl(images, args.output)
+        print(f"Graded {count} images into {args.output}")
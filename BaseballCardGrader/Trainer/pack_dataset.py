@@ -0,0 +1,26 @@
+from pathlib import Path
+import argparse
+
+# Import the dataset loading used by the trainer
+from train_model import load_dataset_annotations
+from dataset_cache import pack_shard
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack a dataset into a pre-resized, memory-mapped training shard")
+    parser.add_argument("dataset_directory", type=Path, help="Path to the dataset of images and labelme annotations")
+    parser.add_argument("shard_path", type=Path, help="Path of the shard file to write")
+    parser.add_argument("--height", type=int, default=1120, help="Training image height")
+    parser.add_argument("--width", type=int, default=800, help="Training image width")
+    args = parser.parse_args()
+
+    # Loads the images, annotations and class names of the dataset
+    image_dict, annotation_index, class_names = load_dataset_annotations(args.dataset_directory)
+    keys = sorted(image_dict.keys())
+
+    pack_shard(args.shard_path,
+               keys,
+               [image_dict[key] for key in keys],
+               [annotation_index.get_shapes(key) for key in keys],
+               class_names,
+               image_size=(args.height, args.width))
+    print(f"Packed {len(keys)} images into {args.shard_path}")
@@ -0,0 +1,174 @@
+import torch
+from torchvision.models.detection.transform import resize_boxes
+
+def detect(model, images):
+    """
+    Runs a Mask R-CNN model in eval mode without pasting its masks into the image.
+
+    torchvision's postprocessing pastes every mask into a float image-sized
+    tensor. This keeps each mask as its (1, M, M) probabilities instead, so
+    paste_masks can threshold them in chunks.
+
+    Args:
+        model: A Mask R-CNN model in eval mode.
+        images: A list of (3, H, W) float image tensors.
+
+    Returns:
+        A detections dictionary per image with 'boxes' in image coordinates,
+        'labels', 'scores' and (N, 1, M, M) 'mask_probs'.
+    """
+    original_image_sizes = [tuple(image.shape[-2:]) for image in images]
+    image_list, _ = model.transform(images)
+    features = model.backbone(image_list.tensors)
+    proposals, _ = model.rpn(image_list, features)
+    detections, _ = model.roi_heads(features, proposals, image_list.image_sizes)
+    for detection, image_size, original_image_size in zip(detections, image_list.image_sizes, original_image_sizes):
+        detection['boxes'] = resize_boxes(detection['boxes'], image_size, original_image_size)
+        detection['mask_probs'] = detection.pop('masks')
+    return detections
+
+def interpolation_weights(starts, lengths, size, source_size):
+    """
+    Builds the bilinear weights that resize source cells onto a span of pixels.
+
+    Returns:
+        A (N, size, source_size) tensor. Row i of instance n holds the weights
+        F.interpolate(align_corners=False) gives the source cells for pixel i,
+        when the source is resized to lengths[n] pixels starting at starts[n].
+        Rows outside the span are zero.
+    """
+    offsets = torch.arange(size, device=starts.device)[None, :] - starts[:, None]
+    inside = ((offsets >= 0) & (offsets < lengths[:, None])).to(torch.float32)
+    scale = source_size / lengths.to(torch.float32)
+    source = ((offsets + 0.5) * scale[:, None] - 0.5).clamp(min=0)
+    lower = source.floor().to(torch.int64).clamp(max=source_size - 1)
+    upper = (lower + 1).clamp(max=source_size - 1)
+    upper_weight = (source - lower) * inside
+    lower_weight = inside - upper_weight
+
+    weights = torch.zeros((len(starts), size, source_size), device=starts.device)
+    weights.scatter_add_(2, lower[..., None], lower_weight[..., None])
+    weights.scatter_add_(2, upper[..., None], upper_weight[..., None])
+    return weights
+
+def paste_masks(mask_probs, boxes, image_size, mask_threshold=0.5, max_chunk_bytes=64 * 1024 * 1024):
+    """
+    Pastes (N, 1, M, M) mask probabilities into (N, H, W) boolean masks.
+
+    Gives the same result as torchvision's paste_masks_in_image followed by a
+    threshold, but for all instances at once. Bilinear resizing is separable,
+    so each mask is resized and placed by two batched matrix products with
+    interpolation weights that are zero outside its box. Float masks only
+    exist for one chunk of instances at a time, under max_chunk_bytes.
+    """
+    height, width = image_size
+    masks = torch.zeros((len(mask_probs), height, width), dtype=torch.bool, device=mask_probs.device)
+    if not len(mask_probs):
+        return masks
+
+    # Pad the masks by one cell and grow the boxes to match, as torchvision does
+    mask_size = mask_probs.shape[-1]
+    padded = torch.nn.functional.pad(mask_probs[:, 0], (1, 1, 1, 1))
+    scale = (mask_size + 2) / mask_size
+    centers = (boxes[:, :2] + boxes[:, 2:]) * 0.5
+    half_sizes = (boxes[:, 2:] - boxes[:, :2]) * 0.5 * scale
+    expanded = torch.cat([centers - half_sizes, centers + half_sizes], dim=1).to(torch.int64)
+    sizes = (expanded[:, 2:] - expanded[:, :2] + 1).clamp(min=1)
+
+    row_weights = interpolation_weights(expanded[:, 1], sizes[:, 1], height, mask_size + 2)
+    column_weights = interpolation_weights(expanded[:, 0], sizes[:, 0], width, mask_size + 2)
+    chunk = max(1, max_chunk_bytes // (height * width * 4))
+    for start in range(0, len(masks), chunk):
+        end = start + chunk
+        pasted = row_weights[start:end] @ padded[start:end] @ column_weights[start:end].transpose(1, 2)
+        masks[start:end] = pasted >= mask_threshold
+    return masks
+
+def masks_to_rle(masks):
+    """
+    Encodes (N, H, W) boolean masks as uncompressed COCO-style run-length encodings.
+
+    Runs are taken in column-major order and always start with a run of zeros.
+    The change points of all masks are found in one pass.
+    """
+    count, height, width = masks.shape
+    if not count:
+        return []
+    pixels = masks.transpose(1, 2).reshape(count, -1)
+    changes = torch.nonzero(pixels[:, 1:] != pixels[:, :-1])
+    change_points = (changes[:, 1] + 1).cpu().split(torch.bincount(changes[:, 0], minlength=count).tolist())
+    starts_with_one = pixels[:, 0].tolist()
+
+    rles = []
+    for points, first in zip(change_points, starts_with_one):
+        boundaries = torch.cat([torch.tensor([0]), points, torch.tensor([height * width])])
+        counts = torch.diff(boundaries).tolist()
+        rles.append({'size': [height, width], 'counts': [0] + counts if first else counts})
+    return rles
+
+def rles_to_masks(rles):
+    """
+    Decodes run-length encodings from masks_to_rle back into (N, H, W) boolean masks.
+    """
+    if not rles:
+        return torch.zeros((0, 0, 0), dtype=torch.bool)
+    height, width = rles[0]['size']
+    masks = torch.zeros((len(rles), height * width), dtype=torch.bool)
+    for mask, rle in zip(masks, rles):
+        counts = torch.tensor(rle['counts'])
+        # Runs alternate between zeros and ones, starting with zeros
+        mask[:] = torch.repeat_interleave(torch.arange(len(counts)) % 2 == 1, counts)
+    return masks.reshape(len(rles), width, height).transpose(1, 2)
+
+def coverage_map(masks, labels, image_size):
+    """
+    Combines instance masks into one (H, W) uint8 map of defect labels.
+
+    Each pixel holds the label of the first mask covering it, which is the
+    highest-scoring one when masks are sorted by score, and 0 where no mask does.
+    """
+    if masks.is_cuda and len(masks) > 0:
+        # One batched argmax beats a kernel launch per mask on the GPU; argmax returns the first of equal maxima
+        first_mask = masks.to(torch.uint8).argmax(0)
+        labels = torch.as_tensor(labels, device=masks.device).to(torch.uint8)
+        return torch.where(masks.any(0), labels[first_mask], 0).to(torch.uint8)
+    labels_map = torch.zeros(image_size, dtype=torch.uint8, device=masks.device)
+    # Paint from the last mask to the first, so the first mask covering a pixel is painted last
+    for mask, label in zip(reversed(masks), reversed(labels.tolist())):
+        labels_map[mask] = label
+    return labels_map
+
+def coverage_fractions(coverage_map, class_names):
+    # Fraction of the image covered by each class with any coverage, background excluded
+    coverage = torch.bincount(coverage_map.cpu().flatten().to(torch.int64), minlength=len(class_names)) / max(coverage_map.numel(), 1)
+    return {class_name: float(fraction) for class_name, fraction in zip(class_names[1:], coverage[1:]) if fraction > 0}
+
+def postprocess_detections(detections, image_size, score_threshold=0.5, mask_threshold=0.5):
+    """
+    Filters one image's detections by score and turns their masks into compact outputs.
+
+    Args:
+        detections: A dictionary with 'boxes', 'labels', 'scores', and either
+            'mask_probs' from detect or already pasted float 'masks'.
+        image_size: The (height, width) the masks are pasted at.
+
+    Returns:
+        A dictionary with the kept 'boxes', 'labels' and 'scores', the boolean
+        (N, H, W) 'masks', their run-length encodings 'rles', and the (H, W)
+        label 'coverage_map'.
+    """
+    keep = detections['scores'] > score_threshold
+    boxes = detections['boxes'][keep]
+    labels = detections['labels'][keep]
+    if 'mask_probs' in detections:
+        masks = paste_masks(detections['mask_probs'][keep], boxes, image_size, mask_threshold)
+    else:
+        masks = detections['masks'][keep][:, 0] >= mask_threshold
+    return {
+        'boxes': boxes,
+        'labels': labels,
+        'scores': detections['scores'][keep],
+        'masks': masks,
+        'rles': masks_to_rle(masks),
+        'coverage_map': coverage_map(masks, labels, image_size),
+    }
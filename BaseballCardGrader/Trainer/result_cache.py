@@ -0,0 +1,192 @@
+from pathlib import Path
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import json
+import os
+import threading
+
+# Import PIL for storing normal maps
+from PIL import Image
+
+import torch
+
+# Import the mask decoding and coverage of the post-processing
+from postprocessing import rles_to_masks, coverage_map, coverage_fractions
+
+# Import the content hashes of cache keys
+from hashing import hash_bytes, hash_file
+
+# Score threshold raw detections are graded at; the model itself drops detections below 0.05
+RAW_SCORE_THRESHOLD = 0.0
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache of normal maps and raw detections.
+
+    Keys are hashes of the inputs and of everything else that changes the
+    output, from get_key. A normal map is keyed by its four captures and the
+    normal map settings. Detections are keyed by their input image, or the key
+    of the normal map they were graded on, the model file and the grading
+    settings. The score threshold is left out of detection keys: entries hold
+    every detection the model returns, so grading the same card at another
+    threshold is answered by threshold_detections without running the model.
+
+    Detections are stored as JSON with run-length encoded masks, and normal
+    maps as PNG. When the cache grows past max_bytes, the least recently used
+    files are removed first. Hits refresh a file's modification time, which
+    orders the files again when the cache is reopened.
+    """
+    def __init__(self, cache_directory, max_bytes=2 * 2**30):
+        self._cache_directory = Path(cache_directory)
+        self._cache_directory.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        # File sizes in least to most recently used order
+        self._files = OrderedDict()
+        paths = [path for path in self._cache_directory.iterdir() if path.suffix in ('.json', '.png')]
+        for path in sorted(paths, key=lambda path: path.stat().st_mtime_ns):
+            self._files[path.name] = path.stat().st_size
+        self._size = sum(self._files.values())
+
+    def get_key(self, input_hashes, model_hash=None, settings=None):
+        """
+        Args:
+            input_hashes: The hashes of the inputs, such as the four captures in
+                capture order, a single image, or the key of a normal map.
+            model_hash: The hash of the model file, from get_model_hash, for detections.
+            settings: A JSON-serializable dictionary of everything else that
+                changes the output.
+        """
+        key_source = json.dumps({'inputs': list(input_hashes), 'model': model_hash, 'settings': settings or {}}, sort_keys=True)
+        return hashlib.sha1(key_source.encode('utf-8')).hexdigest()
+
+    def get_detections(self, key):
+        # Returns the cached raw detections, or None on a miss
+        path = self._get_hit(f"{key}.json")
+        if path is None:
+            return None
+        with open(path, 'r') as file:
+            return json.load(file)
+
+    def get_normal_map(self, key):
+        # Returns the cached normal map as an RGB PIL image, or None on a miss
+        path = self._get_hit(f"{key}.png")
+        if path is None:
+            return None
+        with Image.open(path) as image:
+            return image.convert('RGB')
+
+    def get_normal_map_path(self, key):
+        # Returns the path of a cached normal map PNG, or None on a miss
+        return self._get_hit(f"{key}.png")
+
+    def put_detections(self, key, detections):
+        """
+        Stores the raw detections of a Grader graded at RAW_SCORE_THRESHOLD.
+        """
+        self._put(f"{key}.json", lambda file: file.write(json.dumps(detections).encode('utf-8')))
+
+    def put_normal_map(self, key, normal_map):
+        self._put(f"{key}.png", lambda file: normal_map.save(file, format='PNG'))
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._files)
+
+    def _get_hit(self, name):
+        path = self._cache_directory/name
+        with self._lock:
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Removed by another process sharing the directory
+            with self._lock:
+                self._size -= self._files.pop(name, 0)
+            return None
+        return path
+
+    def _put(self, name, write):
+        # Write to a temporary file first so a partially written file is never treated as a hit
+        path = self._cache_directory/name
+        temp_path = path.with_name(f"{name}.tmp")
+        with open(temp_path, 'wb') as file:
+            write(file)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._size -= self._files.pop(name, 0)
+            self._files[name] = path.stat().st_size
+            self._size += self._files[name]
+            evicted = []
+            while self._size > self._max_bytes and len(self._files) > 1:
+                evicted_name, size = self._files.popitem(last=False)
+                self._size -= size
+                evicted.append(evicted_name)
+        for evicted_name in evicted:
+            (self._cache_directory/evicted_name).unlink(missing_ok=True)
+
+def get_model_hash(model_path):
+    # Hashing a checkpoint takes a moment, so the hash is kept until the file changes
+    model_path = Path(model_path).resolve()
+    stat = model_path.stat()
+    return _hash_model_file(model_path, stat.st_mtime_ns, stat.st_size)
+
+@lru_cache(maxsize=8)
+def _hash_model_file(model_path, mtime_ns, size):
+    return hash_file(model_path)
+
+def threshold_detections(detections, score_threshold, class_names):
+    """
+    Keeps the detections of a result above a score threshold, as Grader would have.
+
+    Args:
+        detections: A result dictionary of Grader, such as raw detections from
+            ResultCache.get_detections.
+        score_threshold: The minimum score.
+        class_names: The class names, starting with 'background'.
+
+    Returns:
+        A result dictionary of Grader, with the coverage of the kept masks.
+    """
+    keep = [i for i, score in enumerate(detections['scores']) if score > score_threshold]
+    masks = [detections['masks'][i] for i in keep]
+    labels = [detections['labels'][i] for i in keep]
+    label_indices = torch.tensor([class_names.index(label) for label in labels], dtype=torch.int64)
+    image_size = detections['input_size'][::-1]
+    return {
+        **detections,
+        'boxes': [detections['boxes'][i] for i in keep],
+        'labels': labels,
+        'scores': [detections['scores'][i] for i in keep],
+        'masks': masks,
+        'coverage': coverage_fractions(coverage_map(rles_to_masks(masks), label_indices, image_size), class_names),
+    }
+
+def grade_cached(grader, result_cache, image_path, score_threshold):
+    """
+    Grades one image file, answering from the cache when it was graded by the same model before.
+
+    Args:
+        grader: A Grader created with threshold=RAW_SCORE_THRESHOLD.
+        result_cache: A ResultCache.
+        image_path: The path of the image.
+        score_threshold: The score threshold of the returned result.
+
+    Returns:
+        A tuple of the result dictionary of Grader and whether it came from the cache.
+    """
+    key = result_cache.get_key([hash_file(image_path)], get_model_hash(grader.model_path), grader.get_settings())
+    detections = result_cache.get_detections(key)
+    cache_hit = detections is not None
+    if not cache_hit:
+        detections = next(grader.grade(image_path))
+        result_cache.put_detections(key, detections)
+    return threshold_detections({**detections, 'image': str(image_path)}, score_threshold, grader.class_names), cache_hit
@@ -0,0 +1,209 @@
+from pathlib import Path
+from contextlib import contextmanager
+import json
+import sys
+import time
+
+import torch
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Stages a training step is split into, in order
+TRAINING_STAGES = ('data_wait', 'copy', 'forward', 'backward', 'optimizer')
+
+class TrainingTelemetry:
+    """
+    Per-stage timing, throughput and memory metrics for the training loop.
+
+    Losses are summed on the device and only synchronized every `log_every`
+    steps, when a record is appended to the metrics JSONL file. Stage timers
+    measure host wall time; on an accelerator the host does not wait for queued
+    kernels, so pass `sync_timing=True` to synchronize at every stage boundary
+    and attribute the time exactly, at some cost to throughput.
+
+    An optional torch.profiler trace covers the global steps [start, end) of
+    `profile_steps` and is written as a Chrome trace next to the metrics file.
+
+    Every record carries the run's `settings`, such as the batch size and
+    resize policy, so throughput and memory can be compared across runs.
+    """
+    def __init__(self, metrics_path=None, device='cpu', log_every=10, sync_timing=False, profile_steps=None, settings=None):
+        self._metrics_path = Path(metrics_path) if metrics_path else None
+        self._device = torch.device(device)
+        self._log_every = log_every
+        self._sync_timing = sync_timing and self._device.type != 'cpu'
+        self._profile_steps = profile_steps
+        self._profiler = None
+        self._settings = settings or {}
+        self.global_step = 0
+
+    def start_epoch(self, epoch):
+        self._epoch = epoch
+        self._epoch_start = time.perf_counter()
+        self._epoch_totals = dict.fromkeys(TRAINING_STAGES, 0.0)
+        self._epoch_loss = torch.zeros((), device=self._device)
+        self._epoch_steps = 0
+        self._epoch_images = 0
+        self._start_interval()
+
+    def iterate(self, dataloader):
+        """
+        Yields the batches of a DataLoader, timing how long each one was waited on.
+        """
+        iterator = iter(dataloader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self._add_time('data_wait', time.perf_counter() - start)
+            yield batch
+
+    @contextmanager
+    def stage(self, name):
+        self._synchronize()
+        start = time.perf_counter()
+        yield
+        self._synchronize()
+        self._add_time(name, time.perf_counter() - start)
+
+    def step(self, batch_size, loss, learning_rate=None):
+        """
+        Records a finished step.
+
+        Args:
+            batch_size: The number of images in the step.
+            loss: The loss tensor of the step; it is not synchronized here.
+            learning_rate: The learning rate after the step, for the metrics record.
+
+        Returns:
+            The metrics record when this step was logged, otherwise None.
+        """
+        detached_loss = loss.detach().float()
+        self._interval_loss += detached_loss
+        self._epoch_loss += detached_loss
+        self._interval_steps += 1
+        self._interval_images += batch_size
+        self._epoch_steps += 1
+        self._epoch_images += batch_size
+        self.global_step += 1
+        self._step_profiler()
+
+        if self._interval_steps < self._log_every:
+            return None
+        return self._log_interval(learning_rate)
+
+    def end_epoch(self, learning_rate=None):
+        """
+        Logs the last partial interval and an epoch summary record.
+
+        Returns:
+            The epoch summary record.
+        """
+        if self._interval_steps:
+            self._log_interval(learning_rate)
+        epoch_time = time.perf_counter() - self._epoch_start
+        record = {
+            'type': 'epoch',
+            'epoch': self._epoch,
+            'steps': self._epoch_steps,
+            'images': self._epoch_images,
+            'time': epoch_time,
+            'images_per_sec': self._epoch_images / epoch_time if epoch_time else 0.0,
+            'avg_loss': self._epoch_loss.item() / max(self._epoch_steps, 1),
+            'stages': self._epoch_totals,
+            **get_memory_usage(self._device),
+        }
+        self._write(record)
+        return record
+
+    def close(self):
+        if self._profiler:
+            self._stop_profiler()
+
+    def _start_interval(self):
+        self._interval_start = time.perf_counter()
+        self._interval_totals = dict.fromkeys(TRAINING_STAGES, 0.0)
+        self._interval_loss = torch.zeros((), device=self._device)
+        self._interval_steps = 0
+        self._interval_images = 0
+
+    def _log_interval(self, learning_rate):
+        # The only place the loss is synchronized
+        interval_time = time.perf_counter() - self._interval_start
+        record = {
+            'type': 'interval',
+            'epoch': self._epoch,
+            'step': self.global_step,
+            'images': self._interval_images,
+            'time': interval_time,
+            'images_per_sec': self._interval_images / interval_time if interval_time else 0.0,
+            'avg_loss': self._interval_loss.item() / self._interval_steps,
+            'learning_rate': learning_rate,
+            'stages': self._interval_totals,
+            **get_memory_usage(self._device),
+        }
+        self._write(record)
+        self._start_interval()
+        return record
+
+    def _add_time(self, name, seconds):
+        self._interval_totals[name] = self._interval_totals.get(name, 0.0) + seconds
+        self._epoch_totals[name] = self._epoch_totals.get(name, 0.0) + seconds
+
+    def _synchronize(self):
+        if self._sync_timing:
+            getattr(torch, self._device.type).synchronize()
+
+    def _step_profiler(self):
+        if not self._profile_steps:
+            return
+        start, end = self._profile_steps
+        if self._profiler is None and start <= self.global_step < end:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self._device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self._profiler.__enter__()
+        elif self._profiler is not None:
+            self._profiler.step()
+            if self.global_step >= end:
+                self._stop_profiler()
+
+    def _stop_profiler(self):
+        start, end = self._profile_steps
+        self._profiler.__exit__(None, None, None)
+        if self._metrics_path:
+            self._profiler.export_chrome_trace(str(self._metrics_path.parent/f"trace-steps-{start}-{end}.json"))
+        self._profiler = None
+        self._profile_steps = None
+
+    def _write(self, record):
+        record['settings'] = self._settings
+        if self._metrics_path:
+            with open(self._metrics_path, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+
+def get_memory_usage(device):
+    """
+    Returns the peak resident set size of this process and the accelerator memory, in MB.
+    """
+    usage = {}
+    if resource:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage['peak_rss_mb'] = max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    if device.type == 'cuda':
+        usage['accelerator_peak_mb'] = torch.cuda.max_memory_allocated(device) / 2**20
+    elif device.type == 'mps':
+        usage['accelerator_allocated_mb'] = torch.mps.driver_allocated_memory() / 2**20
+    return usage
+
+def parse_step_range(value):
+    # Parses "START:END" into a (start, end) tuple of global steps
+    start, end = value.split(':')
+    return int(start), int(end)
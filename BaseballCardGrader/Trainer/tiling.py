@@ -0,0 +1,317 @@
+from pathlib import Path
+import argparse
+import json
+import math
+import random
+import statistics
+import time
+
+import numpy as np
+import torch
+import torchvision.transforms.v2 as transforms
+import torchvision.transforms.v2.functional as TF
+from torchvision.models.detection.transform import resize_boxes
+from torchvision.ops import masks_to_boxes
+from torchvision.tv_tensors import BoundingBoxes, Mask
+
+# Import the batched mask post-processing
+from postprocessing import detect, paste_masks, masks_to_rle, coverage_map, postprocess_detections
+
+# Import the detection metrics
+from evaluation import DetectionEvaluator, pack_masks, packed_mask_iou
+
+# Tiles are cut at the size the model is trained on, so they reach it without resizing
+TILE_SIZE = (1120, 800)
+
+# Ground truth size buckets of the benchmark, as the largest fraction of the image area in each
+SIZE_BUCKETS = {'small': 0.001, 'medium': 0.01, 'large': 1.0}
+
+def get_tile_starts(length, tile_length, overlap=0.2):
+    """
+    Returns the start of every tile along one axis.
+
+    Tiles overlap by at least `overlap` of their length and are spread evenly,
+    so the first starts at 0 and the last ends at the image edge.
+    """
+    if length <= tile_length:
+        return [0]
+    stride = tile_length * (1 - overlap)
+    count = math.ceil((length - tile_length) / stride) + 1
+    return [round(i * (length - tile_length) / (count - 1)) for i in range(count)]
+
+def get_tiles(image_size, tile_size=TILE_SIZE, overlap=0.2):
+    """
+    Covers an image with overlapping tiles.
+
+    Args:
+        image_size: The (height, width) of the image.
+        tile_size: The (height, width) of a tile. Tiles are clipped to smaller images.
+        overlap: The least overlap of neighbouring tiles, as a fraction of the tile size.
+
+    Returns:
+        A list of (top, left, bottom, right) tiles in row-major order.
+    """
+    height, width = image_size
+    tile_height, tile_width = min(tile_size[0], height), min(tile_size[1], width)
+    return [(top, left, top + tile_height, left + tile_width)
+            for top in get_tile_starts(height, tile_height, overlap)
+            for left in get_tile_starts(width, tile_width, overlap)]
+
+def group_tile_detections(boxes, labels, tile_ids, merge_threshold=0.5):
+    """
+    Groups the score-sorted detections of overlapping tiles into objects.
+
+    Each detection joins the best-scoring group of its label whose box overlaps
+    its own by at least merge_threshold of the smaller box, and that holds no
+    detection of the same tile. Overlap of the smaller box, rather than IoU,
+    also joins a cut-off piece to the whole object seen by the next tile.
+    Detections of one tile were already separated by the model's own NMS.
+
+    Returns:
+        A tuple of the (N,) group index of every detection and the (G, 4) union
+        box of every group.
+    """
+    groups = torch.zeros(len(boxes), dtype=torch.int64)
+    group_boxes = boxes.new_zeros((0, 4))
+    group_labels = labels.new_zeros(0)
+    group_tiles = torch.zeros((0, int(tile_ids.max()) + 1 if len(tile_ids) else 0), dtype=torch.bool)
+    for i, (box, label, tile_id) in enumerate(zip(boxes, labels, tile_ids)):
+        top_left = torch.maximum(group_boxes[:, :2], box[:2])
+        bottom_right = torch.minimum(group_boxes[:, 2:], box[2:])
+        intersections = (bottom_right - top_left).clamp(min=0).prod(dim=1)
+        group_areas = (group_boxes[:, 2:] - group_boxes[:, :2]).prod(dim=1)
+        box_area = (box[2:] - box[:2]).prod()
+        overlaps = intersections / torch.minimum(group_areas, box_area).clamp(min=1e-9)
+        candidates = (overlaps >= merge_threshold) & (group_labels == label) & ~group_tiles[:, tile_id]
+        if candidates.any():
+            # Groups are in score order, so the first candidate is the best-scoring one
+            group = int(candidates.nonzero()[0])
+            group_boxes[group, :2] = torch.minimum(group_boxes[group, :2], box[:2])
+            group_boxes[group, 2:] = torch.maximum(group_boxes[group, 2:], box[2:])
+        else:
+            group = len(group_boxes)
+            group_boxes = torch.cat([group_boxes, box[None]])
+            group_labels = torch.cat([group_labels, label[None]])
+            group_tiles = torch.cat([group_tiles, torch.zeros((1, group_tiles.shape[1]), dtype=torch.bool)])
+        group_tiles[group, tile_id] = True
+        groups[i] = group
+    return groups, group_boxes
+
+def detect_tiled(model, image, tile_size=TILE_SIZE, overlap=0.2, batch_size=4, score_threshold=0.5, mask_threshold=0.5,
+                 merge_threshold=0.5, max_chunk_bytes=64 * 1024 * 1024):
+    """
+    Detects defects on a full-resolution image with overlapping tiles.
+
+    Tiles run through the model in batches without being resized. The
+    detections of all tiles are moved to image coordinates, grouped across
+    tiles with group_tile_detections, and the masks of every group are pasted
+    at full resolution and joined, so an object cut by a tile edge comes out
+    whole. Only one chunk of pasted masks exists at a time besides the result.
+
+    Args:
+        model: A Mask R-CNN model in eval mode.
+        image: A (3, H, W) float image tensor at full resolution.
+        tile_size: The (height, width) of a tile.
+        overlap: The least overlap of neighbouring tiles, as a fraction of the tile size.
+        batch_size: The number of tiles per forward pass.
+
+    Returns:
+        A dictionary like that of postprocess_detections, at the image's full
+        resolution, with the best score of every group.
+    """
+    height, width = image.shape[-2:]
+    tiles = get_tiles((height, width), tile_size, overlap)
+    boxes, labels, scores, mask_probs, tile_ids = [], [], [], [], []
+    for start in range(0, len(tiles), batch_size):
+        batch = tiles[start:start + batch_size]
+        detections = detect(model, [image[:, top:bottom, left:right] for top, left, bottom, right in batch])
+        for tile_id, (top, left, _, _), detection in zip(range(start, start + len(batch)), batch, detections):
+            keep = detection['scores'] > score_threshold
+            boxes.append(detection['boxes'][keep] + detection['boxes'].new_tensor([left, top, left, top]))
+            labels.append(detection['labels'][keep])
+            scores.append(detection['scores'][keep])
+            mask_probs.append(detection['mask_probs'][keep])
+            tile_ids.append(torch.full((int(keep.sum()),), tile_id, dtype=torch.int64))
+
+    # Group the detections of all tiles in score order
+    scores, order = torch.cat(scores).sort(descending=True)
+    boxes, labels, mask_probs = torch.cat(boxes)[order], torch.cat(labels)[order], torch.cat(mask_probs)[order]
+    groups, group_boxes = group_tile_detections(boxes.cpu(), labels.cpu(), torch.cat(tile_ids)[order.cpu()], merge_threshold)
+    first = torch.full((len(group_boxes),), len(groups), dtype=torch.int64).scatter_reduce(0, groups, torch.arange(len(groups)), 'amin')
+
+    # Paste the masks of every group member in chunks and join them into their group's mask
+    masks = torch.zeros((len(group_boxes), height, width), dtype=torch.bool, device=image.device)
+    groups = groups.to(image.device)
+    chunk = max(1, max_chunk_bytes // (height * width))
+    for start in range(0, len(groups), chunk):
+        pasted = paste_masks(mask_probs[start:start + chunk], boxes[start:start + chunk], (height, width), mask_threshold)
+        for member, group in zip(pasted, groups[start:start + chunk].tolist()):
+            masks[group] |= member
+
+    group_labels = labels[first.to(labels.device)]
+    return {
+        'boxes': group_boxes.to(image.device),
+        'labels': group_labels,
+        'scores': scores[first.to(scores.device)],
+        'masks': masks,
+        'rles': masks_to_rle(masks),
+        'coverage_map': coverage_map(masks, group_labels, (height, width)),
+    }
+
+class PolygonCrop:
+    """
+    Crops a full-resolution training image to one tile around an annotated polygon.
+
+    The tile is placed at random so it holds a random instance whole, or lies
+    within the instance when it is larger than a tile. With probability
+    background_probability, and for images without instances, the tile is
+    placed anywhere. Without jitter the tile is centered on the largest
+    instance, for validation. Boxes are recomputed from the cropped masks, so
+    instances cut by the tile keep tight boxes, and instances outside it are
+    left for SanitizeBoundingBoxes to drop.
+
+    Takes and returns the (image, target) pair of BaseballCardDataset.
+    """
+    def __init__(self, tile_size=TILE_SIZE, background_probability=0.1, jitter=True):
+        self.tile_size = tile_size
+        self.background_probability = background_probability
+        self.jitter = jitter
+
+    def __call__(self, image, target):
+        height, width = TF.get_size(image)
+        tile_height, tile_width = min(self.tile_size[0], height), min(self.tile_size[1], width)
+        boxes = target['boxes']
+        if len(boxes) and (not self.jitter or random.random() >= self.background_probability):
+            index = random.randrange(len(boxes)) if self.jitter else int((boxes[:, 2:] - boxes[:, :2]).prod(dim=1).argmax())
+            x1, y1, x2, y2 = boxes[index].tolist()
+            top = self._get_start(y1, y2, tile_height, height)
+            left = self._get_start(x1, x2, tile_width, width)
+        else:
+            top = random.randint(0, height - tile_height) if self.jitter else (height - tile_height) // 2
+            left = random.randint(0, width - tile_width) if self.jitter else (width - tile_width) // 2
+
+        image = TF.crop(image, top, left, tile_height, tile_width)
+        masks = Mask(TF.crop(target['masks'], top, left, tile_height, tile_width))
+        boxes = BoundingBoxes(masks_to_boxes(masks), format='xyxy', canvas_size=(tile_height, tile_width))
+        return image, {**target, 'masks': masks, 'boxes': boxes}
+
+    def _get_start(self, low, high, tile_length, length):
+        # The starts that keep [low, high] inside the tile, or the tile inside [low, high] when it is longer
+        first, last = sorted((high - tile_length, low))
+        first, last = min(max(first, 0), length - tile_length), min(max(last, 0), length - tile_length)
+        return int(random.uniform(first, last) if self.jitter else (first + last) / 2)
+
+def detect_resized(model, image, image_size, score_threshold=0.5, mask_threshold=0.5):
+    """
+    Detects defects the way the app does, on the whole image stretched to image_size.
+
+    Returns:
+        A dictionary like that of postprocess_detections, with the boxes and
+        masks brought back to the image's full resolution.
+    """
+    original_size = tuple(image.shape[-2:])
+    resized = TF.resize(image, list(image_size), antialias=True)
+    detections = detect(model, [resized])[0]
+    detections['boxes'] = resize_boxes(detections['boxes'], tuple(image_size), original_size)
+    return postprocess_detections(detections, original_size, score_threshold, mask_threshold)
+
+def count_recalled_by_size(detections, target, iou_threshold=0.5, size_buckets=SIZE_BUCKETS):
+    """
+    Counts the ground truth instances of each size bucket that a detection of their label covers.
+
+    Returns:
+        A dictionary of bucket names to [recalled, total] counts.
+    """
+    image_area = target['masks'].shape[-2] * target['masks'].shape[-1]
+    pred_bits, pred_areas = pack_masks(detections['masks'])
+    gt_bits, gt_areas = pack_masks(target['masks'].bool())
+    ious = packed_mask_iou(pred_bits, pred_areas, gt_bits, gt_areas)
+    same_label = detections['labels'].cpu().numpy()[:, None] == target['labels'].cpu().numpy()[None, :]
+    recalled = ((ious >= iou_threshold) & same_label).any(axis=0)
+    # Bucket of every ground truth instance, by the first bound its area fits under
+    buckets = np.searchsorted(np.array(list(size_buckets.values())) * image_area, gt_areas)
+    return {name: [int(recalled[buckets == i].sum()), int((buckets == i).sum())] for i, name in enumerate(size_buckets)}
+
+def benchmark_tiling(model, dataset, class_names, image_size, tile_size=TILE_SIZE, overlap=0.2, batch_size=4, score_threshold=0.5):
+    """
+    Compares tiled inference with the global-resize baseline on full-resolution images.
+
+    Args:
+        model: A Mask R-CNN model in eval mode.
+        dataset: A dataset of full-resolution (image, target) pairs.
+        class_names: The class names, starting with 'background'.
+        image_size: The (height, width) the baseline stretches images to.
+
+    Returns:
+        A dictionary with, for the baseline and tiled modes, the median latency
+        per image, the mask and box mAP, the per-class metrics and the recall
+        of every size bucket.
+    """
+    modes = {
+        'resize': lambda image: detect_resized(model, image, image_size, score_threshold),
+        'tiled': lambda image: detect_tiled(model, image, tile_size, overlap, batch_size, score_threshold),
+    }
+    evaluators = {mode: DetectionEvaluator(class_names, score_threshold) for mode in modes}
+    latencies = {mode: [] for mode in modes}
+    recall_counts = {mode: {name: [0, 0] for name in SIZE_BUCKETS} for mode in modes}
+    with torch.inference_mode():
+        for image, target in dataset:
+            for mode, run in modes.items():
+                start = time.perf_counter()
+                detections = run(image)
+                latencies[mode].append((time.perf_counter() - start) * 1000)
+                evaluators[mode].update({**detections, 'masks': detections['masks'][:, None]}, target)
+                for name, (recalled, total) in count_recalled_by_size(detections, target).items():
+                    recall_counts[mode][name][0] += recalled
+                    recall_counts[mode][name][1] += total
+
+    report = {'images': len(latencies['tiled']), 'tile_size': list(tile_size), 'overlap': overlap, 'image_size': list(image_size), 'modes': {}}
+    for mode in modes:
+        metrics = evaluators[mode].compute()
+        report['modes'][mode] = {
+            'latency_ms': statistics.median(latencies[mode]) if latencies[mode] else None,
+            'segm_map': metrics['segm_map'],
+            'bbox_map': metrics['bbox_map'],
+            'per_class': metrics['per_class'],
+            'recall_by_size': {name: recalled / total if total else None for name, (recalled, total) in recall_counts[mode].items()},
+        }
+    return report
+
+if __name__ == "__main__":
+    # Imported here so the inference helpers do not pull in the trainer
+    from train_model import BaseballCardDataset, load_dataset_annotations
+    from model_bundle import load_model, find_checkpoint, get_torch_device
+
+    parser = argparse.ArgumentParser(description="Benchmark tiled full-resolution inference against the global-resize baseline")
+    parser.add_argument("checkpoint_directory", type=Path, help="Path to the model checkpoint")
+    parser.add_argument("dataset_directory", type=Path, help="Path to the full-resolution images and annotations")
+    parser.add_argument("--tile-size", type=int, nargs=2, default=list(TILE_SIZE), metavar=("HEIGHT", "WIDTH"), help="Tile size in pixels")
+    parser.add_argument("--overlap", type=float, default=0.2, help="Least overlap of neighbouring tiles, as a fraction of the tile size")
+    parser.add_argument("--batch-size", type=int, default=4, help="Tiles per forward pass")
+    parser.add_argument("--max-images", type=int, default=None, help="Maximum number of images to benchmark")
+    parser.add_argument("--device", default=None, help="Device to run the model on (default: the fastest available)")
+    parser.add_argument("--output", type=Path, default=None, help="Path of the JSON report (default: <checkpoint>/<model>-tiling-report.json)")
+    args = parser.parse_args()
+
+    checkpoint_path = find_checkpoint(args.checkpoint_directory)
+    device = args.device or get_torch_device()
+    model, bundle = load_model(checkpoint_path, device)
+    class_names = bundle['class_names']
+
+    # Full-resolution images of the annotated classes the model knows
+    image_dict, annotation_index, _ = load_dataset_annotations(args.dataset_directory)
+    image_keys = sorted(key for key in image_dict if key in annotation_index)[:args.max_images]
+    to_input = transforms.Compose([transforms.ToImage(), transforms.ToDtype(torch.float32, scale=True)])
+    class_to_idx = {c: i for i, c in enumerate(class_names)}
+    dataset = BaseballCardDataset(image_keys, annotation_index, image_dict, class_to_idx, to_input)
+    dataset = ((image.to(device), target) for image, target in dataset)
+
+    report = benchmark_tiling(model, dataset, class_names, bundle['preprocessing']['image_size'], tuple(args.tile_size), args.overlap, args.batch_size)
+    report_path = args.output or checkpoint_path.with_name(f"{checkpoint_path.stem}-tiling-report.json")
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    for mode, result in report['modes'].items():
+        recall = ', '.join(f"{name} {value:.3f}" for name, value in result['recall_by_size'].items() if value is not None)
+        print(f"{mode}: {result['latency_ms']:.0f} ms per image, mask mAP {result['segm_map']:.3f}, box mAP {result['bbox_map']:.3f}, recall {recall or 'n/a'}")
+    print(f"Wrote the report to {report_path}")
@@ -1,23 +1,31 @@
 from pathlib import Path
-import pandas as pd
+import argparse
 import random
 import math
 import json
-import sys
+import os
+import multiprocessing
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 from tqdm.auto import tqdm
 
 # Used to create unique colors for each class
 from distinctipy import distinctipy
 
+import numpy as np
+
 # Import PIL for image manipulation
 from PIL import Image, ImageDraw
 
 # Import PyTorch dependencies
 import torch
 from torch.amp import autocast
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 import torchvision
 torchvision.disable_beta_transforms_warning()
+from torchvision import tv_tensors
 from torchvision.tv_tensors import BoundingBoxes, Mask
 import torchvision.transforms.v2 as transforms
 
@@ -26,15 +34,48 @@ from torchvision.models.detection import maskrcnn_resnet50_fpn_v2
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
 
+# Import the flat annotation index
+from annotation_index import AnnotationIndex
+
+# Import the on-disk image and mask caches
+from dataset_cache import MaskCache, TrainingShard
+
+# Import the self-contained model checkpoint format
+from model_bundle import make_bundle, get_preprocessing, load_bundle, get_torch_device
+
+# Import the background checkpoint writer
+from checkpointing import CheckpointWriter, get_rng_state, set_rng_state, load_training_state
+
+# Import the detection metrics
+from evaluation import evaluate, evaluate_checkpoint, append_metrics
+
+# Import the training loop instrumentation
+from telemetry import TrainingTelemetry, parse_step_range
+
+# Import the resize policies and aspect ratio grouped batching
+from batching import RESIZE_POLICIES, get_resize_transform, set_model_resize_bounds, get_aspect_ratio_groups, GroupedBatchSampler
+
+# Import the backbone feature cache of head-only fine-tuning
+from feature_cache import FeatureCache, CachedFeatureDataset, CachedFeatureHeads, get_backbone_hash
+
+# Import the training augmentation pipelines
+from augmentation import AUGMENTATION_PIPELINES, get_augmentation_transforms, get_collate_fns
+
+# Import the helpers for multi-process training launched by torchrun
+from distributed import (init_distributed, cleanup_distributed, is_distributed, is_main_process, barrier, all_reduce_mean,
+                         broadcast_object, unwrap_model, get_local_rank, get_local_world_size, get_world_size, ShardSampler)
+
 class BaseballCardDataset(Dataset):
-    def __init__(self, img_keys, annotation_df, img_dict, class_to_idx, transforms=None):
+    def __init__(self, img_keys, annotation_index, img_dict, class_to_idx, transforms=None, mask_cache=None, shard=None):
         super(Dataset, self).__init__()
         
         self._img_keys = img_keys  # List of image keys
-        self._annotation_df = annotation_df  # DataFrame containing annotations
+        self._annotation_index = annotation_index  # Index of the annotations of every image
         self._img_dict = img_dict  # Dictionary mapping image keys to image paths
         self._class_to_idx = class_to_idx  # Dictionary mapping class names to class indices
         self._transforms = transforms  # Image transforms to be applied
+        self._mask_cache = mask_cache  # Optional cache of decoded images and masks
+        self._shard = shard  # Optional pre-resized training shard, takes precedence over the cache
         
     def __len__(self):
         return len(self._img_keys)
@@ -42,10 +83,12 @@ class BaseballCardDataset(Dataset):
     def __getitem__(self, index):
         # Retrieve the key for the image at the specified index
         img_key = self._img_keys[index]
-        # Get the annotations for this image
-        annotation = self._annotation_df.loc[img_key]
-        # Load the image and its target (segmentation masks, bounding boxes and labels)
-        image, target = self._load_image_and_target(annotation)
+        if self._shard:
+            # Read the pre-resized image and target straight from the shard
+            image, target = self._load_image_and_target_from_shard(img_key)
+        else:
+            # Load the image and its target (segmentation masks, bounding boxes and labels)
+            image, target = self._load_image_and_target(img_key)
         
         # Apply the transformations, if any
         if self._transforms:
@@ -53,46 +96,192 @@ class BaseballCardDataset(Dataset):
         
         return image, target
 
-    def _load_image_and_target(self, annotation):
+    def _load_image_and_target(self, img_key):
         # Retrieve the file path of the image
-        filepath = self._img_dict[annotation.name]
-        # Open the image file and convert it to RGB
-        image = Image.open(filepath).convert('RGB')
+        filepath = self._img_dict[img_key]
         
         # Convert the class labels to indices
-        labels = [shape['label'] for shape in annotation['shapes']]
-        labels = torch.Tensor([self._class_to_idx[label] for label in labels])
-        labels = labels.to(dtype=torch.int64)
-
-        # Convert polygons to mask images
-        shape_points = [shape['points'] for shape in annotation['shapes']]
-        xy_coords = [[tuple(p) for p in points] for points in shape_points]
-        mask_imgs = [create_polygon_mask(image.size, xy) for xy in xy_coords]
-        masks = Mask(torch.concat([Mask(transforms.PILToTensor()(mask_img), dtype=torch.bool) for mask_img in mask_imgs]))
+        labels = self._annotation_index.get_labels(img_key)
+        labels = torch.tensor([self._class_to_idx[label] for label in labels], dtype=torch.int64)
+
+        if self._mask_cache:
+            # Load the decoded image and the pre-rasterized masks from the cache
+            image_array, mask_array = self._mask_cache.load(filepath, self._annotation_index.get_shapes(img_key))
+            image = Image.fromarray(np.ascontiguousarray(image_array))
+            masks = Mask(torch.from_numpy(np.ascontiguousarray(mask_array)))
+        else:
+            # Open the image file and convert it to RGB
+            image = Image.open(filepath).convert('RGB')
+
+            # Convert polygons to mask images
+            shape_points = self._annotation_index.get_polygons(img_key)
+            xy_coords = [[tuple(p) for p in points.tolist()] for points in shape_points]
+            mask_imgs = [create_polygon_mask(image.size, xy) for xy in xy_coords]
+            masks = Mask(torch.concat([Mask(transforms.PILToTensor()(mask_img), dtype=torch.bool) for mask_img in mask_imgs]))
 
         # Generate bounding box annotations from segmentation masks
         bboxes = BoundingBoxes(data=torchvision.ops.masks_to_boxes(masks), format='xyxy', canvas_size=image.size[::-1])
                 
         return image, {'masks': masks,'boxes': bboxes, 'labels': labels}
 
+    def _load_image_and_target_from_shard(self, img_key):
+        image_array, mask_array, box_array, label_array = self._shard.get(img_key)
+        height, width = image_array.shape[:2]
+
+        # Wrap the memory-mapped image without copying it
+        image = tv_tensors.Image(torch.from_numpy(image_array).permute(2, 0, 1))
+        masks = Mask(torch.from_numpy(np.ascontiguousarray(mask_array)))
+        bboxes = BoundingBoxes(data=torch.from_numpy(box_array), format='xyxy', canvas_size=(height, width))
+
+        # Map the shard's label indices onto this run's class indices
+        shard_labels = [self._shard.class_names[label] for label in label_array]
+        labels = torch.tensor([self._class_to_idx[label] for label in shard_labels], dtype=torch.int64)
+
+        return image, {'masks': masks,'boxes': bboxes, 'labels': labels}
+
+def create_model(num_classes, weights='DEFAULT'):
+    """
+    Builds a Mask R-CNN with box and mask predictors for the given number of classes.
+    
+    Args:
+        num_classes: The number of classes, including 'background'.
+        weights: The torchvision weights to start from, or None when a checkpoint
+            replaces every weight anyway.
+    
+    Returns:
+        The model, on the CPU.
+    """
+    model = maskrcnn_resnet50_fpn_v2(weights=weights, weights_backbone=None)
+    # torchvision makes every backbone layer trainable when no weights are given, so freeze conv1 and layer1 as
+    # it does for pretrained weights, and a run started from a checkpoint trains the same parameters as one from COCO
+    for name, parameter in model.backbone.body.named_parameters():
+        if not name.startswith(('layer2', 'layer3', 'layer4')):
+            parameter.requires_grad_(False)
+    in_features_box = model.roi_heads.box_predictor.cls_score.in_features
+    in_features_mask = model.roi_heads.mask_predictor.conv5_mask.in_channels
+    dim_reduced = model.roi_heads.mask_predictor.conv5_mask.out_channels
+    model.roi_heads.box_predictor = FastRCNNPredictor(in_channels=in_features_box, num_classes=num_classes)
+    model.roi_heads.mask_predictor = MaskRCNNPredictor(in_channels=in_features_mask, dim_reduced=dim_reduced, num_classes=num_classes)
+    return model
+
+def load_initial_weights(model, checkpoint_path, class_names):
+    """
+    Starts a model from the weights of a checkpoint bundle, such as a model
+    trained before new classes were labeled.
+
+    Predictor weights of classes the bundle knows are copied into the rows of
+    the same class, and the rows of new classes keep their fresh initialization.
+    
+    Args:
+        model: A model from create_model.
+        checkpoint_path: The path of the checkpoint bundle.
+        class_names: The class names of the model, starting with 'background'.
+    
+    Returns:
+        The class names that were not in the bundle.
+    """
+    bundle = load_bundle(checkpoint_path)
+    bundle_classes = bundle['class_names']
+    model_state = model.state_dict()
+    state_dict = {}
+    for name, tensor in bundle['state_dict'].items():
+        if model_state[name].shape == tensor.shape and bundle_classes == class_names:
+            state_dict[name] = tensor
+        elif name.startswith(('roi_heads.box_predictor.', 'roi_heads.mask_predictor.mask_fcn_logits.')):
+            # Predictor outputs are grouped by class, with one row per class or four for box regression
+            rows = tensor.shape[0] // len(bundle_classes)
+            state_dict[name] = model_state[name].clone()
+            for i, class_name in enumerate(class_names):
+                if class_name in bundle_classes:
+                    j = bundle_classes.index(class_name)
+                    state_dict[name][i * rows:(i + 1) * rows] = tensor[j * rows:(j + 1) * rows]
+        else:
+            state_dict[name] = tensor
+    model.load_state_dict(state_dict)
+    return [class_name for class_name in class_names if class_name not in bundle_classes]
+
+def load_dataset_annotations(dataset_directory):
+    """
+    Loads the images and labelme annotations of a dataset directory.
+    
+    Args:
+        dataset_directory: Path to the directory of images and annotation files.
+    
+    Returns:
+        A tuple of the image key to path dictionary, the AnnotationIndex and the
+        class names, starting with 'background'.
+    """
+    # Gets all image file paths in the dataset directory
+    image_file_paths = list(dataset_directory.glob("*.png"))
+    image_dict = {file.stem : file for file in image_file_paths}
+
+    # Builds the flat index from the annotation manifest, parsing only the annotation files added or changed since it was written
+    annotation_index = AnnotationIndex.from_manifest(dataset_directory)
+
+    # Gets unique list of classes, in this case just one, and adds 'background' class
+    class_names = ['background'] + annotation_index.label_names
+
+    return image_dict, annotation_index, class_names
+
 def create_polygon_mask(image_size, vertices):
     mask_image = Image.new('L', image_size, 0)
     ImageDraw.Draw(mask_image, 'L').polygon(vertices, fill=(255))
     return mask_image
 
-def get_torch_device():
-    if torch.cuda.is_available():
-        return "cuda"
-    elif torch.backends.mps.is_available():
-        return "mps"
-    else:
-        return "cpu"
-
 def tensor_to_pil(tensor):
     transform = transforms.ToPILImage()
     img = transform(tensor)
     return img
 
+def get_available_cores():
+    # Respect CPU affinity masks and container limits where the platform exposes them
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def get_data_loader_params(device, batch_size=4, num_workers=None, prefetch_factor=2, processes_per_node=1):
+    """
+    Builds the DataLoader parameters for a device.
+    
+    Args:
+        device: The device name returned by get_torch_device.
+        batch_size: The number of samples per batch.
+        num_workers: The number of loader processes. When None, half of the
+            available cores are used on CPU and MPS, and 4 on CUDA.
+        prefetch_factor: The number of batches each worker loads ahead.
+        processes_per_node: The number of training processes sharing this
+            machine's cores, which split the default CPU and MPS workers.
+    
+    Returns:
+        A dictionary of keyword arguments for DataLoader.
+    """
+    device_type = torch.device(device).type
+    if num_workers is None:
+        num_workers = 4 if device_type == "cuda" else min(8, get_available_cores() // 2 // processes_per_node)
+
+    data_loader_params = {
+        'batch_size': batch_size,
+        'num_workers': num_workers,
+        'collate_fn': custom_collate_fn,
+    }
+    if num_workers > 0:
+        data_loader_params.update(persistent_workers=True, prefetch_factor=prefetch_factor)
+    if device_type == "cuda":
+        data_loader_params.update(pin_memory=True, pin_memory_device=str(device))
+    return data_loader_params
+
+def set_torch_threads(num_workers, num_threads=None, processes_per_node=1):
+    """
+    Pins the intra-op thread count of the training process.
+    
+    DataLoader workers already run single-threaded, so by default the training
+    processes on this machine share the cores that are not taken by workers.
+    """
+    if num_threads is None:
+        num_threads = max(1, (get_available_cores() - num_workers * processes_per_node) // processes_per_node)
+    torch.set_num_threads(num_threads)
+    return num_threads
+
 def custom_collate_fn(batch):
     return tuple(zip(*batch))
 
@@ -112,7 +301,7 @@ def move_data_to_device(data, device:torch.device):
     else:
         return data
 
-def run_epoch(model, dataloader, optimizer, lr_scheduler, device, scaler, epoch_id, is_training):
+def run_epoch(model, dataloader, optimizer, lr_scheduler, device, scaler, epoch_id, is_training, telemetry=None, accumulation_steps=1):
     """
     Function to run a single training or evaluation epoch.
     
@@ -124,6 +313,9 @@ def run_epoch(model, dataloader, optimizer, lr_scheduler, device, scaler, epoch_
         device: The device (CPU or GPU) to run the model on.
         scaler: Gradient scaler for mixed-precision training.
         is_training: Boolean flag indicating whether the model is in training or evaluation mode.
+        telemetry: The TrainingTelemetry that times the stages of every step and logs metrics.
+        accumulation_steps: The number of batches whose gradients are summed before each
+            optimizer step. The last step of an epoch may cover fewer batches.
     
     Returns:
         The average loss for the epoch.
@@ -131,63 +323,88 @@ def run_epoch(model, dataloader, optimizer, lr_scheduler, device, scaler, epoch_
     # Set the model to training mode
     model.train()
     
-    epoch_loss = 0  # Initialize the total loss for this epoch
-    progress_bar = tqdm(total=len(dataloader), desc="Train" if is_training else "Eval")  # Initialize a progress bar
+    # Without a metrics file the telemetry still times stages for the progress bar and summary
+    telemetry = telemetry or TrainingTelemetry(device=device)
+    telemetry.start_epoch(epoch_id)
+    progress_bar = tqdm(total=len(dataloader), desc="Train" if is_training else "Eval", disable=not is_main_process())  # Initialize a progress bar
     
     # Loop over the data
-    for batch_id, (inputs, targets) in enumerate(dataloader):
-        # Move inputs and targets to the specified device
-        inputs = torch.stack(inputs).to(device)
-        
-        # Forward pass with Automatic Mixed Precision (AMP) context manager
-        with autocast(torch.device(device).type):
-            if is_training:
-                losses = model(inputs.to(device), move_data_to_device(targets, device))
-            else:
-                with torch.no_grad():
-                    losses = model(inputs.to(device), move_data_to_device(targets, device))
+    for batch_id, (inputs, targets) in enumerate(telemetry.iterate(dataloader)):
+        # Move inputs and targets to the specified device. Images stay a list, since
+        # they can differ in size; the model pads each batch to its largest image
+        with telemetry.stage('copy'):
+            inputs = [image.to(device) for image in inputs]
+            targets = move_data_to_device(targets, device)
+
+        # Gradients of the batches in one accumulation group are summed, and only the last one steps the optimizer
+        group_start = batch_id - batch_id % accumulation_steps
+        group_size = min(accumulation_steps, len(dataloader) - group_start)
+        is_optimizer_step = batch_id + 1 == group_start + group_size
+        # DistributedDataParallel only needs to average gradients across ranks before an optimizer step
+        sync_context = model.no_sync() if is_training and not is_optimizer_step and isinstance(model, DistributedDataParallel) else nullcontext()
         
-            # Compute the loss
-            loss = sum([loss for loss in losses.values()])  # Sum up the losses
+        with sync_context:
+            # Forward pass with Automatic Mixed Precision (AMP) context manager
+            with telemetry.stage('forward'), torch.set_grad_enabled(is_training):
+                with autocast(torch.device(device).type):
+                    losses = model(inputs, targets)
+                
+                    # Compute the loss
+                    loss = sum([loss for loss in losses.values()])  # Sum up the losses
 
-        # If in training mode, backpropagate the error and update the weights
-        if is_training:
-            if scaler:
-                scaler.scale(loss).backward()
-                scaler.step(optimizer)
-                old_scaler = scaler.get_scale()
-                scaler.update()
-                new_scaler = scaler.get_scale()
-                if new_scaler >= old_scaler:
+            # If in training mode, backpropagate the error, scaled so the group's gradients average
+            if is_training:
+                with telemetry.stage('backward'):
+                    if scaler:
+                        scaler.scale(loss / group_size).backward()
+                    else:
+                        (loss / group_size).backward()
+
+        # Update the weights at the end of each accumulation group
+        if is_training and is_optimizer_step:
+            with telemetry.stage('optimizer'):
+                if scaler:
+                    scaler.step(optimizer)
+                    old_scaler = scaler.get_scale()
+                    scaler.update()
+                    new_scaler = scaler.get_scale()
+                    if new_scaler >= old_scaler:
+                        lr_scheduler.step()
+                else:
+                    optimizer.step()
                     lr_scheduler.step()
-            else:
-                loss.backward()
-                optimizer.step()
-                lr_scheduler.step()
-                
-            optimizer.zero_grad()
+                    
+                optimizer.zero_grad()
+
+        # Accumulate the loss on the device; it is only synchronized when a record is logged
+        record = telemetry.step(len(inputs), loss, lr_scheduler.get_last_lr()[0] if is_training else None)
+        progress_bar.update()
+        if record is None:
+            continue
 
-        # Update the total loss
-        loss_item = loss.item()
-        epoch_loss += loss_item
-        
         # Update the progress bar
-        progress_bar_dict = dict(loss=loss_item, avg_loss=epoch_loss/(batch_id+1))
+        progress_bar_dict = dict(avg_loss=record['avg_loss'], img_per_s=record['images_per_sec'], data_wait=record['stages']['data_wait'])
         if is_training:
-            progress_bar_dict.update(lr=lr_scheduler.get_last_lr()[0])
+            progress_bar_dict.update(lr=record['learning_rate'])
         progress_bar.set_postfix(progress_bar_dict)
-        progress_bar.update()
 
         # If loss is NaN or infinity, stop training
         if is_training:
-            stop_training_message = f"Loss is NaN or infinite at epoch {epoch_id}, batch {batch_id}. Stopping training."
-            assert not math.isnan(loss_item) and math.isfinite(loss_item), stop_training_message
+            stop_training_message = f"Loss is NaN or infinite at epoch {epoch_id}, in the steps logged at batch {batch_id}. Stopping training."
+            assert math.isfinite(record['avg_loss']), stop_training_message
 
     # Cleanup and close the progress bar 
     progress_bar.close()
+
+    # Report how the epoch split between waiting on data and the step stages
+    summary = telemetry.end_epoch(lr_scheduler.get_last_lr()[0] if is_training else None)
+    assert math.isfinite(summary['avg_loss']) or not is_training, f"Loss is NaN or infinite at epoch {epoch_id}. Stopping training."
+    stages = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in summary['stages'].items())
+    if is_main_process():
+        tqdm.write(f"{'Train' if is_training else 'Eval'} epoch {epoch_id}: {summary['images_per_sec']:.1f} img/s over {summary['time']:.1f}s ({stages})")
     
     # Return the average loss for this epoch
-    return epoch_loss / (batch_id + 1)
+    return summary['avg_loss']
 
 def train_loop(model, 
                train_dataloader, 
@@ -197,7 +414,19 @@ def train_loop(model,
                device, 
                epochs, 
                checkpoint_path, 
-               use_scaler=False):
+               use_scaler=False,
+               training_state_path=None,
+               checkpoint_every=1,
+               resume_state=None,
+               extra_state=None,
+               class_names=None,
+               eval_every=1,
+               eval_in_background=False,
+               eval_device='cpu',
+               telemetry=None,
+               accumulation_steps=1,
+               colors=None,
+               preprocessing=None):
     """
     Main training loop.
     
@@ -211,172 +440,344 @@ def train_loop(model,
         epochs: The number of epochs to train for.
         checkpoint_path: The path where to save the best model checkpoint.
         use_scaler: Whether to scale graidents when using a CUDA device
+        training_state_path: The path of the full training state checkpoint, or None to not write one.
+        checkpoint_every: The number of epochs between training state checkpoints.
+        resume_state: A training state loaded with load_training_state to continue from.
+        extra_state: Additional entries saved with the training state, such as the data split.
+        class_names: The class names, starting with 'background'.
+        eval_every: The number of epochs between validation runs.
+        eval_in_background: Whether to evaluate saved weights in a separate process
+            instead of pausing training.
+        eval_device: The device background evaluation runs on.
+        telemetry: The TrainingTelemetry that logs per-step metrics of the training epochs.
+        accumulation_steps: The number of batches accumulated into each optimizer step.
+        colors: The (r, g, b) color of every class, saved in the model checkpoint.
+        preprocessing: The preprocessing parameters from get_preprocessing, saved in the model checkpoint.
+    
+    The best model is saved as a checkpoint bundle holding its weights, head
+    config, classes, colors, preprocessing and training metadata.
+    
+    When the model is wrapped in DistributedDataParallel, every rank trains on
+    its shard of the data, losses are averaged across ranks, and only rank 0
+    writes checkpoints and metrics.
     
     Returns:
         None
     """
+    # The underlying model, for checkpoints and evaluation
+    base_model = unwrap_model(model)
+
     # Initialize a gradient scaler for mixed-precision training if the device is a CUDA GPU
     scaler = torch.amp.GradScaler() if device.type == 'cuda' and use_scaler else None
-    best_loss = float('inf')  # Initialize the best validation loss
-
-    # Loop over the epochs
-    for epoch in tqdm(range(epochs), desc="Epochs"):
-        # Run a training epoch and get the training loss
-        train_loss = run_epoch(model, train_dataloader, optimizer, lr_scheduler, device, scaler, epoch, is_training=True)
-        # Run an evaluation epoch and get the validation loss
-        with torch.no_grad():
-            valid_loss = run_epoch(model, valid_dataloader, None, None, device, scaler, epoch, is_training=False)
-
-        # If the validation loss is lower than the best validation loss seen so far, save the model checkpoint
-        if valid_loss < best_loss:
-            best_loss = valid_loss
-            torch.save(model.state_dict(), checkpoint_path)
-
-            # Save metadata about the training process
+    best_map = -1.0  # Initialize the best validation mask mAP
+    start_epoch = 0
+
+    # Restore the exact point in the schedule that the training state was saved at
+    if resume_state:
+        base_model.load_state_dict(resume_state['model'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        lr_scheduler.load_state_dict(resume_state['lr_scheduler'])
+        if scaler and resume_state['scaler']:
+            scaler.load_state_dict(resume_state['scaler'])
+        best_map = resume_state['best_map']
+        start_epoch = resume_state['epoch']
+        set_rng_state(resume_state['rng'])
+
+    # Checkpoints are written from a background thread so the GPU keeps training
+    checkpoint_writer = CheckpointWriter()
+
+    # Validation metrics of every evaluated epoch are appended next to the training metadata
+    metrics_path = checkpoint_path.parent/'eval_metrics.jsonl'
+    background_evaluations = deque()
+    eval_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) if eval_in_background and is_main_process() else None
+
+    def make_model_bundle(metadata=None):
+        return make_bundle(base_model, class_names, colors or [], preprocessing or get_preprocessing(base_model), metadata)
+
+    def record_evaluation(epoch, train_loss, learning_rate, metrics, weights_path=None):
+        nonlocal best_map
+        if not is_main_process():
+            return
+        # Validation runs in eval mode without the loss graph, so valid_loss stays in the records only as null for existing readers
+        append_metrics(metrics_path, {'epoch': epoch, 'train_loss': train_loss, 'valid_loss': None, 'learning_rate': learning_rate, **metrics})
+        tqdm.write(f"Eval epoch {epoch}: mask mAP {metrics['segm_map']:.3f} (@.5 {metrics['segm_map50']:.3f}), box mAP {metrics['bbox_map']:.3f}")
+
+        # If the mask mAP is higher than the best seen so far, keep these weights as the model checkpoint
+        if metrics['segm_map'] > best_map:
+            best_map = metrics['segm_map']
+
+            # Save metadata about the training process, in the checkpoint and beside it
             training_metadata = {
                 'epoch': epoch,
                 'train_loss': train_loss,
-                'valid_loss': valid_loss, 
-                'learning_rate': lr_scheduler.get_last_lr()[0],
-                'model_architecture': model.name
+                'valid_loss': None,
+                'valid_map': metrics['segm_map'],
+                'valid_bbox_map': metrics['bbox_map'],
+                'learning_rate': learning_rate,
+                'model_architecture': base_model.name
             }
+            if weights_path:
+                # The snapshot was saved before it was evaluated, so it gets the metadata now
+                bundle = load_bundle(weights_path)
+                bundle['metadata'] = training_metadata
+                checkpoint_writer.save(bundle, checkpoint_path)
+                del bundle
+                os.remove(weights_path)
+            else:
+                checkpoint_writer.save(make_model_bundle(training_metadata), checkpoint_path)
             with open(Path(checkpoint_path.parent/'training_metadata.json'), 'w') as f:
                 json.dump(training_metadata, f)
+        elif weights_path:
+            os.remove(weights_path)
+
+    def collect_background_evaluations(wait):
+        while background_evaluations and (wait or background_evaluations[0][-1].done()):
+            epoch, train_loss, learning_rate, weights_path, future = background_evaluations.popleft()
+            record_evaluation(epoch, train_loss, learning_rate, future.result(), weights_path)
+
+    # Loop over the epochs
+    for epoch in tqdm(range(start_epoch, epochs), desc="Epochs", initial=start_epoch, total=epochs, disable=not is_main_process()):
+        # Reshuffle the distributed shards differently every epoch
+        train_sampler = train_dataloader.batch_sampler.sampler
+        if isinstance(train_sampler, DistributedSampler):
+            train_sampler.set_epoch(epoch)
+
+        # Run a training epoch and get the training loss, averaged over all ranks
+        train_loss = run_epoch(model, train_dataloader, optimizer, lr_scheduler, device, scaler, epoch, is_training=True, telemetry=telemetry,
+                               accumulation_steps=accumulation_steps)
+        train_loss = all_reduce_mean(train_loss, device)
+        learning_rate = lr_scheduler.get_last_lr()[0]
+
+        # Evaluate the model in eval mode every few epochs and on the last one
+        if (epoch + 1) % eval_every == 0 or epoch + 1 == epochs:
+            if eval_executor:
+                # Hand a snapshot of the weights to the evaluation process and keep training
+                weights_path = checkpoint_path.with_name(f"{checkpoint_path.stem}-epoch{epoch}.pt")
+                checkpoint_writer.save(make_model_bundle(), weights_path)
+                checkpoint_writer.wait()
+                future = eval_executor.submit(evaluate_checkpoint, weights_path, valid_dataloader.dataset, class_names, eval_device,
+                                              valid_dataloader.batch_size, collate_fn=valid_dataloader.collate_fn)
+                background_evaluations.append((epoch, train_loss, learning_rate, weights_path, future))
+            elif not eval_in_background:
+                # Every rank evaluates its shard and the results are merged
+                metrics = evaluate(base_model, valid_dataloader, device, class_names)
+                record_evaluation(epoch, train_loss, learning_rate, metrics)
+        collect_background_evaluations(wait=False)
+
+        # Periodically save everything needed to resume from the next epoch
+        if training_state_path and is_main_process() and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == epochs):
+            training_state = {
+                'epoch': epoch + 1,
+                'model': base_model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'lr_scheduler': lr_scheduler.state_dict(),
+                'scaler': scaler.state_dict() if scaler else None,
+                'best_map': best_map,
+                'rng': get_rng_state(),
+                **(extra_state or {}),
+            }
+            checkpoint_writer.save(training_state, training_state_path)
+
+    # Wait for outstanding evaluations, then make sure the last checkpoints are on disk before returning
+    collect_background_evaluations(wait=True)
+    if eval_executor:
+        eval_executor.shutdown()
+    checkpoint_writer.close()
+    if telemetry:
+        telemetry.close()
 
     # If the device is a GPU, empty the cache
     if device.type != 'cpu':
         getattr(torch, device.type).empty_cache()
 
 if __name__ ==  "__main__":
-    if len(sys.argv) != 3:
-        print("Needs path to dataset and path to save model output")
-        exit()
+    parser = argparse.ArgumentParser(description="Train the baseball card defect segmentation model")
+    parser.add_argument("dataset_directory", type=Path, help="Path to the dataset of images and labelme annotations")
+    parser.add_argument("checkpoint_directory", type=Path, help="Path to save the model output")
+    parser.add_argument("--cache-dir", type=Path, default=None, help="Directory for the decoded image and mask cache (default: <dataset>/.cache)")
+    parser.add_argument("--no-cache", action="store_true", help="Decode images and rasterize masks on every access")
+    parser.add_argument("--num-workers", type=int, default=None, help="DataLoader worker processes (default: half of the available cores, 4 on CUDA)")
+    parser.add_argument("--prefetch-factor", type=int, default=2, help="Batches loaded ahead by each worker")
+    parser.add_argument("--torch-threads", type=int, default=None, help="Intra-op threads for the training process (default: cores not used by workers)")
+    parser.add_argument("--shard", type=Path, default=None, help="Read pre-resized samples from a shard written by pack_dataset.py")
+    parser.add_argument("--checkpoint-every", type=int, default=1, help="Epochs between full training state checkpoints")
+    parser.add_argument("--resume", action="store_true", help="Continue from the training state in the checkpoint directory")
+    parser.add_argument("--eval-every", type=int, default=1, help="Epochs between validation runs")
+    parser.add_argument("--eval-in-background", action="store_true", help="Evaluate saved weights in a separate process while training continues")
+    parser.add_argument("--eval-device", default="cpu", help="Device for background evaluation")
+    parser.add_argument("--log-every", type=int, default=10, help="Steps between training metrics records and loss synchronization")
+    parser.add_argument("--sync-timing", action="store_true", help="Synchronize the accelerator at stage boundaries for exact stage timings")
+    parser.add_argument("--profile-steps", type=parse_step_range, default=None, help="Global steps START:END to record a torch.profiler trace for")
+    parser.add_argument("--batch-size", type=int, default=4, help="Images per batch on each rank")
+    parser.add_argument("--accumulation-steps", type=int, default=1, help="Batches whose gradients are accumulated into each optimizer step")
+    parser.add_argument("--resize-policy", choices=RESIZE_POLICIES, default="stretch",
+                        help="Stretch every image to 1120x800, or keep its aspect ratio within those bounds (shards are already stretched)")
+    parser.add_argument("--group-by-aspect", action="store_true", help="Batch portrait and landscape training images separately")
+    parser.add_argument("--tile-size", type=int, nargs=2, default=None, metavar=("HEIGHT", "WIDTH"),
+                        help="Train on full-resolution tiles of this size drawn around annotated polygons, for tiled inference")
+    parser.add_argument("--tile-background", type=float, default=0.1, help="Fraction of training tiles placed anywhere instead of around a polygon")
+    parser.add_argument("--epochs", type=int, default=60, help="Training epochs")
+    parser.add_argument("--init-from", type=Path, default=None, help="Start from the weights of this checkpoint bundle, keeping the predictor rows of its classes")
+    parser.add_argument("--head-only", action="store_true",
+                        help="Freeze the backbone and FPN, cache their feature maps of the non-augmented images, and train only the RPN and ROI heads from them")
+    parser.add_argument("--feature-dir", type=Path, default=None, help="Directory for the feature maps of --head-only (default: <cache dir>/features)")
+    parser.add_argument("--augmentation", choices=AUGMENTATION_PIPELINES, default="pil",
+                        help="Jitter and flip decoded PIL images, or resize first and augment uint8 tensors with the color jitter applied per batch")
+    args = parser.parse_args()
+    assert not (args.tile_size and args.shard), "Shards hold resized images, tiled training needs the full-resolution images"
+    assert not (args.head_only and args.eval_in_background), "Background evaluation reads images, head-only training evaluates on cached features"
 
     # Name of the model
     model_name = "BaseballCardGraderModel"
 
+    # Joins the process group when launched with torchrun, and gives each process its own GPU
+    distributed = init_distributed()
+    processes_per_node = get_local_world_size() if distributed else 1
+
     # Gets device for training
     device = get_torch_device()
+    if distributed and device == "cuda":
+        device = f"cuda:{get_local_rank()}"
+    elif distributed and device == "mps":
+        # The gloo backend cannot reduce MPS tensors
+        device = "cpu"
     dtype = torch.float32
 
     # Paths for dataset and checkpoint directory
-    dataset_directory = Path(sys.argv[1])
-    checkpoint_directory = Path(sys.argv[2]) 
+    dataset_directory = args.dataset_directory
+    checkpoint_directory = args.checkpoint_directory
     checkpoint_path = checkpoint_directory/f"{model_name}.pth"
+    training_state_path = checkpoint_directory/f"{model_name}-training-state.pt"
+    resume_state = load_training_state(training_state_path) if args.resume else None
 
-    # Gets all image file paths in the dataset directory
-    image_file_paths = list(dataset_directory.glob("*.png"))
-    image_dict = {file.stem : file for file in image_file_paths}
-
-    # Gets all annotation file paths in the dataset directory
-    annotation_file_paths = list(dataset_directory.glob("*.json"))
-
-    # Dataframe for annotations
-    cls_dataframes = (pd.read_json(file_path, orient='index').transpose() for file_path in annotation_file_paths)
-    annotation_df = pd.concat(cls_dataframes, ignore_index=False)
-    annotation_df['index'] = annotation_df.apply(lambda row: row['imagePath'].split('.')[0], axis=1)
-    annotation_df = annotation_df.set_index('index')
-
-    # Dataframe for segmentations of annotations
-    shapes_df = annotation_df['shapes'].explode().to_frame().shapes.apply(pd.Series)
-
-    # Gets unique list of classes, in this case just one, and adds 'background' class
-    class_names = shapes_df['label'].unique().tolist()
-    class_names = ['background'] + class_names
+    # Loads the images, annotations and class names of the dataset
+    image_dict, annotation_index, class_names = load_dataset_annotations(dataset_directory)
 
     # Generate a list of colors with a length equal to the number of labels
     colors = distinctipy.get_colors(len(class_names))
     int_colors = [tuple(int(c*255) for c in color) for color in colors]
 
     # Initialize a Mask R-CNN model with pretrained weights
-    model = maskrcnn_resnet50_fpn_v2(weights='DEFAULT')
-    in_features_box = model.roi_heads.box_predictor.cls_score.in_features
-    in_features_mask = model.roi_heads.mask_predictor.conv5_mask.in_channels
-    dim_reduced = model.roi_heads.mask_predictor.conv5_mask.out_channels
-    model.roi_heads.box_predictor = FastRCNNPredictor(in_channels=in_features_box, num_classes=len(class_names))
-    model.roi_heads.mask_predictor = MaskRCNNPredictor(in_channels=in_features_mask, dim_reduced=dim_reduced, num_classes=len(class_names))
+    model = create_model(len(class_names), weights=None if args.init_from else 'DEFAULT')
+    if args.init_from:
+        new_classes = load_initial_weights(model, args.init_from, class_names)
+        print(f"Starting from {args.init_from}" + (f", with new classes {', '.join(new_classes)}" if new_classes else ""))
+    if not args.tile_size:
+        set_model_resize_bounds(model, args.resize_policy)
     model.to(device=torch.device(device), dtype=dtype)
     model.device = device
     model.name = model_name
 
-    # Split the subset of image paths into training and validation sets
+    # Split the subset of image paths into training and validation sets, or reuse the split being resumed
     train_percentage = 0.75
     image_keys = list(image_dict.keys())
-    random.shuffle(image_keys)
-    train_keys = image_keys[ : int(len(image_keys) * train_percentage)]
-    valid_keys = image_keys[int(len(image_keys) * train_percentage) : ]
-
-    # Define data augmentation transforms
-    data_augment_transforms = transforms.Compose(
-        transforms=[
-            transforms.ColorJitter(
-                    brightness = (0.95, 1.05),
-                    contrast = (0.95, 1.05),
-                    saturation = (0.95, 1.05),
-                    hue = (-0.02, 0.02),
-            ),
-            transforms.RandomHorizontalFlip(p=0.5),
-            transforms.RandomVerticalFlip(p=0.5),
-        ],
-    )
-    # Compose transforms to sanitize bounding boxes and normalize input data
-    final_tranforms = transforms.Compose([
-        transforms.ToImage(), 
-        transforms.ToDtype(torch.float32, scale=True),
-        transforms.SanitizeBoundingBoxes(),
-    ])
-    # Compose transforms to resize images
-    resize_tranforms = transforms.Compose([
-        transforms.Resize([1120, 800], antialias=True)
-    ])
-    # Define the transformations for training and validation datasets
-    train_tfms = transforms.Compose([
-        data_augment_transforms, 
-        resize_tranforms,
-        final_tranforms
-    ])
-    valid_tfms = transforms.Compose([
-        resize_tranforms,
-        final_tranforms
-    ])
+    if resume_state:
+        train_keys, valid_keys = resume_state['train_keys'], resume_state['valid_keys']
+        image_keys = train_keys + valid_keys
+        missing_keys = [key for key in image_keys if key not in image_dict]
+        assert not missing_keys, f"Images from the resumed run are missing from {dataset_directory}: {missing_keys}"
+    else:
+        random.shuffle(image_keys)
+        train_keys = image_keys[ : int(len(image_keys) * train_percentage)]
+        valid_keys = image_keys[int(len(image_keys) * train_percentage) : ]
+        # Every rank must shard the same split, so all of them use rank 0's
+        train_keys, valid_keys = broadcast_object((train_keys, valid_keys))
+
+    # Define the transformations for training and validation datasets, and the collate functions that finish them
+    train_tfms, valid_tfms = get_augmentation_transforms(args.augmentation, args.resize_policy, args.tile_size, args.tile_background)
+    train_collate_fn, valid_collate_fn = get_collate_fns(args.augmentation, custom_collate_fn)
+
+    # Open the pre-resized shard, or build the decoded image and mask cache once, before any epoch runs
+    mask_cache = None
+    shard = TrainingShard(args.shard) if args.shard else None
+    if shard:
+        missing_keys = [key for key in image_keys if key not in shard]
+        assert not missing_keys, f"Images missing from {args.shard}, re-run pack_dataset.py: {missing_keys}"
+    elif not args.no_cache:
+        # Rank 0 fills the cache while the other ranks wait, then every rank reads it
+        mask_cache = MaskCache(args.cache_dir or dataset_directory/'.cache')
+        if is_main_process():
+            mask_cache.build([image_dict[key] for key in image_keys], [annotation_index.get_shapes(key) for key in image_keys])
+        barrier()
 
     # Instantiate the datasets using the defined transformations
     class_to_idx = {c: i for i, c in enumerate(class_names)}
-    train_dataset = BaseballCardDataset(train_keys, annotation_df, image_dict, class_to_idx, train_tfms)
-    valid_dataset = BaseballCardDataset(valid_keys, annotation_df, image_dict, class_to_idx, valid_tfms)
-
-    # Define parameters for DataLoader
-    if device == "cuda":
-        data_loader_params = {
-            'batch_size': 4,
-            'num_workers': 4,
-            'persistent_workers': True,
-            'pin_memory': True,
-            'pin_memory_device': device,
-            'collate_fn': custom_collate_fn,
-        }
-    else:  # mps or cpu
-        data_loader_params = {
-            'batch_size': 4,
-            'num_workers': 0,
-            'persistent_workers': False,
-            'collate_fn': custom_collate_fn,
-        }
-    # Create DataLoader for training data. Data is shuffled for every epoch.
-    train_dataloader = DataLoader(train_dataset, **data_loader_params, shuffle=True)
-    # Create DataLoader for validation data. Shuffling is not necessary for validation data.
-    valid_dataloader = DataLoader(valid_dataset, **data_loader_params)
+    train_dataset = BaseballCardDataset(train_keys, annotation_index, image_dict, class_to_idx, train_tfms, mask_cache, shard)
+    valid_dataset = BaseballCardDataset(valid_keys, annotation_index, image_dict, class_to_idx, valid_tfms, mask_cache, shard)
+
+    if args.head_only:
+        # The frozen backbone's feature maps of the non-augmented samples are computed once, and the heads train on them in place of the images
+        preprocessing = get_preprocessing(model, resize_policy=args.resize_policy, tile_size=args.tile_size)
+        feature_cache = FeatureCache(args.feature_dir or (args.cache_dir or dataset_directory/'.cache')/'features')
+        backbone_hash = get_backbone_hash(model)
+        feature_settings = {'preprocessing': preprocessing, 'class_names': class_names}
+        feature_keys = {key: feature_cache.get_key(image_dict[key], annotation_index.get_shapes(key), backbone_hash, feature_settings) for key in image_keys}
+        if is_main_process():
+            feature_source = BaseballCardDataset(image_keys, annotation_index, image_dict, class_to_idx, valid_tfms, mask_cache, shard)
+            feature_cache.build(model, feature_source, [feature_keys[key] for key in image_keys], device)
+        barrier()
+        train_dataset = CachedFeatureDataset(feature_cache, [feature_keys[key] for key in train_keys])
+        valid_dataset = CachedFeatureDataset(feature_cache, [feature_keys[key] for key in valid_keys])
+        train_collate_fn = valid_collate_fn = custom_collate_fn
+        model = CachedFeatureHeads(model)
+
+    # Define parameters for DataLoader and keep the model's threads off the worker cores
+    data_loader_params = get_data_loader_params(device, args.batch_size, args.num_workers, args.prefetch_factor, processes_per_node)
+    torch_threads = set_torch_threads(data_loader_params['num_workers'], args.torch_threads, processes_per_node)
+    print(f"Using {data_loader_params['num_workers']} DataLoader workers and {torch_threads} torch threads" + (f" on each of {get_world_size()} ranks" if distributed else ""))
+    if distributed:
+        # Each rank trains on its own shard, reshuffled every epoch, and evaluates an unpadded shard
+        train_sampler = DistributedSampler(train_dataset, shuffle=True)
+        valid_sampler = ShardSampler(valid_dataset)
+    else:
+        # Training data is shuffled for every epoch. Shuffling is not necessary for validation data.
+        train_sampler = torch.utils.data.RandomSampler(train_dataset)
+        valid_sampler = None
+    batch_size = data_loader_params.pop('batch_size')
+    data_loader_params.pop('collate_fn')
+    if args.group_by_aspect:
+        # Batch only images of the same orientation together, so none is padded to the other's shape
+        group_ids = get_aspect_ratio_groups(train_keys, annotation_index, image_dict)
+        train_dataloader = DataLoader(train_dataset, **data_loader_params, batch_sampler=GroupedBatchSampler(train_sampler, group_ids, batch_size),
+                                      collate_fn=train_collate_fn)
+    else:
+        # Create DataLoader for training data
+        train_dataloader = DataLoader(train_dataset, **data_loader_params, batch_size=batch_size, sampler=train_sampler, collate_fn=train_collate_fn)
+    # Create DataLoader for validation data
+    valid_dataloader = DataLoader(valid_dataset, **data_loader_params, batch_size=batch_size, sampler=valid_sampler, collate_fn=valid_collate_fn)
 
     # Create a color map and write it to a JSON file
-    color_map = {'items': [{'label': label, 'color': color} for label, color in zip(class_names, colors)]}
-    with open(f"{checkpoint_directory}/{model_name}-colormap.json", "w") as file:
-        json.dump(color_map, file)
+    if is_main_process():
+        color_map = {'items': [{'label': label, 'color': color} for label, color in zip(class_names, colors)]}
+        with open(f"{checkpoint_directory}/{model_name}-colormap.json", "w") as file:
+            json.dump(color_map, file)
+
+    # Gradients are averaged across ranks on every backward pass
+    if distributed:
+        model = DistributedDataParallel(model, device_ids=[torch.device(device).index] if torch.device(device).type == "cuda" else None)
 
     # Trains the model
     lr = 5e-4
-    epochs = 60
+    epochs = args.epochs
     optimizer = torch.optim.AdamW(model.parameters(), lr=lr)
-    lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=lr, total_steps=epochs*len(train_dataloader))
+    # len(train_dataloader) is the batch count of this rank's shard, which every rank takes, grouped into optimizer steps
+    steps_per_epoch = math.ceil(len(train_dataloader) / args.accumulation_steps)
+    lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=lr, total_steps=epochs*steps_per_epoch)
+    print(f"Training with {args.batch_size} images per batch x {args.accumulation_steps} accumulation steps x {get_world_size()} ranks"
+          f" = {args.batch_size * args.accumulation_steps * get_world_size()} images per optimizer step ({f'{args.tile_size[0]}x{args.tile_size[1]} tiles' if args.tile_size else f'{args.resize_policy} resize'}"
+          f"{', grouped by aspect ratio' if args.group_by_aspect else ''}, {'heads only on cached features' if args.head_only else f'{args.augmentation} augmentation'})")
+    training_settings = {
+        'batch_size': args.batch_size,
+        'accumulation_steps': args.accumulation_steps,
+        'world_size': get_world_size(),
+        'effective_batch_size': args.batch_size * args.accumulation_steps * get_world_size(),
+        'resize_policy': args.resize_policy,
+        'group_by_aspect': args.group_by_aspect,
+        'tile_size': args.tile_size,
+        'augmentation': args.augmentation,
+        'head_only': args.head_only,
+        'init_from': str(args.init_from) if args.init_from else None,
+    }
     train_loop(model=model, 
             train_dataloader=train_dataloader,
             valid_dataloader=valid_dataloader,
@@ -385,4 +786,18 @@ if __name__ ==  "__main__":
             device=torch.device(device), 
             epochs=epochs, 
             checkpoint_path=checkpoint_path,
-            use_scaler=True)
+            use_scaler=True,
+            training_state_path=training_state_path,
+            checkpoint_every=args.checkpoint_every,
+            resume_state=resume_state,
+            extra_state={'train_keys': train_keys, 'valid_keys': valid_keys},
+            class_names=class_names,
+            eval_every=args.eval_every,
+            eval_in_background=args.eval_in_background,
+            eval_device=args.eval_device,
+            colors=colors,
+            preprocessing=get_preprocessing(unwrap_model(model), resize_policy=args.resize_policy, tile_size=args.tile_size),
+            telemetry=TrainingTelemetry(checkpoint_directory/'training_metrics.jsonl' if is_main_process() else None, device, args.log_every, args.sync_timing, args.profile_steps,
+                                        settings=training_settings),
+            accumulation_steps=args.accumulation_steps)
+    cleanup_distributed()